@@ -1,5 +1,8 @@
 import unittest
 
+import numpy as np
+import dynet as dy
+
 import xnmt.batcher
 import xnmt.input
 import xnmt.events
@@ -60,5 +63,35 @@ class TestBatcher(unittest.TestCase):
       if l!=l0: return
     self.assertTrue(False)
 
+  def test_pad_array_inputs(self):
+    lens = [3, 5, 2]
+    sents = [xnmt.input.ArrayInput(np.random.uniform(-1, 1, (4, sent_len))) for sent_len in lens]
+    for pad_token in [None, 0]:
+      for pad_src_to_multiple, max_len in [(1, 5), (4, 8)]:
+        padded, mask = xnmt.batcher.pad(sents, pad_token=pad_token, pad_src_to_multiple=pad_src_to_multiple)
+        for sent, padded_sent in zip(sents, padded):
+          # reference: the former per-item padding with np.append
+          pad_len = max_len - len(sent)
+          pad_frames = np.zeros((4, pad_len)) if pad_token == 0 \
+                       else np.broadcast_to(sent.nparr[:,-1:], (4, pad_len))
+          np.testing.assert_array_almost_equal(padded_sent.get_array(), np.append(sent.nparr, pad_frames, axis=1))
+        self.assertEqual(mask.np_arr.tolist(),
+                         [[0.0] * sent_len + [1.0] * (max_len - sent_len) for sent_len in lens])
+
+  def test_mask_expr_cache(self):
+    mask = xnmt.batcher.Mask(np.array([[0, 0, 1], [0, 0, 0]]))
+    dy.renew_cg()
+    expr = dy.inputTensor(np.ones((1, 2)), batched=True)
+    self.assertIs(mask.cmult_by_timestep_expr(expr, 1, inverse=True), expr)
+    masked = mask.cmult_by_timestep_expr(expr, 2, inverse=True)
+    self.assertEqual(masked.npvalue().tolist(), [[0.0, 1.0]])
+    cached_expr = mask._expr_cache[(2, True, None)]
+    mask.cmult_by_timestep_expr(expr, 2, inverse=True)
+    self.assertIs(mask._expr_cache[(2, True, None)], cached_expr)
+    dy.renew_cg()
+    expr = dy.inputTensor(np.ones((1, 2)), batched=True)
+    self.assertEqual(mask.cmult_by_timestep_expr(expr, 2, inverse=False).npvalue().tolist(), [[1.0, 0.0]])
+    self.assertNotIn((2, True, None), mask._expr_cache)
+
 if __name__ == '__main__':
   unittest.main()
@@ -2,6 +2,7 @@ import unittest
 
 import dynet_config
 import dynet as dy
+import numpy as np
 
 from xnmt.attender import MlpAttender
 from xnmt.bridge import CopyBridge
@@ -9,6 +10,7 @@ from xnmt.decoder import MlpSoftmaxDecoder
 from xnmt.embedder import SimpleWordEmbedder
 import xnmt.events
 from xnmt.input_reader import PlainTextReader
+from xnmt.length_normalization import PolynomialNormalization
 from xnmt.lstm import UniLSTMSeqTransducer, BiLSTMSeqTransducer
 from xnmt.loss_calculator import MLELoss
 from xnmt.mlp import MLP
@@ -170,6 +172,61 @@ class TestGreedyVsBeam(unittest.TestCase):
 
     self.assertAlmostEqual(output_score1, output_score2)
 
+class TestBeamSearchEarlyStopping(unittest.TestCase):
+  """
+  Test that early stopping without length normalization does not change the best hypothesis.
+  """
+  def setUp(self):
+    layer_dim = 512
+    xnmt.events.clear()
+    ParamManager.init_param_col()
+    self.model = DefaultTranslator(
+      src_reader=PlainTextReader(),
+      trg_reader=PlainTextReader(),
+      src_embedder=SimpleWordEmbedder(emb_dim=layer_dim, vocab_size=100),
+      encoder=BiLSTMSeqTransducer(input_dim=layer_dim, hidden_dim=layer_dim),
+      attender=MlpAttender(input_dim=layer_dim, state_dim=layer_dim, hidden_dim=layer_dim),
+      trg_embedder=SimpleWordEmbedder(emb_dim=layer_dim, vocab_size=100),
+      decoder=MlpSoftmaxDecoder(input_dim=layer_dim,
+                                trg_embed_dim=layer_dim,
+                                rnn_layer=UniLSTMSeqTransducer(input_dim=layer_dim, hidden_dim=layer_dim, decoder_input_dim=layer_dim, yaml_path="model.decoder.rnn_layer"),
+                                mlp_layer=MLP(input_dim=layer_dim, hidden_dim=layer_dim, decoder_rnn_dim=layer_dim, vocab_size=100, yaml_path="model.decoder.rnn_layer"),
+                                bridge=CopyBridge(dec_dim=layer_dim, dec_layers=1)),
+    )
+    self.model.set_train(False)
+
+    self.src_data = list(self.model.src_reader.read_sents("examples/data/head.ja"))
+
+  def test_early_stopping(self):
+    dy.renew_cg()
+    self.model.initialize_generator()
+    outputs1 = self.model.generate_output(self.src_data[0], 0, BeamSearch(beam_size=5, max_len=20))
+
+    dy.renew_cg()
+    self.model.initialize_generator()
+    outputs2 = self.model.generate_output(self.src_data[0], 0, BeamSearch(beam_size=5, max_len=20,
+                                                                           early_stopping=True))
+
+    self.assertEqual(outputs1[0].actions, outputs2[0].actions)
+    self.assertAlmostEqual(outputs1[0].score, outputs2[0].score, places=4)
+
+class TestPolynomialNormalization(unittest.TestCase):
+
+  def test_completed_scores(self):
+    len_norm = PolynomialNormalization(m=0.8)
+    scores = np.array([-1.0, -2.5, -4.0])
+    lengths = np.array([1, 3, 7])
+    normalized = len_norm.normalize_completed_scores(scores, lengths)
+    for score, length, norm_score in zip(scores, lengths, normalized):
+      self.assertAlmostEqual(score / pow(length, 0.8), norm_score)
+
+  def test_partial_scores(self):
+    len_norm = PolynomialNormalization(m=0.8, apply_during_search=True)
+    score = 0.0
+    for length, word_score in enumerate([-1.0, -0.5, -2.0], start=1):
+      score = len_norm.normalize_partial(score, np.array([word_score]), length)[0]
+    self.assertAlmostEqual(-3.5 / pow(3, 0.8), score)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -1,20 +1,29 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 import dynet_config
 import dynet as dy
+import numpy as np
 
 from xnmt.attender import MlpAttender
 from xnmt.bridge import CopyBridge
-from xnmt.decoder import MlpSoftmaxDecoder
+from xnmt.decoder import MlpSoftmaxDecoder, MlpSoftmaxLexiconDecoder
 from xnmt.embedder import SimpleWordEmbedder
+import xnmt.batcher
 import xnmt.events
+from xnmt.input import SimpleSentenceInput
 from xnmt.input_reader import PlainTextReader
 from xnmt.loss_calculator import MLELoss
 from xnmt.lstm import UniLSTMSeqTransducer, BiLSTMSeqTransducer
 from xnmt.mlp import MLP
 from xnmt.param_collection import ParamManager
-from xnmt.translator import DefaultTranslator
-from xnmt.search_strategy import GreedySearch
+from xnmt.transformer import TransformerEncoder, TransformerDecoder
+from xnmt.translator import DefaultTranslator, EnsembleDecoder, EnsembleListDelegate, TransformerTranslator
+from xnmt.search_strategy import BeamSearch, GreedySearch, SamplingSearch, MctsSearch
+from xnmt.softmax import ClassFactoredSoftmax
+from xnmt.vocab import Vocab
 
 class TestForcedDecodingOutputs(unittest.TestCase):
 
@@ -95,6 +104,31 @@ class TestForcedDecodingLoss(unittest.TestCase):
     output_score = outputs[0].score
     self.assertAlmostEqual(-output_score, train_loss, places=5)
 
+  def test_shared_src_matches_single(self):
+    trgs = self.trg_data[:3]
+    dy.renew_cg()
+    shared_losses = self.model.calc_loss_shared_src(self.src_data[0], trgs, MLELoss()).value()
+    for trg, shared_loss in zip(trgs, shared_losses):
+      dy.renew_cg()
+      single_loss = self.model.calc_loss(src=self.src_data[0], trg=trg, loss_calculator=MLELoss()).value()
+      self.assertAlmostEqual(shared_loss, single_loss, places=4)
+
+  def test_sampling_forced(self):
+    dy.renew_cg()
+    train_loss = self.model.calc_loss(src=self.src_data[0],
+                                      trg=self.trg_data[0],
+                                      loss_calculator=MLELoss()).value()
+    dy.renew_cg()
+    src = xnmt.batcher.mark_as_batch([self.src_data[0]])
+    self.model.start_sent(src)
+    encodings, enc_final_states = self.model._encode_src(src)
+    initial_state = self.model._initial_state(src, encodings, enc_final_states)
+    outputs = SamplingSearch(sample_size=3).generate_output(self.model, initial_state,
+                                                            forced_trg_ids=self.trg_data[0])
+    self.assertEqual(len(outputs), 3)
+    self.assertEqual(outputs[0].word_ids.shape[0], 1)
+    self.assertAlmostEqual(-outputs[0].score[0], train_loss, places=4)
+
 class TestFreeDecodingLoss(unittest.TestCase):
 
   def setUp(self):
@@ -134,6 +168,265 @@ class TestFreeDecodingLoss(unittest.TestCase):
 
     self.assertAlmostEqual(-output_score, train_loss, places=5)
 
+  def test_mcts(self):
+    dy.renew_cg()
+    self.model.initialize_generator()
+    outputs = self.model.generate_output(self.src_data[0], 0, MctsSearch(visits=16, max_len=5, leaves_per_step=4))
+    self.assertLessEqual(len(outputs[0].actions), 5)
+    self.assertLessEqual(outputs[0].score, 0.0)
+
+class TestClassFactoredSoftmax(unittest.TestCase):
+
+  def setUp(self):
+    xnmt.events.clear()
+    ParamManager.init_param_col()
+    # 7 classes of 14 words, the last of which has 3 unused slots
+    self.softmax = ClassFactoredSoftmax(input_dim=8, vocab_size=95, num_classes=7,
+                                        word_ranking=list(np.random.permutation(95)))
+
+  def test_log_probs_normalized(self):
+    dy.renew_cg()
+    log_probs = self.softmax(dy.inputTensor(np.random.randn(8))).npvalue()
+    self.assertAlmostEqual(np.exp(log_probs).sum(), 1.0, places=5)
+
+  def test_loss_matches_log_probs(self):
+    dy.renew_cg()
+    x = dy.inputTensor(np.random.randn(8, 4), batched=True)
+    ref_ids = [0, 17, 93, 94]
+    log_probs = self.softmax(x).npvalue()
+    losses = self.softmax.calc_loss(x, xnmt.batcher.mark_as_batch(ref_ids)).npvalue()
+    np.testing.assert_allclose(losses.flatten(), -log_probs[ref_ids, range(4)], rtol=1e-5)
+
+  def test_best_k_matches_log_probs(self):
+    dy.renew_cg()
+    x = dy.inputTensor(np.random.randn(8))
+    log_probs = self.softmax(x).npvalue()
+    best_words, best_scores = self.softmax.best_k(x, 5)
+    self.assertEqual(best_words.shape, (5, 1))
+    order = np.argsort(-best_scores[:, 0])
+    self.assertEqual(list(best_words[order, 0]), list(np.argsort(-log_probs)[:5]))
+    np.testing.assert_allclose(best_scores[order, 0], np.sort(log_probs)[::-1][:5], rtol=1e-5)
+
+  def test_best_k_batched(self):
+    dy.renew_cg()
+    x = dy.inputTensor(np.random.randn(8, 3), batched=True)
+    log_probs = self.softmax(x).npvalue()
+    best_words, best_scores = self.softmax.best_k(x, 20)
+    self.assertEqual(best_words.shape, (20, 3))
+    for b in range(3):
+      self.assertEqual(set(best_words[:, b]), set(np.argsort(-log_probs[:, b])[:20]))
+      np.testing.assert_allclose(best_scores[:, b], log_probs[best_words[:, b], b], rtol=1e-5)
+
+def build_small_translator(layer_dim=32):
+  return DefaultTranslator(
+    src_reader=PlainTextReader(),
+    trg_reader=PlainTextReader(),
+    src_embedder=SimpleWordEmbedder(emb_dim=layer_dim, vocab_size=100),
+    encoder=BiLSTMSeqTransducer(input_dim=layer_dim, hidden_dim=layer_dim),
+    attender=MlpAttender(input_dim=layer_dim, state_dim=layer_dim, hidden_dim=layer_dim),
+    trg_embedder=SimpleWordEmbedder(emb_dim=layer_dim, vocab_size=100),
+    decoder=MlpSoftmaxDecoder(input_dim=layer_dim,
+                              trg_embed_dim=layer_dim,
+                              rnn_layer=UniLSTMSeqTransducer(input_dim=layer_dim, hidden_dim=layer_dim, decoder_input_dim=layer_dim, yaml_path="model.decoder.rnn_layer"),
+                              mlp_layer=MLP(input_dim=layer_dim, hidden_dim=layer_dim, decoder_rnn_dim=layer_dim, vocab_size=100, yaml_path="model.decoder.rnn_layer"),
+                              bridge=CopyBridge(dec_dim=layer_dim, dec_layers=1)),
+  )
+
+class TestEnsembleDecoder(unittest.TestCase):
+
+  def setUp(self):
+    xnmt.events.clear()
+    ParamManager.init_param_col()
+    self.models = [build_small_translator() for _ in range(2)]
+    for model in self.models:
+      model.set_train(False)
+    self.decoder = EnsembleDecoder([model.decoder for model in self.models], weights=[1.0, 3.0])
+    self.src_data = list(self.models[0].src_reader.read_sents("examples/data/head.ja"))
+
+  def get_states(self):
+    src = xnmt.batcher.mark_as_batch([self.src_data[0]])
+    states = []
+    for model in self.models:
+      model.start_sent(src)
+      encodings, enc_final_states = model._encode_src(src)
+      state = model._initial_state(src, encodings, enc_final_states)
+      state.context = model.attender.calc_context(state.rnn_state.output())
+      states.append(state)
+    return EnsembleListDelegate(states)
+
+  def test_stacked_matches_weighted_sum(self):
+    dy.renew_cg()
+    states = self.get_states()
+    self.assertTrue(self.decoder._stackable)
+    stacked = self.decoder.get_scores_logsoftmax(states).npvalue()
+    expected = 0.25 * self.models[0].decoder.get_scores_logsoftmax(states[0]).npvalue() \
+               + 0.75 * self.models[1].decoder.get_scores_logsoftmax(states[1]).npvalue()
+    np.testing.assert_allclose(stacked, expected, rtol=1e-5, atol=1e-6)
+
+  def test_stacked_output_follows_graph(self):
+    dy.renew_cg()
+    first = self.decoder.get_scores_logsoftmax(self.get_states()).npvalue()
+    dy.renew_cg()
+    second = self.decoder.get_scores_logsoftmax(self.get_states()).npvalue()
+    np.testing.assert_allclose(first, second, rtol=1e-5)
+
+class TestBeamSearch(unittest.TestCase):
+
+  def setUp(self):
+    xnmt.events.clear()
+    ParamManager.init_param_col()
+    self.models = [build_small_translator() for _ in range(2)]
+    for model in self.models:
+      model.set_train(False)
+    self.src_data = list(self.models[0].src_reader.read_sents("examples/data/head.ja"))
+
+  def assert_best_k_matches_full_scores(self, translator):
+    src = xnmt.batcher.mark_as_batch([self.src_data[0]])
+    search = BeamSearch(beam_size=3, max_len=10)
+    outputs = []
+    for collect_loss_info in [False, True]:
+      dy.renew_cg()
+      translator.start_sent(src)
+      encodings, enc_final_states = translator._encode_src(src)
+      initial_state = translator._initial_state(src, encodings, enc_final_states)
+      # collecting loss info forces the search to compute the full output distribution instead of using best_k()
+      outputs.append(search.generate_output(translator, initial_state, src_length=[len(self.src_data[0])],
+                                            collect_loss_info=collect_loss_info)[0])
+    self.assertEqual(outputs[0].word_ids, outputs[1].word_ids)
+    self.assertAlmostEqual(outputs[0].score[0], outputs[1].score[0], places=4)
+
+  def test_best_k_matches_full_scores(self):
+    self.assert_best_k_matches_full_scores(self.models[0])
+
+  def test_hyp_scores_match_forced_decoding(self):
+    # all hyps are expanded as one batch, so each hyp must continue from its own batch element of the previous step
+    translator = self.models[0]
+    src = xnmt.batcher.mark_as_batch([self.src_data[0]])
+    dy.renew_cg()
+    translator.start_sent(src)
+    encodings, enc_final_states = translator._encode_src(src)
+    initial_state = translator._initial_state(src, encodings, enc_final_states)
+    outputs = BeamSearch(beam_size=5, max_len=10, one_best=False).generate_output(translator, initial_state)
+    self.assertGreater(len(outputs), 1)
+    for output in outputs:
+      word_ids = output.word_ids[0]
+      forced_output = GreedySearch(max_len=len(word_ids)).generate_output(translator, initial_state,
+                                                                          forced_trg_ids=word_ids)[0]
+      self.assertAlmostEqual(output.score[0], forced_output.score[0], places=4)
+
+  def test_best_k_matches_full_scores_ensemble(self):
+    ensemble = DefaultTranslator(
+      src_reader=self.models[0].src_reader,
+      trg_reader=self.models[0].trg_reader,
+      src_embedder=EnsembleListDelegate([model.src_embedder for model in self.models]),
+      encoder=EnsembleListDelegate([model.encoder for model in self.models]),
+      attender=EnsembleListDelegate([model.attender for model in self.models]),
+      trg_embedder=EnsembleListDelegate([model.trg_embedder for model in self.models]),
+      decoder=EnsembleDecoder([model.decoder for model in self.models], weights=[1.0, 3.0]),
+    )
+    self.assert_best_k_matches_full_scores(ensemble)
+
+class TestTransformerMaskCache(unittest.TestCase):
+
+  def setUp(self):
+    xnmt.events.clear()
+    ParamManager.init_param_col()
+    self.model = TransformerTranslator(
+      src_reader=PlainTextReader(),
+      src_embedder=SimpleWordEmbedder(emb_dim=16, vocab_size=100),
+      encoder=TransformerEncoder(input_dim=16),
+      trg_reader=PlainTextReader(),
+      trg_embedder=SimpleWordEmbedder(emb_dim=16, vocab_size=100),
+      decoder=TransformerDecoder(input_dim=16, vocab_size=100, trg_reader=None),
+      input_dim=16,
+    )
+
+  def test_masks_are_shared(self):
+    block = np.zeros((2, 5), dtype=bool)
+    self.assertIs(self.model.make_attention_mask(block, block), self.model.make_attention_mask(block, block))
+    self.assertEqual(self.model.make_history_mask(block).tolist(),
+                     [np.tril(np.ones((5, 5), dtype=bool)).tolist()] * 2)
+
+  def test_cache_is_bounded(self):
+    self.model.max_cached_masks = 3
+    first = self.model.make_attention_mask(np.zeros((1, 1), dtype=bool), np.zeros((1, 1), dtype=bool))
+    for length in range(2, 6):
+      self.model.make_attention_mask(np.zeros((1, 1), dtype=bool), np.zeros((1, length), dtype=bool))
+      # recently used masks stay cached
+      self.model.make_attention_mask(np.zeros((1, 1), dtype=bool), np.zeros((1, 2), dtype=bool))
+    self.assertEqual(len(self.model.mask_cache), 3)
+    self.assertIn(("attention", (1, 1, 2)), self.model.mask_cache)
+    self.assertNotIn(("attention", (1, 1, 1)), self.model.mask_cache)
+    self.assertIsNot(self.model.make_attention_mask(np.zeros((1, 1), dtype=bool), np.zeros((1, 1), dtype=bool)), first)
+
+class TestLexiconDecoder(unittest.TestCase):
+
+  def setUp(self):
+    xnmt.events.clear()
+    ParamManager.init_param_col()
+    self.out_dir = tempfile.mkdtemp()
+    self.lexicon_file = os.path.join(self.out_dir, "lexicon.txt")
+    with open(self.lexicon_file, "w", encoding="utf-8") as f:
+      f.write("x a 0.5\ny a 0.3\nx a 0.2\nz b 0.75\nx b 0.25\ny c 0.9\nmalformed line\n")
+    self.src_vocab, self.trg_vocab = self.make_vocab(["a", "b", "c"]), self.make_vocab(["x", "y", "z"])
+
+  def tearDown(self):
+    shutil.rmtree(self.out_dir)
+
+  def make_vocab(self, words):
+    vocab = Vocab()
+    for word in words:
+      vocab.convert(word)
+    vocab.freeze()
+    vocab.set_unk(Vocab.UNK_STR)
+    return vocab
+
+  def build_decoder(self, lexicon_topk=None):
+    layer_dim = 8
+    return MlpSoftmaxLexiconDecoder(input_dim=layer_dim,
+                                    trg_embed_dim=layer_dim,
+                                    rnn_layer=UniLSTMSeqTransducer(input_dim=layer_dim, hidden_dim=layer_dim, decoder_input_dim=layer_dim, yaml_path="model.decoder.rnn_layer"),
+                                    mlp_layer=MLP(input_dim=layer_dim, hidden_dim=layer_dim, decoder_rnn_dim=layer_dim, vocab_size=len(self.trg_vocab), yaml_path="model.decoder.rnn_layer"),
+                                    bridge=CopyBridge(dec_dim=layer_dim, dec_layers=1),
+                                    lexicon_file=self.lexicon_file,
+                                    src_vocab=self.src_vocab,
+                                    trg_vocab=self.trg_vocab,
+                                    attender=MlpAttender(input_dim=layer_dim, state_dim=layer_dim, hidden_dim=layer_dim),
+                                    lexicon_topk=lexicon_topk)
+
+  def expected_lexicon(self, entries):
+    # rows of the special source words are fixed, and the remaining mass of each source word goes to the unknown word
+    expected = np.zeros((len(self.src_vocab), len(self.trg_vocab)))
+    for src_id, trg_id in [(Vocab.SS, Vocab.SS), (Vocab.ES, Vocab.ES), (self.src_vocab.unk_token, self.trg_vocab.unk_token)]:
+      expected[src_id, trg_id] = 1.0
+    for (src, trg), prob in entries.items():
+      expected[self.src_vocab.convert(src), self.trg_vocab.convert(trg)] = prob
+    for src in ["a", "b", "c"]:
+      src_id = self.src_vocab.convert(src)
+      expected[src_id, self.trg_vocab.unk_token] += 1.0 - expected[src_id].sum()
+    return expected
+
+  def test_load_lexicon(self):
+    lexicon = self.build_decoder().load_lexicon()
+    # the later of the duplicate entries for (a, x) wins
+    np.testing.assert_allclose(lexicon.toarray(),
+                               self.expected_lexicon({("a", "x"): 0.2, ("a", "y"): 0.3, ("b", "z"): 0.75,
+                                                      ("b", "x"): 0.25, ("c", "y"): 0.9}))
+
+  def test_load_lexicon_topk(self):
+    lexicon = self.build_decoder(lexicon_topk=1).load_lexicon()
+    np.testing.assert_allclose(lexicon.toarray(),
+                               self.expected_lexicon({("a", "y"): 0.3, ("b", "z"): 0.75, ("c", "y"): 0.9}))
+
+  def test_lexicon_prob(self):
+    decoder = self.build_decoder()
+    decoder.lexicon = decoder.load_lexicon()
+    src_ids = np.array([[2, 3, Vocab.ES], [4, Vocab.ES, Vocab.ES]])
+    dy.renew_cg()
+    decoder.on_start_sent(xnmt.batcher.mark_as_batch([SimpleSentenceInput(list(words)) for words in src_ids]))
+    # lexicon_prob has dimensions (trg_vocab_size, src_len) x batch_size
+    np.testing.assert_allclose(decoder.lexicon_prob.npvalue(),
+                               np.transpose(decoder.lexicon.toarray()[src_ids], (2, 1, 0)))
 
 if __name__ == '__main__':
   unittest.main()
@@ -1,10 +1,13 @@
 import unittest
 
 import numpy as np
+import dynet as dy
 from itertools import islice
 
 from xnmt.input_reader import PlainTextReader
-from xnmt.embedder import PretrainedSimpleWordEmbedder
+from xnmt.batcher import mark_as_batch
+from xnmt.embedder import PretrainedSimpleWordEmbedder, SimpleWordEmbedder
+from xnmt.input import SimpleSentenceInput
 from xnmt.param_collection import ParamManager
 import xnmt.events
 
@@ -31,3 +34,21 @@ class PretrainedSimpleWordEmbedderSanityTest(unittest.TestCase):
 
     self.assertTrue(np.allclose(embedder.embeddings.batch([test_id]).npvalue().tolist(),
                                 np.array(test_emb, dtype=float).tolist(), rtol=1e-5))
+
+class SimpleWordEmbedderSentTest(unittest.TestCase):
+  def setUp(self):
+    xnmt.events.clear()
+    ParamManager.init_param_col()
+    self.embedder = SimpleWordEmbedder(emb_dim=8, vocab_size=20, fix_norm=1)
+    dy.renew_cg()
+
+  def test_embed_sent_matches_embed(self):
+    """
+    Checks that the whole-sentence lookup yields the same vectors as embedding one position at a time.
+    """
+    sents = [[3, 5, 7, 1], [2, 4, 1, 1]]
+    sent_embs = self.embedder.embed_sent(mark_as_batch([SimpleSentenceInput(words) for words in sents]))
+    self.assertEqual(len(sent_embs), 4)
+    for word_i in range(4):
+      word_emb = self.embedder.embed(mark_as_batch([words[word_i] for words in sents]))
+      self.assertTrue(np.allclose(sent_embs[word_i].npvalue(), word_emb.npvalue()))
@@ -8,6 +8,7 @@ import dynet as dy
 from xnmt.pyramidal import PyramidalLSTMSeqTransducer
 from xnmt.translator import DefaultTranslator
 from xnmt.embedder import SimpleWordEmbedder
+from xnmt.expression_sequence import ExpressionSequence, ReversedExpressionSequence
 from xnmt.lstm import UniLSTMSeqTransducer, BiLSTMSeqTransducer
 from xnmt.mlp import MLP
 from xnmt.residual import ResidualLSTMSeqTransducer
@@ -153,5 +154,66 @@ class TestEncoder(unittest.TestCase):
       else:
         np.testing.assert_array_almost_equal(train_src[sent_i].mask.np_arr, encodings.mask.np_arr)
 
+  def test_uni_lstm_matches_stepwise(self):
+    lstm = UniLSTMSeqTransducer(layers=2, input_dim=8, hidden_dim=6)
+    for seq_len in [1, 5]:
+      dy.renew_cg()
+      self.set_train(False)
+      self.start_sent(self.src_data[0])
+      inputs = [dy.inputVector(np.random.uniform(-1, 1, (8,))) for _ in range(seq_len)]
+      encodings = lstm(ExpressionSequence(expr_list=inputs))
+      self.assertEqual(len(encodings), seq_len)
+      state = lstm.initial_state()
+      for inp, enc in zip(inputs, encodings):
+        state = state.add_input(inp)
+        np.testing.assert_array_almost_equal(state.output().npvalue(), enc.npvalue())
+
+  def test_bi_lstm_matches_reversed_backward(self):
+    bilstm = BiLSTMSeqTransducer(layers=1, input_dim=8, hidden_dim=6)
+    for seq_len in [1, 5]:
+      dy.renew_cg()
+      self.set_train(False)
+      self.start_sent(self.src_data[0])
+      inputs = ExpressionSequence(expr_list=[dy.inputVector(np.random.uniform(-1, 1, (8,))) for _ in range(seq_len)])
+      encodings = bilstm(inputs)
+      forward = bilstm.forward_layers[0](inputs)
+      rev_backward = bilstm.backward_layers[0](ReversedExpressionSequence(inputs))
+      for i in range(seq_len):
+        np.testing.assert_array_almost_equal(encodings[i].npvalue(),
+                                             np.concatenate([forward[i].npvalue(),
+                                                             rev_backward[seq_len-1-i].npvalue()]))
+
+  def list_based_pyramidal(self, pyramidal, inputs, reduce_factor):
+    # reference: the former list-based downsampling of a 2-layer pyramidal LSTM, with reversed backward inputs
+    (fb, bb), (fb2, bb2) = pyramidal.builder_layers
+    fs = fb([inputs])
+    bs = bb([ReversedExpressionSequence(inputs)])
+    seq_len = len(inputs)
+    if pyramidal.downsampling_method == "skip":
+      es_list = [ExpressionSequence(expr_list=fs.as_list()[::reduce_factor]),
+                 ExpressionSequence(expr_list=bs.as_list()[::reduce_factor][::-1])]
+    else:
+      es_list = [ExpressionSequence(expr_list=[fs[i+j] for i in range(0, seq_len, reduce_factor)])
+                 for j in range(reduce_factor)] \
+                + [ExpressionSequence(expr_list=[bs[seq_len-reduce_factor+j-i] for i in range(0, seq_len, reduce_factor)])
+                   for j in range(reduce_factor)]
+    fs2 = fb2(es_list)
+    bs2 = bb2([ReversedExpressionSequence(es) for es in es_list])
+    return [np.concatenate([fs2[i].npvalue(), bs2[len(fs2)-1-i].npvalue()]) for i in range(len(fs2))]
+
+  def test_py_lstm_matches_list_based(self):
+    for downsampling_method, reduce_factor, seq_len in [("skip", 2, 7), ("skip", 3, 7), ("concat", 3, 9)]:
+      pyramidal = PyramidalLSTMSeqTransducer(layers=2, input_dim=8, hidden_dim=6, reduce_factor=reduce_factor,
+                                             downsampling_method=downsampling_method)
+      dy.renew_cg()
+      self.set_train(False)
+      self.start_sent(self.src_data[0])
+      inputs = ExpressionSequence(expr_list=[dy.inputVector(np.random.uniform(-1, 1, (8,))) for _ in range(seq_len)])
+      encodings = pyramidal(inputs)
+      expected = self.list_based_pyramidal(pyramidal, inputs, reduce_factor)
+      self.assertEqual(len(encodings), len(expected))
+      for enc, exp in zip(encodings, expected):
+        np.testing.assert_array_almost_equal(enc.npvalue(), exp)
+
 if __name__ == '__main__':
   unittest.main()
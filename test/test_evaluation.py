@@ -29,5 +29,13 @@ class TestBLEU(unittest.TestCase):
     act_bleu = bleu.evaluate(self.ref_id, self.hyp_id)
     self.assertEqual(act_bleu, exp_bleu)
 
+  @unittest.skipUnless(has_cython(), "requires cython to run")
+  def test_bleu_4gram_fast_batch(self):
+    bleu = evaluator.FastBLEUEvaluator(ngram=4, smooth=1)
+    hyps = [self.hyp_id, self.ref_id, self.hyp_id[1:]]
+    refs = [self.ref_id] * len(hyps)
+    act_bleu = bleu.evaluate_batch(refs, hyps)
+    self.assertEqual(list(act_bleu), [bleu.evaluate(ref, hyp) for ref, hyp in zip(refs, hyps)])
+
 if __name__ == '__main__':
   unittest.main()
@@ -6,17 +6,19 @@ import numpy as np
 from xnmt.attender import MlpAttender, DotAttender
 from xnmt.batcher import mark_as_batch, Mask, SrcBatcher
 from xnmt.bridge import CopyBridge
-from xnmt.decoder import MlpSoftmaxDecoder
+from xnmt.decoder import Decoder, MlpSoftmaxDecoder
 from xnmt.embedder import SimpleWordEmbedder
 from xnmt.eval_task import LossEvalTask
+from xnmt.evaluator import Evaluator
 import xnmt.events
 from xnmt.input_reader import PlainTextReader
 from xnmt.lstm import UniLSTMSeqTransducer, BiLSTMSeqTransducer
-from xnmt.loss_calculator import MLELoss
+from xnmt.loss_calculator import MLELoss, SampledMLELoss, ReinforceLoss
 from xnmt.mlp import MLP
 from xnmt.optimizer import AdamTrainer
 from xnmt.param_collection import ParamManager
 from xnmt.pyramidal import PyramidalLSTMSeqTransducer
+from xnmt.search_strategy import GreedySearch, SearchOutput
 import xnmt.training_regimen
 from xnmt.translator import DefaultTranslator
 from xnmt.vocab import Vocab
@@ -287,6 +289,101 @@ class TestBatchTraining(unittest.TestCase):
     model.set_train(False)
     self.assert_single_loss_equals_batch_loss(model)
 
+  def build_small_model(self, label_smoothing=0.0):
+    layer_dim = 32
+    return DefaultTranslator(
+      src_reader=self.src_reader,
+      trg_reader=self.trg_reader,
+      src_embedder=SimpleWordEmbedder(emb_dim=layer_dim, vocab_size=100),
+      encoder=BiLSTMSeqTransducer(input_dim=layer_dim, hidden_dim=layer_dim),
+      attender=MlpAttender(input_dim=layer_dim, state_dim=layer_dim, hidden_dim=layer_dim),
+      trg_embedder=SimpleWordEmbedder(emb_dim=layer_dim, vocab_size=100),
+      decoder=MlpSoftmaxDecoder(input_dim=layer_dim,
+                                trg_embed_dim=layer_dim,
+                                rnn_layer=UniLSTMSeqTransducer(input_dim=layer_dim,
+                                                               hidden_dim=layer_dim,
+                                                               decoder_input_dim=layer_dim,
+                                                               yaml_path="model.decoder.rnn_layer"),
+                                mlp_layer=MLP(input_dim=layer_dim,
+                                              hidden_dim=layer_dim,
+                                              decoder_rnn_dim=layer_dim,
+                                              vocab_size=100,
+                                              yaml_path="model.decoder.rnn_layer"),
+                                label_smoothing=label_smoothing,
+                                bridge=CopyBridge(dec_dim=layer_dim, dec_layers=1)),
+    )
+
+  def test_loss_sequence_matches_stepwise(self):
+    model = self.build_small_model(label_smoothing=0.1)
+    model.set_train(False)
+    src, trg = SrcBatcher(batch_size=5, break_ties_randomly=False).pack(self.src_data[:5], self.trg_data[:5])
+    dy.renew_cg()
+    fused_loss = model.calc_loss(src=src[0], trg=trg[0], loss_calculator=MLELoss()).value()
+    # fall back to the generic per-timestep implementation
+    model.decoder.calc_loss_sequence = lambda *args: Decoder.calc_loss_sequence(model.decoder, *args)
+    dy.renew_cg()
+    stepwise_loss = model.calc_loss(src=src[0], trg=trg[0], loss_calculator=MLELoss()).value()
+    np.testing.assert_allclose(fused_loss, stepwise_loss, rtol=1e-5)
+
+  def test_label_smoothed_loss_matches_log_softmax(self):
+    decoder = self.build_small_model(label_smoothing=0.1).decoder
+    dy.renew_cg()
+    scores_val = np.random.uniform(-2.0, 2.0, size=(100, 3))
+    ref_ids = [3, 17, 99]
+    scores = dy.inputTensor(scores_val, batched=True)
+    fused_loss = decoder.calc_loss_from_scores(scores, mark_as_batch(ref_ids)).npvalue()
+    log_prob = scores_val - np.log(np.sum(np.exp(scores_val), axis=0))
+    expected_loss = -0.9 * log_prob[ref_ids, range(3)] - 0.1 * np.mean(log_prob, axis=0)
+    np.testing.assert_allclose(fused_loss.flatten(), expected_loss, rtol=1e-5)
+
+  def test_sampled_loss_over_full_vocab_is_exact(self):
+    model = self.build_small_model()
+    model.set_train(False)
+    src, trg = SrcBatcher(batch_size=5, break_ties_randomly=False).pack(self.src_data[:5], self.trg_data[:5])
+    dy.renew_cg()
+    exact_loss = model.calc_loss(src=src[0], trg=trg[0], loss_calculator=MLELoss()).value()
+    dy.renew_cg()
+    model.decoder.calc_loss_sequence = lambda dec_states, ref_actions, trg_mask=None: \
+      model.decoder.calc_sampled_loss_sequence(dec_states, ref_actions, np.arange(100), trg_mask=trg_mask)
+    sampled_loss = model.calc_loss(src=src[0], trg=trg[0], loss_calculator=MLELoss()).value()
+    np.testing.assert_allclose(exact_loss, sampled_loss, rtol=1e-5)
+
+  def test_sampled_loss_training(self):
+    src, trg = SrcBatcher(batch_size=5, break_ties_randomly=False).pack(self.src_data[:5], self.trg_data[:5])
+    ref_counts = np.bincount(np.concatenate([sent.words for sent in self.trg_data[:5]]), minlength=100)
+    for proposal in ["unigram", "uniform"]:
+      model = self.build_small_model()
+      loss_calculator = SampledMLELoss(num_samples=10, proposal=proposal)
+      calls = []
+      calc_sampled_loss_sequence = model.decoder.calc_sampled_loss_sequence
+      def record_call(dec_states, ref_actions, candidates, candidate_bias=None, trg_mask=None):
+        calls.append((ref_actions, candidates, candidate_bias))
+        return calc_sampled_loss_sequence(dec_states, ref_actions, candidates, candidate_bias=candidate_bias,
+                                          trg_mask=trg_mask)
+      model.decoder.calc_sampled_loss_sequence = record_call
+      model.set_train(True)
+      self.assertTrue(loss_calculator.train)
+      for num_batches in [1, 2]:
+        dy.renew_cg()
+        model.calc_loss(src=src[0], trg=trg[0], loss_calculator=loss_calculator).value()
+        ref_actions, candidates, candidate_bias = calls[-1]
+        self.assertTrue(np.all(np.isin(ref_actions, candidates)))
+        self.assertLessEqual(len(candidates), len(np.unique(ref_actions)) + 10)
+        if proposal == "unigram":
+          # padded positions do not count, and counts accumulate over minibatches
+          np.testing.assert_array_equal(loss_calculator.unigram_counts, 1 + num_batches * ref_counts)
+          proposal_probs = np.power(loss_calculator.unigram_counts, 0.75)
+          proposal_probs /= proposal_probs.sum()
+          np.testing.assert_allclose(candidate_bias, -np.log(proposal_probs[candidates]))
+        else:
+          self.assertIsNone(candidate_bias)
+      # outside of training, the exact loss is computed
+      model.set_train(False)
+      self.assertFalse(loss_calculator.train)
+      dy.renew_cg()
+      model.calc_loss(src=src[0], trg=trg[0], loss_calculator=loss_calculator).value()
+      self.assertEqual(len(calls), 2)
+
 
 class TestTrainDevLoss(unittest.TestCase):
 
@@ -382,5 +479,107 @@ class TestOverfitting(unittest.TestCase):
                            training_regimen.train_loss_tracker.epoch_loss.sum() / training_regimen.train_loss_tracker.epoch_words,
                            places=2)
 
+class LengthEvaluator(Evaluator):
+  """
+  Scores each hypothesis by its length, so that rewards are known in advance.
+  """
+  def evaluate_batch(self, refs, hyps):
+    return np.array([len(hyp) for hyp in hyps], dtype=float)
+
+class FixedSearch(object):
+  """
+  Returns the given search outputs instead of searching.
+  """
+  def __init__(self, search_outputs):
+    self.search_outputs = search_outputs
+
+  def generate_output(self, translator, initial_state, src_length=None, forced_trg_ids=None, collect_loss_info=False):
+    return self.search_outputs
+
+class TestReinforceLoss(unittest.TestCase):
+
+  def setUp(self):
+    xnmt.events.clear()
+    ParamManager.init_param_col()
+    layer_dim = 8
+    self.model = DefaultTranslator(
+      src_reader=PlainTextReader(),
+      trg_reader=PlainTextReader(),
+      src_embedder=SimpleWordEmbedder(emb_dim=layer_dim, vocab_size=100),
+      encoder=BiLSTMSeqTransducer(input_dim=layer_dim, hidden_dim=layer_dim),
+      attender=MlpAttender(input_dim=layer_dim, state_dim=layer_dim, hidden_dim=layer_dim),
+      trg_embedder=SimpleWordEmbedder(emb_dim=layer_dim, vocab_size=100),
+      decoder=MlpSoftmaxDecoder(input_dim=layer_dim,
+                                trg_embed_dim=layer_dim,
+                                rnn_layer=UniLSTMSeqTransducer(input_dim=layer_dim,
+                                                               hidden_dim=layer_dim,
+                                                               decoder_input_dim=layer_dim,
+                                                               yaml_path="model.decoder.rnn_layer"),
+                                mlp_layer=MLP(input_dim=layer_dim,
+                                              hidden_dim=layer_dim,
+                                              decoder_rnn_dim=layer_dim,
+                                              vocab_size=100,
+                                              yaml_path="model.decoder.rnn_layer"),
+                                bridge=CopyBridge(dec_dim=layer_dim, dec_layers=1)),
+    )
+    self.model.set_train(False)
+    self.src_data = list(self.model.src_reader.read_sents("examples/data/head.ja"))
+    self.trg_data = list(self.model.trg_reader.read_sents("examples/data/head.en"))
+    # two samples for a batch of two sentences; the log probabilities after the first EOS are nonzero and must be
+    # masked out. Rewards (sample lengths without EOS) are [1, 3] for the first and [2, 0] for the second sample.
+    self.word_ids = [np.array([[5, Vocab.ES, Vocab.ES], [5, 6, 7]]),
+                     np.array([[5, 6, Vocab.ES], [Vocab.ES, Vocab.ES, Vocab.ES]])]
+    self.masks = [np.array([[1, 1], [1, 1], [0, 1]], dtype=float),
+                  np.array([[1, 1], [1, 0], [1, 0]], dtype=float)]
+    self.rewards = [np.array([1.0, 3.0]), np.array([2.0, 0.0])]
+    self.logprobs = [np.array([[-0.1, -0.2], [-0.3, -0.4], [-0.5, -0.6]]),
+                     np.array([[-0.7, -0.8], [-0.9, -1.0], [-1.1, -1.2]])]
+    self.states = [np.random.uniform(-1, 1, (3, layer_dim, 2)) for _ in range(2)]
+
+  def calc_loss(self, loss_calculator):
+    src = mark_as_batch([self.src_data[0], self.src_data[0]])
+    trg = mark_as_batch(self.trg_data[:2])
+    dy.renew_cg()
+    self.model.search_strategy = FixedSearch(
+      [SearchOutput(word_ids, None, None, [dy.inputTensor(logprob[t:t+1], batched=True) for t in range(3)],
+                    [dy.inputTensor(state[t], batched=True) for t in range(3)], list(mask))
+       for word_ids, logprob, state, mask in zip(self.word_ids, self.logprobs, self.states, self.masks)])
+    self.model.start_sent(src)
+    encodings, enc_final_states = self.model._encode_src(src)
+    initial_state = self.model._initial_state(src, encodings, enc_final_states)
+    return loss_calculator(self.model, initial_state, src, trg), initial_state
+
+  def test_multiple_samples(self):
+    loss_calculator = ReinforceLoss(evaluation_metric=LengthEvaluator(), inv_eval=False, decoder_hidden_dim=8)
+    loss, _ = self.calc_loss(loss_calculator)
+    expected = sum(np.sum(logprob * mask, axis=0) * reward
+                   for logprob, mask, reward in zip(self.logprobs, self.masks, self.rewards)) / 2
+    np.testing.assert_allclose(loss["reinforce"].npvalue().flatten(), expected, rtol=1e-5)
+
+  def test_self_critical(self):
+    loss_calculator = ReinforceLoss(evaluation_metric=LengthEvaluator(), inv_eval=False, self_critical=True,
+                                    sample_length=5, decoder_hidden_dim=8)
+    loss, initial_state = self.calc_loss(loss_calculator)
+    greedy_output = GreedySearch(max_len=5).generate_output(self.model, initial_state)
+    _, greedy_lengths = loss_calculator.stack_samples(greedy_output, 2)
+    expected = sum(np.sum(logprob * mask, axis=0) * (reward - greedy_lengths[0])
+                   for logprob, mask, reward in zip(self.logprobs, self.masks, self.rewards)) / 2
+    np.testing.assert_allclose(loss["reinforce"].npvalue().flatten(), expected, rtol=1e-5)
+
+  def test_learned_baseline(self):
+    loss_calculator = ReinforceLoss(evaluation_metric=LengthEvaluator(), inv_eval=False, use_baseline=True,
+                                    decoder_hidden_dim=8)
+    loss, _ = self.calc_loss(loss_calculator)
+    W = loss_calculator.baseline.W1.as_array()
+    b = loss_calculator.baseline.b1.as_array()
+    expected_reinforce, expected_baseline = 0.0, 0.0
+    for logprob, mask, reward, state in zip(self.logprobs, self.masks, self.rewards, self.states):
+      baseline = np.einsum("h,thb->tb", W[0], state) + b[0]
+      advantage = mask * reward - mask * baseline
+      expected_reinforce += np.sum(logprob * advantage, axis=0) / 2
+      expected_baseline += np.sum(advantage ** 2, axis=0) / 2
+    np.testing.assert_allclose(loss["reinforce"].npvalue().flatten(), expected_reinforce, rtol=1e-4)
+    np.testing.assert_allclose(loss["reinf_baseline"].npvalue().flatten(), expected_baseline, rtol=1e-4)
+
 if __name__ == '__main__':
   unittest.main()
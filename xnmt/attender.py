@@ -72,10 +72,14 @@ class MlpAttender(Attender, Serializable):
   def init_sent(self, sent):
     self.attention_vecs = []
     self.curr_sent = sent
-    I = self.curr_sent.as_tensor()
+    # encoder tensor, keys and parameters are created once per source and reused for every query. Queries may be
+    # batched over several hypotheses of a single source, in which case keys and values are broadcast over the batch.
+    self.I = self.curr_sent.as_tensor()
     W = dy.parameter(self.pW)
     b = dy.parameter(self.pb)
-    self.WI = dy.affine_transform([b, W, I])
+    self.V = dy.parameter(self.pV)
+    self.U = dy.parameter(self.pU)
+    self.WI = dy.affine_transform([b, W, self.I])
     wi_dim = self.WI.dim()
     # TODO(philip30): dynet affine transform bug, should be fixed upstream
     # if the input size is "1" then the last dimension will be dropped.
@@ -83,11 +87,8 @@ class MlpAttender(Attender, Serializable):
       self.WI = dy.reshape(self.WI, (wi_dim[0][0], 1), batch_size=wi_dim[1])
 
   def calc_attention(self, state):
-    V = dy.parameter(self.pV)
-    U = dy.parameter(self.pU)
-
-    h = dy.tanh(dy.colwise_add(self.WI, V * state))
-    scores = dy.transpose(U * h)
+    h = dy.tanh(dy.colwise_add(self.WI, self.V * state))
+    scores = dy.transpose(self.U * h)
     if self.curr_sent.mask is not None:
       scores = self.curr_sent.mask.add_to_tensor_expr(scores, multiplicator = -100.0)
     normalized = dy.softmax(scores)
@@ -96,8 +97,7 @@ class MlpAttender(Attender, Serializable):
 
   def calc_context(self, state):
     attention = self.calc_attention(state)
-    I = self.curr_sent.as_tensor()
-    return I * attention
+    return self.I * attention
 
 class DotAttender(Attender, Serializable):
   '''
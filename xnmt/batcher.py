@@ -2,6 +2,7 @@ import math
 import random
 import numpy as np
 import dynet as dy
+import xnmt.input
 from xnmt.vocab import Vocab
 from xnmt.persistence import serializable_init, Serializable
 
@@ -27,12 +28,36 @@ class Mask(object):
 
   Masks are represented as numpy array of dimensions batchsize x seq_len, with parts
   belonging to the sequence set to 0, and parts that should be masked set to 1
+
+  Mask expressions are cached per computation graph, so that repeated calls with the same arguments
+  (e.g. once per attention step or per LSTM layer) do not create new input nodes.
   
   Args:
     np_arr: numpy array
   """
   def __init__(self, np_arr):
     self.np_arr = np_arr
+    self._num_masked = None
+    self._expr_cache = {}
+    self._expr_cache_cg_version = None
+
+  def _get_cached_expr(self, key, create_expr):
+    cg_version = dy.cg_version()
+    if cg_version != self._expr_cache_cg_version:
+      self._expr_cache = {}
+      self._expr_cache_cg_version = cg_version
+    if key not in self._expr_cache:
+      self._expr_cache[key] = create_expr()
+    return self._expr_cache[key]
+
+  def num_masked(self):
+    """
+    Returns:
+      numpy array of length seq_len with the number of masked batch entries at each timestep
+    """
+    if self._num_masked is None:
+      self._num_masked = np.count_nonzero(self.np_arr, axis=0)
+    return self._num_masked
 
   def __len__(self):
     return self.np_arr.shape[1]
@@ -44,24 +69,26 @@ class Mask(object):
     return Mask(self.np_arr[:,::-1])
 
   def add_to_tensor_expr(self, tensor_expr, multiplicator=None):
-    # TODO: might cache these expressions to save memory
-    if np.count_nonzero(self.np_arr) == 0:
+    if not self.num_masked().any():
       return tensor_expr
     else:
-      if multiplicator is not None:
-        mask_expr = dy.inputTensor(np.expand_dims(self.np_arr.transpose(), axis=1) * multiplicator, batched=True)
-      else:
-        mask_expr = dy.inputTensor(np.expand_dims(self.np_arr.transpose(), axis=1), batched=True)
-      return tensor_expr + mask_expr
+      def create_expr():
+        if multiplicator is not None:
+          return dy.inputTensor(np.expand_dims(self.np_arr.transpose(), axis=1) * multiplicator, batched=True)
+        else:
+          return dy.inputTensor(np.expand_dims(self.np_arr.transpose(), axis=1), batched=True)
+      return tensor_expr + self._get_cached_expr((None, False, multiplicator), create_expr)
 
   def lin_subsampled(self, reduce_factor=None, trg_len=None):
     if reduce_factor:
-      return Mask(np.array([[self.np_arr[b,int(i*reduce_factor)] for i in range(int(math.ceil(len(self)/float(reduce_factor))))] for b in range(self.batch_size())]))
+      if reduce_factor == int(reduce_factor):
+        return Mask(self.np_arr[:,::int(reduce_factor)])
+      indices = (np.arange(int(math.ceil(len(self)/float(reduce_factor)))) * reduce_factor).astype(int)
     else:
-      return Mask(np.array([[self.np_arr[b,int(i*len(self)/float(trg_len))] for i in range(trg_len)] for b in range(self.batch_size())]))
+      indices = (np.arange(trg_len) * len(self) / float(trg_len)).astype(int)
+    return Mask(self.np_arr[:,indices])
 
   def cmult_by_timestep_expr(self, expr, timestep, inverse=False):
-    # TODO: might cache these expressions to save memory
     """
     Args:
       expr: a dynet expression corresponding to one timestep
@@ -69,14 +96,14 @@ class Mask(object):
       inverse: True will keep the unmasked parts, False will zero out the unmasked parts
     """
     if inverse:
-      if np.count_nonzero(self.np_arr[:,timestep:timestep+1]) == 0:
+      if self.num_masked()[timestep] == 0:
         return expr
-      mask_exp = dy.inputTensor((1.0 - self.np_arr)[:,timestep:timestep+1].transpose(), batched=True)
+      create_expr = lambda: dy.inputTensor((1.0 - self.np_arr)[:,timestep:timestep+1].transpose(), batched=True)
     else:
-      if np.count_nonzero(self.np_arr[:,timestep:timestep+1]) == self.np_arr[:,timestep:timestep+1].size:
+      if self.num_masked()[timestep] == self.batch_size():
         return expr
-      mask_exp = dy.inputTensor(self.np_arr[:,timestep:timestep+1].transpose(), batched=True)
-    return dy.cmult(expr, mask_exp)
+      create_expr = lambda: dy.inputTensor(self.np_arr[:,timestep:timestep+1].transpose(), batched=True)
+    return dy.cmult(expr, self._get_cached_expr((timestep, inverse, None), create_expr))
 
   def get_active_one_mask(self):
     return 1 - self.np_arr
@@ -239,17 +266,17 @@ def pad(batch, pad_token=Vocab.ES, pad_src_to_multiple=1):
   Returns:
     Tuple: list of padded items and a corresponding batched mask.
   """
-  max_len = max(len_or_zero(item) for item in batch)
+  lens = np.array([len_or_zero(item) for item in batch])
+  max_len = lens.max()
   if max_len % pad_src_to_multiple != 0:
     max_len += pad_src_to_multiple - (max_len % pad_src_to_multiple)
-  min_len = min(len_or_zero(item) for item in batch)
-  if min_len == max_len:
+  if lens.min() == max_len:
     return batch, None
-  masks = np.zeros([len(batch), max_len])
-  for i, v in enumerate(batch):
-    for j in range(len_or_zero(v), max_len):
-      masks[i,j] = 1.0
-  padded_items = [item.get_padded_sent(pad_token, max_len - len(item)) for item in batch]
+  masks = (np.arange(max_len)[np.newaxis,:] >= lens[:,np.newaxis]).astype(float)
+  if all(isinstance(item, xnmt.input.ArrayInput) for item in batch):
+    padded_items = xnmt.input.ArrayInput.get_padded_batch(batch, pad_token, max_len)
+  else:
+    padded_items = [item.get_padded_sent(pad_token, max_len - len(item)) for item in batch]
   return padded_items, Mask(masks)
 
 def len_or_zero(val):
@@ -1,81 +1,58 @@
 #include "functions.h"
 #include <iostream>
 #include <unordered_map>
-#include <deque>
 #include <vector>
 #include <math.h>
 
 using std::vector;
 using std::unordered_map;
-using std::deque;
 
 namespace xnmt {
 
 typedef std::vector<std::unordered_map<size_t, int>> NGramStats;
 
 // https://stackoverflow.com/questions/20511347/a-good-hash-function-for-a-vector
-size_t deque_hash (const deque<int>& vec) {
-  std::size_t seed = vec.size();
-  for(int i : vec) {
-    seed ^= i + 0x9e3779b9 + (seed << 6) + (seed >> 2);
+size_t ngram_hash (const int* words, size_t n) {
+  std::size_t seed = n;
+  for (size_t i=0; i < n; ++i) {
+    seed ^= words[i] + 0x9e3779b9 + (seed << 6) + (seed >> 2);
   }
   return seed;
 }
 
-NGramStats calculate_stats(const vector<int>& sents, unsigned int ngram) {
-  NGramStats stat;
+NGramStats calculate_stats(const int* words, size_t len, unsigned int ngram) {
+  NGramStats stat(ngram);
   for (size_t i=0; i < ngram; ++i) {
-    deque<int> buffer;
-    unordered_map<size_t, int> current_map; 
-    for (size_t j=0; j < sents.size(); ++j) {
-      int word = sents[j];
-      buffer.push_back(word);
-      size_t size = buffer.size();
-      if (size == i+1) {
-        size_t hash = deque_hash(buffer);
-        auto it = current_map.find(hash);
-        if (it == current_map.end()) {
-          current_map.insert(std::make_pair(hash, 1));
-        } else {
-          ++(it->second);
-        }
-        buffer.pop_front();
-      } 
+    unordered_map<size_t, int>& current_map = stat[i];
+    if (len > i) {
+      current_map.reserve(len - i);
+    }
+    for (size_t j=0; j + i < len; ++j) {
+      ++current_map[ngram_hash(words + j, i + 1)];
     }
-    stat.push_back(current_map);
   }
   return stat;
 }
 
-double evaluate_bleu_sentence(const vector<int>& ref, const vector<int>& hyp,
-                              int ngram, int smooth) {
-  NGramStats ref_stat = calculate_stats(ref, ngram);
-  NGramStats hyp_stat = calculate_stats(hyp, ngram);
+double bleu_from_stats(const NGramStats& ref_stat, size_t len_ref, const NGramStats& hyp_stat, size_t len_hyp,
+                       int ngram, int smooth) {
   double log_precision = 0;
   double log_bp = 0;
   for (int i=0; i < ngram; ++i) {
-    auto ref_stat_i = ref_stat[i];
-    auto hyp_stat_i = hyp_stat[i];
+    const unordered_map<size_t, int>& ref_stat_i = ref_stat[i];
     int tp = 0;
-    int denom = 0;
-    for (auto ref_it=ref_stat_i.begin(); ref_it != ref_stat_i.end(); ++ref_it) {
-      int ref_count = ref_it->second;
-      int hyp_count = 0;
-      auto hyp_it = hyp_stat_i.find(ref_it->first);
-      if (hyp_it != hyp_stat_i.end()) {
-        hyp_count = hyp_it->second;
+    for (auto hyp_it=hyp_stat[i].begin(); hyp_it != hyp_stat[i].end(); ++hyp_it) {
+      auto ref_it = ref_stat_i.find(hyp_it->first);
+      if (ref_it != ref_stat_i.end()) {
+        tp += std::min(ref_it->second, hyp_it->second);
       }
-      tp += std::min(ref_count, hyp_count);
-    }
-    for (auto hyp_it=hyp_stat_i.begin(); hyp_it != hyp_stat_i.end(); ++hyp_it) {
-      denom += hyp_it->second;
     }
+    // every hypothesis position starts one n-gram of each order that fits
+    int denom = len_hyp > static_cast<size_t>(i) ? len_hyp - i : 0;
     int s = i == 0 ? 0 : smooth;
     double lp = log((static_cast<double>(tp + s)) / (denom + s));
     log_precision += lp;
   }
-  int len_hyp = hyp.size();
-  int len_ref = ref.size();
   if (len_ref != 0 and len_hyp < len_ref) {
     log_bp = 1 - (static_cast<double>(len_ref) / len_hyp);
   } else {
@@ -84,4 +61,28 @@ double evaluate_bleu_sentence(const vector<int>& ref, const vector<int>& hyp,
   return exp(log_precision / ngram + log_bp);
 }
 
+double evaluate_bleu_sentence(const vector<int>& ref, const vector<int>& hyp,
+                              int ngram, int smooth) {
+  NGramStats ref_stat = calculate_stats(ref.data(), ref.size(), ngram);
+  NGramStats hyp_stat = calculate_stats(hyp.data(), hyp.size(), ngram);
+  return bleu_from_stats(ref_stat, ref.size(), hyp_stat, hyp.size(), ngram, smooth);
+}
+
+void evaluate_bleu_batch(const int* ref_words, const int* ref_offsets, int num_refs,
+                         const int* hyp_words, const int* hyp_offsets, const int* hyp_ref_ids, int num_hyps,
+                         int ngram, int smooth, double* scores) {
+  // the statistics of each reference are computed once and shared by all hypotheses compared against it
+  vector<NGramStats> ref_stats;
+  ref_stats.reserve(num_refs);
+  for (int r=0; r < num_refs; ++r) {
+    ref_stats.push_back(calculate_stats(ref_words + ref_offsets[r], ref_offsets[r+1] - ref_offsets[r], ngram));
+  }
+  for (int h=0; h < num_hyps; ++h) {
+    int r = hyp_ref_ids[h];
+    size_t len_hyp = hyp_offsets[h+1] - hyp_offsets[h];
+    NGramStats hyp_stat = calculate_stats(hyp_words + hyp_offsets[h], len_hyp, ngram);
+    scores[h] = bleu_from_stats(ref_stats[r], ref_offsets[r+1] - ref_offsets[r], hyp_stat, len_hyp, ngram, smooth);
+  }
+}
+
 }  // namespace xnmt
@@ -8,4 +8,10 @@ namespace xnmt {
 double evaluate_bleu_sentence(const std::vector<int>& ref, const std::vector<int>& hyp,
                               int ngram=4, int smooth=1);
 
+// Sentence-level BLEU of many hypotheses. Sentences are given as flat arrays of word ids, where sentence i spans
+// words[offsets[i]:offsets[i+1]]; hypothesis h is compared against reference hyp_ref_ids[h].
+void evaluate_bleu_batch(const int* ref_words, const int* ref_offsets, int num_refs,
+                         const int* hyp_words, const int* hyp_offsets, const int* hyp_ref_ids, int num_hyps,
+                         int ngram, int smooth, double* scores);
+
 }
@@ -1,7 +1,76 @@
+import itertools
+
+import numpy as np
+
 from libcpp.vector cimport vector
 
 cdef extern from "src/functions.h" namespace "xnmt":
   double evaluate_bleu_sentence(vector[int] ref, vector[int] hyp, int ngram, int smooth)
+  void evaluate_bleu_batch(const int* ref_words, const int* ref_offsets, int num_refs,
+                           const int* hyp_words, const int* hyp_offsets, const int* hyp_ref_ids, int num_hyps,
+                           int ngram, int smooth, double* scores)
 
 def bleu_sentence(int ngram, int smooth, list ref, list hyp):
   return evaluate_bleu_sentence(ref, hyp, ngram, smooth)
+
+def flatten_sents(sents):
+  """
+  Args:
+    sents: list of sentences (lists of word ids), or tuple of flat array of word ids and array of sentence offsets
+  Returns:
+    Tuple of flat int32 array of word ids and int32 array of offsets, where sentence i spans
+    ``words[offsets[i]:offsets[i+1]]``
+  """
+  if isinstance(sents, tuple):
+    words, offsets = sents
+    return np.ascontiguousarray(words, dtype=np.int32), np.ascontiguousarray(offsets, dtype=np.int32)
+  offsets = np.zeros((len(sents) + 1,), dtype=np.int32)
+  np.cumsum([len(sent) for sent in sents], out=offsets[1:])
+  words = np.fromiter(itertools.chain.from_iterable(sents), dtype=np.int32, count=offsets[-1])
+  return words, offsets
+
+def bleu_sentences(int ngram, int smooth, refs, hyps, hyp_ref_ids=None):
+  """
+  Compute sentence-level BLEU for many hypotheses at once.
+
+  The n-gram statistics of each reference are computed only once, no matter how many hypotheses are compared against
+  it.
+
+  Args:
+    ngram: consider ngrams up to this order
+    smooth: smoothing constant for higher-order precisions
+    refs: list of reference sentences (lists of word ids), or tuple of flat array of word ids and array of offsets
+    hyps: list of hypothesis sentences, in the same format as ``refs``
+    hyp_ref_ids: index of the reference to compare each hypothesis against; if None, hypotheses and references are
+                 paired one to one
+  Returns:
+    numpy array of BLEU scores, one per hypothesis
+  """
+  ref_words, ref_offsets = flatten_sents(refs)
+  hyp_words, hyp_offsets = flatten_sents(hyps)
+  cdef int num_refs = len(ref_offsets) - 1
+  cdef int num_hyps = len(hyp_offsets) - 1
+  if hyp_ref_ids is None:
+    if num_refs != num_hyps:
+      raise ValueError(f"expected one reference per hypothesis, got {num_refs} references for {num_hyps} hypotheses")
+    hyp_ref_ids = np.arange(num_hyps, dtype=np.int32)
+  else:
+    hyp_ref_ids = np.ascontiguousarray(hyp_ref_ids, dtype=np.int32)
+    if len(hyp_ref_ids) != num_hyps:
+      raise ValueError(f"expected one reference id per hypothesis, got {len(hyp_ref_ids)} for {num_hyps} hypotheses")
+    if num_hyps > 0 and (hyp_ref_ids.min() < 0 or hyp_ref_ids.max() >= num_refs):
+      raise ValueError(f"reference ids must be between 0 and {num_refs-1}")
+  scores = np.zeros((num_hyps,), dtype=np.float64)
+  if num_hyps == 0:
+    return scores
+  # pad the word arrays so that their data pointers are valid even if all sentences are empty
+  cdef const int[::1] ref_words_view = np.append(ref_words, np.int32(0))
+  cdef const int[::1] ref_offsets_view = ref_offsets
+  cdef const int[::1] hyp_words_view = np.append(hyp_words, np.int32(0))
+  cdef const int[::1] hyp_offsets_view = hyp_offsets
+  cdef const int[::1] hyp_ref_ids_view = hyp_ref_ids
+  cdef double[::1] scores_view = scores
+  evaluate_bleu_batch(&ref_words_view[0], &ref_offsets_view[0], num_refs,
+                      &hyp_words_view[0], &hyp_offsets_view[0], &hyp_ref_ids_view[0], num_hyps,
+                      ngram, smooth, &scores_view[0])
+  return scores
@@ -1,10 +1,12 @@
 import dynet as dy
 import numpy as np
+import scipy.sparse
 import functools
 
 import xnmt.batcher
 import xnmt.linear
 import xnmt.residual
+import xnmt.softmax
 from xnmt.param_init import GlorotInitializer, ZeroInitializer
 from xnmt import logger
 from xnmt.bridge import CopyBridge
@@ -27,6 +29,81 @@ class Decoder(object):
   def calc_loss(self, x, ref_action):
     raise NotImplementedError('calc_loss must be implemented in Decoder subclasses')
 
+  def calc_loss_sequence(self, dec_states, ref_actions, trg_mask=None):
+    """
+    Calculate the loss of a whole target sequence, given the decoder states for all timesteps.
+
+    By default this sums up the output of :meth:`calc_loss` for each timestep, which assumes that the loss only
+    depends on the given decoder state. Subclasses may override it to compute the loss more efficiently.
+
+    Args:
+      dec_states: list of decoder states, one per timestep
+      ref_actions: numpy array of reference word ids, of dimensions batch_size x seq_len
+      trg_mask (xnmt.batcher.Mask): mask for padded target positions, or None
+    Returns:
+      batched loss expression, summed over timesteps
+    """
+    losses = []
+    for i, dec_state in enumerate(dec_states):
+      word_loss = self.calc_loss(dec_state, xnmt.batcher.mark_as_batch(ref_actions[:,i].tolist()))
+      if trg_mask is not None:
+        word_loss = trg_mask.cmult_by_timestep_expr(word_loss, i, inverse=True)
+      losses.append(word_loss)
+    return dy.esum(losses)
+
+  def calc_sampled_loss_sequence(self, dec_states, ref_actions, candidates, candidate_bias=None, trg_mask=None):
+    raise NotImplementedError('calc_sampled_loss_sequence is not implemented for %s' % type(self).__name__)
+
+  def tile_state(self, dec_state, num_copies):
+    """
+    Stack several copies of a (batched) decoder state along the batch dimension, e.g. to draw several samples at once.
+
+    Args:
+      dec_state: decoder state of batch size ``batch_size``
+      num_copies (int): number of copies
+    Returns:
+      decoder state of batch size ``num_copies * batch_size``, where batch element ``c * batch_size + b`` is a copy of
+      element ``b``
+    """
+    raise NotImplementedError('tile_state is not implemented for %s' % type(self).__name__)
+
+  def concatenate_states(self, dec_states):
+    """
+    Stack several decoder states along the batch dimension, e.g. to advance several search hypotheses at once.
+
+    Args:
+      dec_states: list of decoder states
+    Returns:
+      decoder state whose batch elements are the batch elements of the given states, in order
+    """
+    raise NotImplementedError('concatenate_states is not implemented for %s' % type(self).__name__)
+
+  def select_batch_elems(self, dec_state, batch_ids):
+    """
+    Args:
+      dec_state: batched decoder state
+      batch_ids: list of batch elements to select; may contain duplicates
+    Returns:
+      decoder state holding only the selected batch elements
+    """
+    raise NotImplementedError('select_batch_elems is not implemented for %s' % type(self).__name__)
+
+  def best_k(self, dec_state, k):
+    """
+    Find the k most probable next words.
+
+    Args:
+      dec_state: current decoder state, possibly batched
+      k (int): number of words to return
+    Returns:
+      Tuple of numpy arrays of word ids and their log probabilities, of dimensions k x batch_size, in no particular
+      order
+    """
+    log_probs = self.get_scores_logsoftmax(dec_state).npvalue()
+    log_probs = log_probs.reshape((log_probs.shape[0], -1))
+    top_words = np.argpartition(log_probs, max(-len(log_probs), -k), axis=0)[-k:]
+    return top_words, np.take_along_axis(log_probs, top_words, axis=0)
+
 class MlpSoftmaxDecoderState(object):
   """A state holding all the information needed for MLPSoftmaxDecoder
   
@@ -53,10 +130,10 @@ class MlpSoftmaxDecoder(Decoder, Serializable):
                              Label Smoothing is implemented with reference to Section 7 of the paper
                              "Rethinking the Inception Architecture for Computer Vision"
                              (https://arxiv.org/pdf/1512.00567.pdf)
-  """
 
-  # TODO: This should probably take a softmax object, which can be normal or class-factored, etc.
-  # For now the default behavior is hard coded.
+  The softmax can be replaced by a class-factored one by using a :class:`xnmt.softmax.ClassFactoredSoftmax` as the
+  ``output_projector`` of ``mlp_layer``.
+  """
 
   yaml_tag = '!MlpSoftmaxDecoder'
 
@@ -126,6 +203,30 @@ class MlpSoftmaxDecoder(Decoder, Serializable):
     return MlpSoftmaxDecoderState(rnn_state=mlp_dec_state.rnn_state.add_input(inp),
                                   context=mlp_dec_state.context)
 
+  def tile_state(self, mlp_dec_state, num_copies):
+    batch_size = mlp_dec_state.rnn_state.output().dim()[1]
+    def tile(expr):
+      # expressions without batch dimension (e.g. the initial context) are broadcast and need not be copied
+      if expr is None or (expr.dim()[1] == 1 and batch_size > 1):
+        return expr
+      return dy.concatenate_to_batch([expr] * num_copies)
+    rnn_state = self.rnn_layer.initial_state().set_s([tile(expr) for expr in mlp_dec_state.rnn_state.s()])
+    return MlpSoftmaxDecoderState(rnn_state=rnn_state, context=tile(mlp_dec_state.context))
+
+  def concatenate_states(self, mlp_dec_states):
+    def concatenate(exprs):
+      return None if exprs[0] is None else dy.concatenate_to_batch(list(exprs))
+    rnn_state = self.rnn_layer.initial_state().set_s(
+      [concatenate(exprs) for exprs in zip(*[mlp_dec_state.rnn_state.s() for mlp_dec_state in mlp_dec_states])])
+    return MlpSoftmaxDecoderState(rnn_state=rnn_state,
+                                  context=concatenate([mlp_dec_state.context for mlp_dec_state in mlp_dec_states]))
+
+  def select_batch_elems(self, mlp_dec_state, batch_ids):
+    def select(expr):
+      return None if expr is None else dy.pick_batch_elems(expr, batch_ids)
+    rnn_state = self.rnn_layer.initial_state().set_s([select(expr) for expr in mlp_dec_state.rnn_state.s()])
+    return MlpSoftmaxDecoderState(rnn_state=rnn_state, context=select(mlp_dec_state.context))
+
   def get_scores(self, mlp_dec_state):
     """Get scores given a current state.
 
@@ -140,8 +241,113 @@ class MlpSoftmaxDecoder(Decoder, Serializable):
     return dy.log_softmax(self.get_scores(mlp_dec_state))
 
   def calc_loss(self, mlp_dec_state, ref_action):
-    scores = self.get_scores(mlp_dec_state)
+    return self.calc_loss_from_input(dy.concatenate([mlp_dec_state.rnn_state.output(), mlp_dec_state.context]),
+                                     ref_action)
+
+  def calc_loss_sequence(self, mlp_dec_states, ref_actions, trg_mask=None):
+    """
+    Calculate the loss of a whole target sequence, computing the output layer and softmax for all timesteps in one go.
 
+    Args:
+      mlp_dec_states: list of :class:`xnmt.decoder.MlpSoftmaxDecoderState` objects, one per timestep
+      ref_actions: numpy array of reference word ids, of dimensions batch_size x seq_len
+      trg_mask (xnmt.batcher.Mask): mask for padded target positions, or None
+    Returns:
+      batched loss expression, summed over timesteps
+    """
+    losses = self.calc_loss_from_input(self.get_sequence_input(mlp_dec_states),
+                                       xnmt.batcher.mark_as_batch(ref_actions.flatten().tolist()))
+    return self.sum_sequence_losses(losses, ref_actions.shape, trg_mask)
+
+  def calc_sampled_loss_sequence(self, mlp_dec_states, ref_actions, candidates, candidate_bias=None, trg_mask=None):
+    """
+    Calculate the loss of a whole target sequence, normalizing only over a subset of the vocabulary.
+
+    This is used to approximate the full softmax during training with large vocabularies; the softmax is computed over
+    the rows of the output projection that correspond to ``candidates``, which must contain all reference words.
+
+    Args:
+      mlp_dec_states: list of :class:`xnmt.decoder.MlpSoftmaxDecoderState` objects, one per timestep
+      ref_actions: numpy array of reference word ids, of dimensions batch_size x seq_len
+      candidates: sorted numpy array of unique word ids to normalize over
+      candidate_bias: numpy array of values to add to the candidate scores (e.g. for importance sampling correction),
+                      or None
+      trg_mask (xnmt.batcher.Mask): mask for padded target positions, or None
+    Returns:
+      batched loss expression, summed over timesteps
+    """
+    output_projector = self.mlp_layer.output_projector
+    if not isinstance(output_projector, xnmt.linear.Linear):
+      raise ValueError("sampled loss requires a Linear output projector, found %s" % type(output_projector).__name__)
+    W = dy.select_rows(dy.parameter(output_projector.W1), candidates)
+    hidden = self.mlp_layer.get_hidden(self.get_sequence_input(mlp_dec_states))
+    if output_projector.bias:
+      b = dy.reshape(dy.select_rows(dy.reshape(dy.parameter(output_projector.b1), (output_projector.output_dim, 1)),
+                                    candidates), (len(candidates),))
+      scores = dy.affine_transform([b, W, hidden])
+    else:
+      scores = W * hidden
+    if candidate_bias is not None:
+      scores = scores + dy.inputTensor(candidate_bias)
+    ref_positions = np.searchsorted(candidates, ref_actions.flatten())
+    losses = self.calc_loss_from_scores(scores, xnmt.batcher.mark_as_batch(ref_positions.tolist()))
+    return self.sum_sequence_losses(losses, ref_actions.shape, trg_mask)
+
+  def get_sequence_input(self, mlp_dec_states):
+    """
+    Args:
+      mlp_dec_states: list of :class:`xnmt.decoder.MlpSoftmaxDecoderState` objects, one per timestep
+    Returns:
+      input to the MLP for all timesteps, with the timesteps moved into the batch dimension; batch element
+      b*seq_len+t corresponds to sentence b, timestep t
+    """
+    hidden = dy.concatenate([dy.concatenate_cols([dec_state.rnn_state.output() for dec_state in mlp_dec_states]),
+                             dy.concatenate_cols([dec_state.context for dec_state in mlp_dec_states])])
+    ((input_dim, seq_len), batch_size) = hidden.dim()
+    return dy.reshape(hidden, (input_dim,), batch_size=batch_size * seq_len)
+
+  def sum_sequence_losses(self, losses, shape, trg_mask=None):
+    """
+    Args:
+      losses: per-timestep losses, batched over sentences and timesteps in the order of :meth:`get_sequence_input`
+      shape: tuple of batch size and sequence length
+      trg_mask (xnmt.batcher.Mask): mask for padded target positions, or None
+    Returns:
+      batched loss expression, summed over unmasked timesteps
+    """
+    batch_size, seq_len = shape
+    if trg_mask is not None and np.count_nonzero(trg_mask.np_arr) > 0:
+      losses = dy.cmult(losses, dy.inputTensor(1.0 - trg_mask.np_arr.flatten(), batched=True))
+    return dy.sum_elems(dy.reshape(losses, (seq_len,), batch_size=batch_size))
+
+  def calc_loss_from_input(self, mlp_input, ref_action):
+    """
+    Args:
+      mlp_input: input to the MLP, possibly batched
+      ref_action: reference word id, or batch of word ids
+    Returns:
+      loss expression
+    """
+    output_projector = self.mlp_layer.output_projector
+    if isinstance(output_projector, xnmt.softmax.ClassFactoredSoftmax) and self.label_smoothing == 0.0:
+      return output_projector.calc_loss(self.mlp_layer.get_hidden(mlp_input), ref_action)
+    return self.calc_loss_from_scores(self.mlp_layer(mlp_input), ref_action)
+
+  def best_k(self, mlp_dec_state, k):
+    output_projector = self.mlp_layer.output_projector
+    if isinstance(output_projector, xnmt.softmax.ClassFactoredSoftmax):
+      return output_projector.best_k(
+        self.mlp_layer.get_hidden(dy.concatenate([mlp_dec_state.rnn_state.output(), mlp_dec_state.context])), k)
+    return super().best_k(mlp_dec_state, k)
+
+  def calc_loss_from_scores(self, scores, ref_action):
+    """
+    Args:
+      scores: unnormalized scores over the vocabulary, possibly batched
+      ref_action: reference word id, or batch of word ids
+    Returns:
+      loss expression
+    """
     if self.label_smoothing == 0.0:
       # single mode
       if not xnmt.batcher.is_batched(ref_action):
@@ -151,17 +357,39 @@ class MlpSoftmaxDecoder(Decoder, Serializable):
         return dy.pickneglogsoftmax_batch(scores, ref_action)
 
     else:
-      log_prob = dy.log_softmax(scores)
+      # As log_prob = scores - logsumexp(scores), both the reference term -log_prob[ref] and the uniform term
+      # -mean(log_prob) can be computed from the scores and a single logsumexp, without materializing the log softmax.
       if not xnmt.batcher.is_batched(ref_action):
-        pre_loss = -dy.pick(log_prob, ref_action)
+        ref_score = dy.pick(scores, ref_action)
       else:
-        pre_loss = -dy.pick_batch(log_prob, ref_action)
-
-      ls_loss = -dy.mean_elems(log_prob)
-      loss = ((1 - self.label_smoothing) * pre_loss) + (self.label_smoothing * ls_loss)
-      return loss
+        ref_score = dy.pick_batch(scores, ref_action)
+      log_z = dy.logsumexp_dim(scores, d=0)
+      return log_z - (1 - self.label_smoothing) * ref_score - self.label_smoothing * dy.mean_elems(scores)
 
 class MlpSoftmaxLexiconDecoder(MlpSoftmaxDecoder, Serializable):
+  """
+  MLP softmax decoder that incorporates lexical translation probabilities, weighted by the attention
+  (Arthur et al., 2016, https://arxiv.org/pdf/1606.02006.pdf).
+
+  Args:
+    input_dim (int): input dimension
+    trg_embed_dim (int): dimension of target embeddings
+    input_feeding (bool): whether to activate input feeding
+    rnn_layer (UniLSTMSeqTransducer): recurrent layer of the decoder
+    mlp_layer (MLP): final prediction layer of the decoder
+    bridge (Bridge): how to initialize decoder state
+    label_smoothing (float): label smoothing value
+    lexicon_file (str): file with one ``trg src prob`` entry per line
+    src_vocab (Vocab): source vocabulary
+    trg_vocab (Vocab): target vocabulary
+    attender (Attender): the model's attender
+    lexicon_type (str): how to combine the lexicon with the model's distribution, ``bias`` or ``linear``
+    lexicon_alpha (float): smoothing constant for the ``bias`` method
+    linear_projector (Linear): computes the interpolation coefficient for the ``linear`` method
+    param_init_lin (ParamInitializer): how to initialize the weight matrix of the linear projector
+    bias_init_lin (ParamInitializer): how to initialize the bias vector of the linear projector
+    lexicon_topk (int): if given, keep only this many most probable translations of each source word
+  """
   yaml_tag = '!MlpSoftmaxLexiconDecoder'
 
   @register_xnmt_handler
@@ -183,6 +411,7 @@ class MlpSoftmaxLexiconDecoder(MlpSoftmaxDecoder, Serializable):
                linear_projector=None,
                param_init_lin=Ref("exp_global.param_init", default=bare(GlorotInitializer)),
                bias_init_lin=Ref("exp_global.bias_init", default=bare(ZeroInitializer)),
+               lexicon_topk=None,
                ):
     super().__init__(input_dim, trg_embed_dim, input_feeding, rnn_layer,
                      mlp_layer, bridge, label_smoothing)
@@ -193,6 +422,7 @@ class MlpSoftmaxLexiconDecoder(MlpSoftmaxDecoder, Serializable):
     self.attender = attender
     self.lexicon_type = lexicon_type
     self.lexicon_alpha = lexicon_alpha
+    self.lexicon_topk = lexicon_topk
 
     self.linear_projector = self.add_serializable_component("linear_projector", linear_projector,
                                                              lambda: xnmt.linear.Linear(input_dim=input_dim,
@@ -206,10 +436,17 @@ class MlpSoftmaxLexiconDecoder(MlpSoftmaxDecoder, Serializable):
       raise ValueError("Unrecognized lexicon method:", lexicon_type, "can only choose between [bias, linear]")
 
   def load_lexicon(self):
+    """
+    Load the lexicon file.
+
+    Returns:
+      scipy.sparse.csr_matrix of translation probabilities, of dimensions src_vocab_size x trg_vocab_size
+    """
     logger.info("Loading lexicon from file: " + self.lexicon_file)
     assert self.src_vocab.frozen
     assert self.trg_vocab.frozen
-    lexicon = [{} for _ in range(len(self.src_vocab))]
+    src_vocab_size, trg_vocab_size = len(self.src_vocab), len(self.trg_vocab)
+    src_ids, trg_ids, probs = [], [], []
     with open(self.lexicon_file, encoding='utf-8') as fp:
       for line in fp:
         try:
@@ -217,22 +454,38 @@ class MlpSoftmaxLexiconDecoder(MlpSoftmaxDecoder, Serializable):
         except:
           logger.warning("Failed to parse 'trg src prob' from:" + line.strip())
           continue
-        trg_id = self.trg_vocab.convert(trg)
-        src_id = self.src_vocab.convert(src)
-        lexicon[src_id][trg_id] = float(prob)
+        trg_ids.append(self.trg_vocab.convert(trg))
+        src_ids.append(self.src_vocab.convert(src))
+        probs.append(float(prob))
+    src_ids, trg_ids, probs = np.array(src_ids, dtype=int), np.array(trg_ids, dtype=int), np.array(probs)
+    # Later entries for the same word pair take precedence
+    _, last_ids = np.unique((src_ids * trg_vocab_size + trg_ids)[::-1], return_index=True)
+    keep = len(src_ids) - 1 - last_ids
+    src_ids, trg_ids, probs = src_ids[keep], trg_ids[keep], probs[keep]
+    # Keeping only the most probable translations of each source word
+    if self.lexicon_topk is not None:
+      order = np.lexsort((-probs, src_ids))
+      src_ids, trg_ids, probs = src_ids[order], trg_ids[order], probs[order]
+      keep = np.arange(len(src_ids)) - np.searchsorted(src_ids, src_ids) < self.lexicon_topk
+      src_ids, trg_ids, probs = src_ids[keep], trg_ids[keep], probs[keep]
     # Setting the rest of the weight to the unknown word
-    for i in range(len(lexicon)):
-      sum_prob = sum(lexicon[i].values())
-      if sum_prob < 1.0:
-        lexicon[i][self.trg_vocab.convert(self.trg_vocab.unk_token)] = 1.0 - sum_prob
+    trg_unk_id = self.trg_vocab.convert(self.trg_vocab.unk_token)
+    sum_probs = np.bincount(src_ids, weights=probs, minlength=src_vocab_size)
+    unk_rows = np.nonzero(sum_probs < 1.0)[0]
+    keep = np.logical_not((sum_probs[src_ids] < 1.0) & (trg_ids == trg_unk_id))
+    src_ids = np.concatenate([src_ids[keep], unk_rows])
+    trg_ids = np.concatenate([trg_ids[keep], np.full(len(unk_rows), trg_unk_id, dtype=int)])
+    probs = np.concatenate([probs[keep], 1.0 - sum_probs[unk_rows]])
     # Overriding special tokens
     src_unk_id = self.src_vocab.convert(self.src_vocab.unk_token)
-    trg_unk_id = self.trg_vocab.convert(self.trg_vocab.unk_token)
-    lexicon[self.src_vocab.SS] = {self.trg_vocab.SS: 1.0}
-    lexicon[self.src_vocab.ES] = {self.trg_vocab.ES: 1.0}
     # TODO(philip30): Note sure if this is intended
-    lexicon[src_unk_id] = {trg_unk_id: 1.0}
-    return lexicon
+    special_src_ids = np.array([self.src_vocab.SS, self.src_vocab.ES, src_unk_id], dtype=int)
+    special_trg_ids = np.array([self.trg_vocab.SS, self.trg_vocab.ES, trg_unk_id], dtype=int)
+    keep = np.logical_not(np.isin(src_ids, special_src_ids))
+    src_ids = np.concatenate([src_ids[keep], special_src_ids])
+    trg_ids = np.concatenate([trg_ids[keep], special_trg_ids])
+    probs = np.concatenate([probs[keep], np.ones(len(special_src_ids))])
+    return scipy.sparse.csr_matrix((probs, (src_ids, trg_ids)), shape=(src_vocab_size, trg_vocab_size))
 
   @handle_xnmt_event
   def on_new_epoch(self, training_task, *args, **kwargs):
@@ -243,18 +496,35 @@ class MlpSoftmaxLexiconDecoder(MlpSoftmaxDecoder, Serializable):
 
   @handle_xnmt_event
   def on_start_sent(self, src):
-    batch_size = len(src)
-    col_size = len(src[0])
-
-    idxs = [(x, j, i) for i in range(batch_size) for j in range(col_size) for x in self.lexicon[src[i][j]].keys()]
-    idxs = tuple(map(list, list(zip(*idxs))))
-
-    values = [x for i in range(batch_size) for j in range(col_size) for x in self.lexicon[src[i][j]].values()]
-    self.lexicon_prob = dy.nobackprop(dy.sparse_inputTensor(idxs, values, (len(self.trg_vocab), col_size, batch_size), batched=True))
-    
-  def get_scores_logsoftmax(self, mlp_dec_state):
+    src_ids = np.stack([np.asarray(sent.words, dtype=int) for sent in src])
+    batch_size, col_size = src_ids.shape
+    # gather the lexicon rows of all source positions; row b*col_size+j of the result belongs to position j of sentence b
+    entries = self.lexicon[src_ids.flatten()].tocoo()
+    idxs = (entries.col.tolist(), (entries.row % col_size).tolist(), (entries.row // col_size).tolist())
+    self.lexicon_prob = dy.nobackprop(dy.sparse_inputTensor(idxs, entries.data.tolist(),
+                                                            (len(self.trg_vocab), col_size, batch_size), batched=True))
+    self.tiled_lexicon_probs = {}
+
+  def get_lexicon_prob(self, batch_size):
+    """
+    Args:
+      batch_size (int): batch size of the current decoder state, a multiple of the number of source sentences
+    Returns:
+      lexicon probabilities of the source words, copied along the batch dimension if the decoder state holds several
+      hypotheses per source sentence (as e.g. in :meth:`tile_state`)
+    """
+    num_copies = batch_size // self.lexicon_prob.dim()[1]
+    if num_copies <= 1:
+      return self.lexicon_prob
+    if num_copies not in self.tiled_lexicon_probs:
+      self.tiled_lexicon_probs[num_copies] = dy.concatenate_to_batch([self.lexicon_prob] * num_copies)
+    return self.tiled_lexicon_probs[num_copies]
+
+  def get_scores_logsoftmax(self, mlp_dec_state, attention=None):
     score = super().get_scores(mlp_dec_state)
-    lex_prob = self.lexicon_prob * self.attender.get_last_attention()
+    if attention is None:
+      attention = self.attender.get_last_attention()
+    lex_prob = self.get_lexicon_prob(attention.dim()[1]) * attention
     # Note that the sum dim is only summing a tensor of 1 size in dim 1.
     # This is to make sure that the shape of the returned tensor matches the vanilla decoder
     return dy.sum_dim(self.lexicon_method(mlp_dec_state, score, lex_prob), [1])
@@ -273,3 +543,20 @@ class MlpSoftmaxLexiconDecoder(MlpSoftmaxDecoder, Serializable):
     else:
       return -dy.pick_batch(logsoft, ref_action)
 
+  def calc_sampled_loss_sequence(self, mlp_dec_states, ref_actions, candidates, candidate_bias=None, trg_mask=None):
+    raise NotImplementedError('calc_sampled_loss_sequence is not implemented for %s' % type(self).__name__)
+
+  def best_k(self, mlp_dec_state, k):
+    return Decoder.best_k(self, mlp_dec_state, k)
+
+  def calc_loss_sequence(self, mlp_dec_states, ref_actions, trg_mask=None):
+    # the lexicon probabilities depend on the attention at each timestep, which is not part of the decoder state
+    attentions = self.attender.attention_vecs[-len(mlp_dec_states):]
+    losses = []
+    for i, (mlp_dec_state, attention) in enumerate(zip(mlp_dec_states, attentions)):
+      word_loss = -dy.pick_batch(self.get_scores_logsoftmax(mlp_dec_state, attention), ref_actions[:,i].tolist())
+      if trg_mask is not None:
+        word_loss = trg_mask.cmult_by_timestep_expr(word_loss, i, inverse=True)
+      losses.append(word_loss)
+    return dy.esum(losses)
+
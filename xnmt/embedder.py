@@ -53,6 +53,25 @@ class Embedder(object):
 
     return ExpressionSequence(expr_list=embeddings, mask=sent.mask if xnmt.batcher.is_batched(sent) else None)
 
+  def sample_word_id_mask(self, batch_size, vocab_size, word_dropout):
+    """Sample word types to drop out, independently for each sentence in the batch.
+
+    Args:
+      batch_size (int): number of sentences
+      vocab_size (int): number of word types
+      word_dropout (float): fraction of word types to drop out
+
+    Returns:
+      numpy.ndarray: boolean array of dimensions batch_size x vocab_size, with dropped word types set to True
+    """
+    num_dropped = int(vocab_size * word_dropout)
+    word_id_mask = np.zeros((batch_size, vocab_size), dtype=bool)
+    if num_dropped > 0:
+      # the num_dropped smallest of vocab_size uniform draws give a sample without replacement
+      dropped_ids = np.argpartition(np.random.random_sample((batch_size, vocab_size)), num_dropped-1, axis=1)[:,:num_dropped]
+      word_id_mask[np.arange(batch_size)[:,np.newaxis], dropped_ids] = True
+    return word_id_mask
+
   def choose_vocab(self, vocab, yaml_path, src_reader, trg_reader):
     """Choose the vocab for the embedder basd on the passed arguments
 
@@ -164,11 +183,11 @@ class DenseWordEmbedder(Embedder, Linear, Serializable):
   def embed(self, x):
     if self.train and self.word_dropout > 0.0 and self.word_id_mask is None:
       batch_size = len(x) if xnmt.batcher.is_batched(x) else 1
-      self.word_id_mask = [set(np.random.choice(self.vocab_size, int(self.vocab_size * self.word_dropout), replace=False)) for _ in range(batch_size)]
+      self.word_id_mask = self.sample_word_id_mask(batch_size, self.vocab_size, self.word_dropout)
     emb_e = dy.parameter(self.embeddings)
     # single mode
     if not xnmt.batcher.is_batched(x):
-      if self.train and self.word_id_mask and x in self.word_id_mask[0]:
+      if self.train and self.word_id_mask is not None and self.word_id_mask[0, x]:
         ret = dy.zeros((self.emb_dim,))
       else:
         ret = dy.pick(emb_e, index=x)
@@ -183,9 +202,11 @@ class DenseWordEmbedder(Embedder, Linear, Serializable):
         ret = dy.cdiv(ret, dy.l2_norm(ret))
         if self.fix_norm != 1:
           ret *= self.fix_norm
-      if self.train and self.word_id_mask and any(x[i] in self.word_id_mask[i] for i in range(len(x))):
-        dropout_mask = dy.inputTensor(np.transpose([[0.0]*self.emb_dim if x[i] in self.word_id_mask[i] else [1.0]*self.emb_dim for i in range(len(x))]), batched=True)
-        ret = dy.cmult(ret, dropout_mask)
+      if self.train and self.word_id_mask is not None:
+        dropped = self.word_id_mask[np.arange(len(x)), list(x)]
+        if dropped.any():
+          dropout_mask = dy.inputTensor(np.broadcast_to(np.logical_not(dropped).astype(float), (self.emb_dim, len(x))), batched=True)
+          ret = dy.cmult(ret, dropout_mask)
     if self.train and self.weight_noise > 0.0:
       ret = dy.noise(ret, self.weight_noise)
     return ret
@@ -252,10 +273,10 @@ class SimpleWordEmbedder(Embedder, Serializable):
   def embed(self, x):
     if self.train and self.word_dropout > 0.0 and self.word_id_mask is None:
       batch_size = len(x) if xnmt.batcher.is_batched(x) else 1
-      self.word_id_mask = [set(np.random.choice(self.vocab_size, int(self.vocab_size * self.word_dropout), replace=False)) for _ in range(batch_size)]
+      self.word_id_mask = self.sample_word_id_mask(batch_size, self.vocab_size, self.word_dropout)
     # single mode
     if not xnmt.batcher.is_batched(x):
-      if self.train and self.word_id_mask and x in self.word_id_mask[0]:
+      if self.train and self.word_id_mask is not None and self.word_id_mask[0, x]:
         ret = dy.zeros((self.emb_dim,))
       else:
         ret = self.embeddings[x]
@@ -270,13 +291,49 @@ class SimpleWordEmbedder(Embedder, Serializable):
         ret = dy.cdiv(ret, dy.l2_norm(ret))
         if self.fix_norm != 1:
           ret *= self.fix_norm
-      if self.train and self.word_id_mask and any(x[i] in self.word_id_mask[i] for i in range(len(x))):
-        dropout_mask = dy.inputTensor(np.transpose([[0.0]*self.emb_dim if x[i] in self.word_id_mask[i] else [1.0]*self.emb_dim for i in range(len(x))]), batched=True)
-        ret = dy.cmult(ret, dropout_mask)
+      if self.train and self.word_id_mask is not None:
+        dropped = self.word_id_mask[np.arange(len(x)), list(x)]
+        if dropped.any():
+          dropout_mask = dy.inputTensor(np.broadcast_to(np.logical_not(dropped).astype(float), (self.emb_dim, len(x))), batched=True)
+          ret = dy.cmult(ret, dropout_mask)
     if self.train and self.weight_noise > 0.0:
       ret = dy.noise(ret, self.weight_noise)
     return ret
 
+  def embed_sent(self, sent):
+    """Embed a full sentence with a single lookup over all word ids.
+
+    Normalization, word dropout and noise are applied once to the looked-up tensor rather than once per position.
+
+    Args:
+      sent: list of word IDs, or a (possibly masked) :class:`xnmt.batcher.Batch` of equal-length lists of word IDs
+
+    Returns:
+      xnmt.expression_sequence.ExpressionSequence: An expression sequence backed by a tensor of dimensions
+                                                   (emb_dim, seq_len) x batch_size.
+    """
+    batched = xnmt.batcher.is_batched(sent)
+    sents = sent if batched else [sent]
+    seq_len = len(sents[0])
+    for single_sent in sents: assert len(single_sent)==seq_len
+    word_ids = np.array([[single_sent[word_i] for word_i in range(seq_len)] for single_sent in sents], dtype=int)
+    if self.train and self.word_dropout > 0.0 and self.word_id_mask is None:
+      self.word_id_mask = self.sample_word_id_mask(len(sents), self.vocab_size, self.word_dropout)
+    # look up all words at once, ordered by sentence, then position
+    ret = self.embeddings.batch(word_ids.flatten().tolist())
+    if self.fix_norm is not None:
+      ret = dy.cdiv(ret, dy.l2_norm(ret))
+      if self.fix_norm != 1:
+        ret *= self.fix_norm
+    if self.train and self.word_id_mask is not None:
+      keep = np.logical_not(self.word_id_mask[np.arange(len(sents))[:,np.newaxis], word_ids]).astype(float).flatten()
+      if not keep.all():
+        ret = dy.cmult(ret, dy.inputTensor(np.broadcast_to(keep, (self.emb_dim, len(keep))), batched=True))
+    if self.train and self.weight_noise > 0.0:
+      ret = dy.noise(ret, self.weight_noise)
+    ret = dy.reshape(ret, (self.emb_dim, seq_len), batch_size=len(sents))
+    return ExpressionSequence(expr_tensor=ret, mask=sent.mask if batched else None)
+
 class NoopEmbedder(Embedder, Serializable):
   """
   This embedder performs no lookups but only passes through the inputs.
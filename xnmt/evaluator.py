@@ -215,6 +215,20 @@ class Evaluator(object):
   """
     raise NotImplementedError(f'evaluate_multi() is not implemented for {type(self)}.')
 
+  def evaluate_batch(self, refs: Sequence[Sequence], hyps: Sequence[Sequence]) -> np.ndarray:
+    """
+  Calculate sentence-level scores for many pairs of sentences at once.
+
+  Only applicable to evaluators whose ``evaluate()`` returns a number when called on a single pair of sentences.
+
+  Args:
+    refs: list of reference sentences ( a sentence is a list of tokens )
+    hyps: list of hypothesis sentences, one per reference
+  Returns:
+    numpy array of scores, one per pair of sentences
+  """
+    return np.array([self.evaluate(ref, hyp) for ref, hyp in zip(refs, hyps)], dtype=float)
+
   def metric_name(self) -> str:
     """
   Return:
@@ -255,6 +269,24 @@ class FastBLEUEvaluator(Evaluator, Serializable):
       raise
     return xnmt_cython.bleu_sentence(self.ngram, self.smooth, ref, hyp)
 
+  def evaluate_batch(self, refs, hyps):
+    try:
+      from xnmt.cython import xnmt_cython
+    except:
+      logger.error("BLEU evaluate fast requires xnmt cython installation step."
+                   "please check the documentation.")
+      raise
+    # references are often shared by several hypotheses (e.g. samples for the same source); pass each one only once
+    unique_refs = []
+    ref_positions = {}
+    hyp_ref_ids = np.empty((len(refs),), dtype=np.int32)
+    for i, ref in enumerate(refs):
+      if id(ref) not in ref_positions:
+        ref_positions[id(ref)] = len(unique_refs)
+        unique_refs.append(ref)
+      hyp_ref_ids[i] = ref_positions[id(ref)]
+    return xnmt_cython.bleu_sentences(self.ngram, self.smooth, unique_refs, hyps, hyp_ref_ids)
+
 
 class BLEUEvaluator(Evaluator, Serializable):
   """
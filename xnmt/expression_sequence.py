@@ -1,4 +1,6 @@
 import dynet as dy
+import numpy as np
+
 import xnmt.batcher
 
 class ExpressionSequence(object):
@@ -100,15 +102,29 @@ class ExpressionSequence(object):
     """
     return self.expr_tensor is not None
 
+  def tile_batch(self, num_copies):
+    """Stack several copies of the (batched) sequence along the batch dimension.
+
+    Args:
+      num_copies: number of copies
+    Returns:
+      expression sequence of batch size ``num_copies * batch_size``, where batch element ``c * batch_size + b`` is a
+      copy of element ``b``
+    """
+    mask = None if self.mask is None else xnmt.batcher.Mask(np.tile(self.mask.np_arr, (num_copies, 1)))
+    return ExpressionSequence(expr_tensor=dy.concatenate_to_batch([self.as_tensor()] * num_copies), mask=mask)
+
 class LazyNumpyExpressionSequence(ExpressionSequence):
   """
   This is initialized via numpy arrays, and dynet expressions are only created
   once a consumer requests representation as list or tensor.
+
+  The data is fed to DyNet as a single float32 input tensor, and individual items are picked from that tensor.
   """
   def __init__(self, lazy_data, mask=None):
     """
     Args:
-      lazy_data: numpy array, or Batcher.Batch of numpy arrays
+      lazy_data: numpy array, or Batcher.Batch of numpy arrays of the same shape
     """
     self.lazy_data = lazy_data
     self.expr_list, self.expr_tensor = None, None
@@ -121,20 +137,24 @@ class LazyNumpyExpressionSequence(ExpressionSequence):
         return self.lazy_data[0].shape[1]
       else: return self.lazy_data.shape[1]
   def __iter__(self):
-    if not (self.expr_list or self.expr_tensor):
-      self.expr_list = [self[i] for i in range(len(self))]
+    self.as_tensor()
     return super(LazyNumpyExpressionSequence, self).__iter__()
   def __getitem__(self, key):
-    if self.expr_list or self.expr_tensor:
-      return super(LazyNumpyExpressionSequence, self).__getitem__(key)
-    else:
-      if xnmt.batcher.is_batched(self.lazy_data):
-        return dy.inputTensor([self.lazy_data[batch][:,key] for batch in range(len(self.lazy_data))], batched=True)
-      else:
-        return dy.inputTensor(self.lazy_data[:,key], batched=False)
+    self.as_tensor()
+    return super(LazyNumpyExpressionSequence, self).__getitem__(key)
+  def as_list(self):
+    self.as_tensor()
+    return super(LazyNumpyExpressionSequence, self).as_list()
   def as_tensor(self):
     if not (self.expr_list or self.expr_tensor):
-      self.expr_tensor = dy.inputTensor(self.lazy_data, batched=xnmt.batcher.is_batched(self.lazy_data))
+      if xnmt.batcher.is_batched(self.lazy_data):
+        # DyNet expects the batch as last dimension
+        data = np.empty(self.lazy_data[0].shape + (len(self.lazy_data),), dtype=np.float32)
+        for batch_i, arr in enumerate(self.lazy_data):
+          data[..., batch_i] = arr
+        self.expr_tensor = dy.inputTensor(data, batched=True)
+      else:
+        self.expr_tensor = dy.inputTensor(np.asarray(self.lazy_data, dtype=np.float32), batched=False)
     return super(LazyNumpyExpressionSequence, self).as_tensor()
 
 class ReversedExpressionSequence(ExpressionSequence):
@@ -1,3 +1,4 @@
+import collections
 from collections.abc import Iterable
 from typing import Optional
 
@@ -35,7 +36,12 @@ class SimpleInference(Serializable):
             ``forced``: perform forced decoding.
             ``forceddebug``: perform forced decoding, calculate training loss, and make suer the scores are identical
                              for debugging purposes.
+            ``score``: score the hypotheses of an n-best list given as ``ref_file`` in the format
+                       ``src_index ||| hypothesis``. If supported by the model, each source sentence is encoded only
+                       once and shared by all of its hypotheses.
     batcher: inference batcher, needed e.g. in connection with ``pad_src_token_to_multiple``
+    max_shared_src_batch: in ``score`` mode, maximum number of hypotheses of the same source sentence that are scored
+                          as one batch; sources with more hypotheses are encoded once per chunk
   """
   
   yaml_tag = '!SimpleInference'
@@ -44,7 +50,8 @@ class SimpleInference(Serializable):
   def __init__(self, src_file: Optional[str] = None, trg_file: Optional[str] = None, ref_file: Optional[str] = None,
                max_src_len: Optional[int] = None, post_process: str = "none", report_path: Optional[str] = None,
                report_type: str = "html", search_strategy: SearchStrategy = bare(BeamSearch), mode: str = "onebest",
-               max_len: Optional[int] = None, batcher: Optional[Batcher] = Ref("train.batcher", default=None)):
+               max_len: Optional[int] = None, batcher: Optional[Batcher] = Ref("train.batcher", default=None),
+               max_shared_src_batch: int = 32):
     self.src_file = src_file
     self.trg_file = trg_file
     self.ref_file = ref_file
@@ -56,6 +63,7 @@ class SimpleInference(Serializable):
     self.batcher = batcher
     self.search_strategy = search_strategy
     self.max_len = max_len
+    self.max_shared_src_batch = max_shared_src_batch
 
   def __call__(self, generator: GeneratorModel, src_file: str = None, trg_file: str = None,
                candidate_id_file: str = None):
@@ -83,6 +91,7 @@ class SimpleInference(Serializable):
       if self.ref_file is None:
         raise RuntimeError("When performing {} decoding, must specify reference file".format(self.mode))
       score_src_corpus = []
+      score_src_indices = []
       ref_corpus = []
       with open(self.ref_file, "r", encoding="utf-8") as fp:
         for line in fp:
@@ -93,6 +102,7 @@ class SimpleInference(Serializable):
             assert src_index < len(src_corpus),\
               f"The src_file has only {len(src_corpus)} instances, nbest file has invalid src_index {src_index}"
             score_src_corpus.append(src_corpus[src_index])
+            score_src_indices.append(src_index)
             trg_input = generator.trg_reader.read_sent(nbest[1].strip())
           else:
             trg_input = generator.trg_reader.read_sent(line)
@@ -128,7 +138,9 @@ class SimpleInference(Serializable):
 
     # If we're debugging, calculate the loss for each target sentence
     ref_scores = None
-    if self.mode == 'forceddebug' or self.mode == 'score':
+    if self.mode == 'score' and hasattr(generator, "calc_loss_shared_src"):
+      ref_scores = self._score_nbest_shared_src(generator, src_corpus, ref_corpus, score_src_indices)
+    elif self.mode == 'forceddebug' or self.mode == 'score':
       some_batcher = xnmt.batcher.InOrderBatcher(32) # Arbitrary
       if not isinstance(some_batcher, xnmt.batcher.InOrderBatcher):
         raise ValueError(f"forceddebug requires InOrderBatcher, got: {some_batcher}")
@@ -175,6 +187,35 @@ class SimpleInference(Serializable):
           for nbest, score in zip(nbest_fp, ref_scores):
             fp.write("{} ||| score={}\n".format(nbest.strip(), score))
   
+  def _score_nbest_shared_src(self, generator, src_corpus, ref_corpus, src_indices):
+    """
+    Score n-best entries grouped by source sentence, so that each source sentence is encoded only once.
+
+    Args:
+      generator: the model to be used
+      src_corpus: source sentence of each n-best entry
+      ref_corpus: hypothesis of each n-best entry
+      src_indices: source index of each n-best entry
+    Returns:
+      list of scores, in the order of the n-best entries
+    """
+    entries_by_src = collections.OrderedDict()
+    for i, src_index in enumerate(src_indices):
+      entries_by_src.setdefault(src_index, []).append(i)
+    chunks = [entries[start:start + self.max_shared_src_batch] for entries in entries_by_src.values()
+              for start in range(0, len(entries), self.max_shared_src_batch)]
+    ref_scores = [None] * len(ref_corpus)
+    for entries in chunks:
+      dy.renew_cg(immediate_compute=settings.IMMEDIATE_COMPUTE, check_validity=settings.CHECK_VALIDITY)
+      loss_expr = generator.calc_loss_shared_src(src_corpus[entries[0]], [ref_corpus[i] for i in entries],
+                                                 loss_calculator=MLELoss())
+      losses = loss_expr.value()
+      if not isinstance(losses, Iterable):
+        losses = [losses]
+      for i, loss in zip(entries, losses):
+        ref_scores[i] = -loss
+    return ref_scores
+
   def get_output_processor(self):
     spec = self.post_process
     if spec == "none":
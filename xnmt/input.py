@@ -100,13 +100,29 @@ class ArrayInput(Input):
     """
     if pad_len == 0:
       return self
-    if token is None:
-      new_nparr = np.append(self.nparr, np.broadcast_to(np.reshape(self.nparr[:,-1], (self.nparr.shape[0], 1)), (self.nparr.shape[0], pad_len)), axis=1)
-    elif token == 0:
-      new_nparr = np.append(self.nparr, np.zeros((self.nparr.shape[0], pad_len)), axis=1)
-    else:
+    return ArrayInput.get_padded_batch([self], token, len(self) + pad_len)[0]
+
+  @staticmethod
+  def get_padded_batch(sents, token, max_len):
+    """
+    Return padded versions of several sents, written into a single pre-allocated array.
+
+    Args:
+      sents (List[ArrayInput]): sents with equal first dimension
+      token: None (replicate last frame) or 0 (pad zeros)
+      max_len (int): length to pad all sents to
+    Returns:
+      List[xnmt.input.ArrayInput]: padded sents, whose arrays are views into one float32 array of dimensions
+                                   len(sents) x feature dim x max_len
+    """
+    if token is not None and token != 0:
       raise NotImplementedError(f"currently only support 'None' or '0' as, but got '{token}'")
-    return ArrayInput(new_nparr)
+    batch_arr = np.empty((len(sents), sents[0].nparr.shape[0], max_len), dtype=np.float32)
+    for sent_arr, sent in zip(batch_arr, sents):
+      sent_len = sent.nparr.shape[1]
+      sent_arr[:,:sent_len] = sent.nparr
+      sent_arr[:,sent_len:] = 0.0 if token == 0 else sent.nparr[:,-1:]
+    return [ArrayInput(sent_arr) for sent_arr in batch_arr]
 
   def get_array(self):
     return self.nparr
\ No newline at end of file
@@ -1,5 +1,5 @@
 from numbers import Real
-from typing import Sequence, Optional
+from typing import Sequence, Optional, Union
 
 import numpy as np
 from scipy.stats import norm
@@ -10,30 +10,63 @@ from xnmt import search_strategy
 class LengthNormalization(object):
   '''
   A template class to generate translation from the output probability model.
+
+  Normalizers operate on numpy arrays, so that whole beams or batches of hypotheses can be normalized at once.
+  Subclasses implement :meth:`normalize_completed_scores` and, if needed, override :meth:`normalize_partial`.
   '''
   def normalize_completed(self, completed_hyps:Sequence['search_strategy.BeamSearch.Hypothesis'], src_length:Optional[int]=None) \
           -> Sequence[float]:
     """
     Apply normalization step to completed hypotheses after search and return the normalized scores.
-    
+
     Args:
-      completed_hyps: list of completed Hypothesis objects, will be normalized in-place
+      completed_hyps: list of completed Hypothesis objects
       src_length: length of source sequence (None if not given)
     Returns:
       normalized scores
     """
-    raise NotImplementedError('normalize_completed must be implemented in LengthNormalization subclasses')
+    scores = np.array([hyp.score for hyp in completed_hyps], dtype=float)
+    lengths = np.array([hyp.length for hyp in completed_hyps], dtype=int)
+    return self.normalize_completed_scores(scores, lengths, src_length).tolist()
+  def normalize_completed_scores(self, scores:np.ndarray, lengths:np.ndarray,
+                                 src_length:Optional[Union[int,np.ndarray]]=None) -> np.ndarray:
+    """
+    Apply normalization step to the scores of completed hypotheses.
+
+    Args:
+      scores: array of unnormalized scores
+      lengths: array of hypothesis lengths, of same shape as ``scores``
+      src_length: length of source sequence, or array of source lengths that broadcasts against ``scores`` (None if
+                  not given)
+    Returns:
+      array of normalized scores
+    """
+    raise NotImplementedError('normalize_completed_scores must be implemented in LengthNormalization subclasses')
   def normalize_partial(self, score_so_far, score_to_add, new_len):
     """
     Args:
-      score_so_far:
-      score_to_add:
-      new_len: length of output hyp with current word already appended
+      score_so_far: score or array of scores
+      score_to_add: score or array of scores, broadcastable against ``score_so_far``
+      new_len: length of output hyp with current word already appended (int or array of ints)
     Returns:
       new score after applying score_to_add to score_so_far
     normalization step applied during the search
     """
     return score_so_far + score_to_add # default behavior: add up the log probs
+  def upper_bound_completed(self, score_so_far, cur_len, max_len, src_length=None):
+    """
+    Upper bound of the normalized score that any completion of a partial hypothesis can achieve; used for early
+    stopping during search.
+
+    Args:
+      score_so_far: score of the partial hypothesis, as returned by :meth:`normalize_partial`
+      cur_len: length of the partial hypothesis
+      max_len: maximum length of a completed hypothesis
+      src_length: length of source sequence (None if not given)
+    Returns:
+      upper bound of the normalized score, or None if no bound is known
+    """
+    return None
 
 class NoNormalization(LengthNormalization, Serializable):
   '''
@@ -45,9 +78,11 @@ class NoNormalization(LengthNormalization, Serializable):
   def __init__(self):
     pass
 
-  def normalize_completed(self, completed_hyps:Sequence['search_strategy.BeamSearch.Hypothesis'], src_length:Optional[int]=None) \
-          -> Sequence[float]:
-    return [hyp.score for hyp in completed_hyps]
+  def normalize_completed_scores(self, scores:np.ndarray, lengths:np.ndarray,
+                                 src_length:Optional[Union[int,np.ndarray]]=None) -> np.ndarray:
+    return scores
+  def upper_bound_completed(self, score_so_far, cur_len, max_len, src_length=None):
+    return score_so_far
 
 class AdditiveNormalization(LengthNormalization, Serializable):
   '''
@@ -60,19 +95,26 @@ class AdditiveNormalization(LengthNormalization, Serializable):
     self.penalty = penalty
     self.apply_during_search = apply_during_search
 
-  def normalize_completed(self, completed_hyps:Sequence['search_strategy.BeamSearch.Hypothesis'], src_length:Optional[int]=None) \
-          -> Sequence[float]:
+  def normalize_completed_scores(self, scores:np.ndarray, lengths:np.ndarray,
+                                 src_length:Optional[Union[int,np.ndarray]]=None) -> np.ndarray:
     if self.apply_during_search:
-      return [hyp.score for hyp in completed_hyps]
+      return scores
     else:
-      return [hyp.score + (len(hyp.id_list) * self.penalty) for hyp in completed_hyps]
+      return scores + lengths * self.penalty
   def normalize_partial(self, score_so_far, score_to_add, new_len):
     return score_so_far + score_to_add + (self.penalty if self.apply_during_search else 0.0)
+  def upper_bound_completed(self, score_so_far, cur_len, max_len, src_length=None):
+    if self.apply_during_search:
+      return score_so_far + max(0.0, self.penalty) * (max_len - cur_len)
+    else:
+      return score_so_far + max(self.penalty * (cur_len + 1), self.penalty * max_len)
 
 
 class PolynomialNormalization(LengthNormalization, Serializable):
   '''
   Dividing by the length (raised to some power)
+
+  The table of length penalties is kept across sentences and grown on demand.
   '''
   yaml_tag = '!PolynomialNormalization'
 
@@ -80,24 +122,30 @@ class PolynomialNormalization(LengthNormalization, Serializable):
   def __init__(self, m:Real=1, apply_during_search:bool=False):
     self.m = m
     self.apply_during_search = apply_during_search
-    self.pows = []
+    self.pows = np.zeros((0,))
 
-  def normalize_completed(self, completed_hyps:Sequence['search_strategy.BeamSearch.Hypothesis'], src_length:Optional[int]=None) \
-          -> Sequence[float]:
+  def normalize_completed_scores(self, scores:np.ndarray, lengths:np.ndarray,
+                                 src_length:Optional[Union[int,np.ndarray]]=None) -> np.ndarray:
     if self.apply_during_search:
-      return [hyp.score for hyp in completed_hyps]
+      return scores
     else:
-      return [(hyp.score / pow(len(hyp.output.word_ids), self.m)) for hyp in completed_hyps]
+      self.update_pows(np.max(lengths, initial=0))
+      return scores / self.pows[lengths]
   def normalize_partial(self, score_so_far, score_to_add, new_len):
     if self.apply_during_search:
-      self.update_pows(new_len)
+      self.update_pows(np.max(new_len))
       return (score_so_far * self.pows[new_len-1] + score_to_add) / self.pows[new_len]
     else:
       return score_so_far + score_to_add
+  def upper_bound_completed(self, score_so_far, cur_len, max_len, src_length=None):
+    # log probs are non-positive, so the normalized score is largest for the longest possible completion
+    if self.apply_during_search:
+      return score_so_far * pow(cur_len, self.m) / pow(max_len, self.m)
+    else:
+      return score_so_far / pow(max_len, self.m)
   def update_pows(self, new_len):
     if len(self.pows) < new_len+1:
-      for i in range(len(self.pows), new_len+1):
-        self.pows.append(pow(i, self.m))
+      self.pows = np.power(np.arange(max(new_len+1, 2*len(self.pows)), dtype=float), self.m)
 
 
 class MultinomialNormalization(LengthNormalization, Serializable):
@@ -105,12 +153,15 @@ class MultinomialNormalization(LengthNormalization, Serializable):
   The algorithm followed by:
   Tree-to-Sequence Attentional Neural Machine Translation
   https://arxiv.org/pdf/1603.06075.pdf
+
+  Log length probabilities are tabulated once per source length and reused across sentences.
   '''
   yaml_tag = '!MultinomialNormalization'
 
   @serializable_init
   def __init__(self, sent_stats):
     self.stats = sent_stats
+    self.log_prob_tables = {}
 
   def trg_length_prob(self, src_length, trg_length):
     v = len(self.stats.src_stat)
@@ -119,15 +170,60 @@ class MultinomialNormalization(LengthNormalization, Serializable):
       return (src_stat.trg_len_distribution.get(trg_length, 0) + 1) / (src_stat.num_sents + v)
     return 1
 
-  def normalize_completed(self, completed_hyps, src_length=None):
+  def log_prob_table(self, src_length):
+    """
+    Args:
+      src_length: length of the src sent
+    Returns:
+      Tuple of array of log length probabilities, indexed by target length, and log probability of lengths beyond the
+      end of the array
+    """
+    if src_length not in self.log_prob_tables:
+      if src_length in self.stats.src_stat:
+        src_stat = self.stats.src_stat[src_length]
+        denom = src_stat.num_sents + len(self.stats.src_stat)
+        counts = np.zeros((max(src_stat.trg_len_distribution.keys(), default=0) + 1,))
+        for trg_length, count in src_stat.trg_len_distribution.items():
+          counts[trg_length] = count
+        self.log_prob_tables[src_length] = (np.log((counts + 1) / denom), np.log(1 / denom))
+      else:
+        self.log_prob_tables[src_length] = (np.zeros((0,)), 0.0)
+    return self.log_prob_tables[src_length]
+
+  def trg_length_log_probs(self, src_length, trg_lengths):
     """
     Args:
-      completed_hyps:
       src_length: length of the src sent
+      trg_lengths: array of target lengths
+    Returns:
+      array of log length probabilities
+    """
+    table, default = self.log_prob_table(src_length)
+    if len(table) == 0:
+      return np.full(trg_lengths.shape, default)
+    return np.where(trg_lengths < len(table), table[np.minimum(trg_lengths, len(table)-1)], default)
+
+  def normalize_completed_scores(self, scores:np.ndarray, lengths:np.ndarray,
+                                 src_length:Optional[Union[int,np.ndarray]]=None) -> np.ndarray:
+    """
+    Args:
+      scores: array of unnormalized scores
+      lengths: array of hypothesis lengths
+      src_length: length of the src sent, or array of src lengths of same shape as ``scores``
     """
     assert (src_length is not None), "Length of Source Sentence is required"
+    src_length = np.asarray(src_length)
+    if src_length.size == 1:
+      return scores + self.trg_length_log_probs(int(src_length.flat[0]), lengths)
+    src_length = np.broadcast_to(src_length, scores.shape)
+    log_probs = np.empty(scores.shape)
+    for single_src_length in np.unique(src_length):
+      idx = src_length == single_src_length
+      log_probs[idx] = self.trg_length_log_probs(int(single_src_length), lengths[idx])
+    return scores + log_probs
 
-    return [hyp.score + np.log(self.trg_length_prob(src_length, len(hyp.id_list))) for hyp in completed_hyps]
+  def upper_bound_completed(self, score_so_far, cur_len, max_len, src_length=None):
+    return score_so_far
 
 
 class GaussianNormalization(LengthNormalization, Serializable):
@@ -136,6 +232,8 @@ class GaussianNormalization(LengthNormalization, Serializable):
    to select sents that have similar lengths as the
    sents in the training set.
    refer: https://arxiv.org/pdf/1509.04942.pdf
+
+   Length probabilities are tabulated and reused across sentences.
   '''
   yaml_tag = '!GaussianNormalization'
 
@@ -154,10 +252,19 @@ class GaussianNormalization(LengthNormalization, Serializable):
       iter = iter_end
     mu, std = norm.fit(y)
     self.distr = norm(mu, std)
+    self.probs = np.zeros((0,))
 
   def trg_length_prob(self, trg_length):
     return self.distr.pdf(trg_length)
 
-  def normalize_completed(self, completed_hyps:Sequence['search_strategy.BeamSearch.Hypothesis'], src_length:Optional[int]=None) \
-          -> Sequence[float]:
-    return [hyp.score / self.trg_length_prob(len(hyp.id_list)) for hyp in completed_hyps]
+  def update_probs(self, max_len):
+    if len(self.probs) < max_len+1:
+      self.probs = self.distr.pdf(np.arange(max(max_len+1, 2*len(self.probs))))
+
+  def normalize_completed_scores(self, scores:np.ndarray, lengths:np.ndarray,
+                                 src_length:Optional[Union[int,np.ndarray]]=None) -> np.ndarray:
+    self.update_probs(np.max(lengths, initial=0))
+    return scores / self.probs[lengths]
+
+  def upper_bound_completed(self, score_so_far, cur_len, max_len, src_length=None):
+    return score_so_far / self.trg_length_prob(self.distr.mean())
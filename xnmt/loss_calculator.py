@@ -1,10 +1,13 @@
 import dynet as dy
 import numpy as np
 
+from xnmt.events import register_xnmt_handler, handle_xnmt_event
 from xnmt.loss import LossBuilder
 from xnmt.persistence import serializable_init, Serializable, Ref
+from xnmt.search_strategy import GreedySearch
 from xnmt.vocab import Vocab
 from xnmt.constants import INFINITY
+from xnmt.settings import settings
 import xnmt.evaluator
 import xnmt.linear as linear
 
@@ -25,6 +28,46 @@ class LossCalculator(object):
       pass
     return sequence
 
+  def stack_samples(self, search_outputs, batch_size):
+    """
+    Stack the word ids of several search outputs into one array.
+
+    Args:
+      search_outputs: list of search outputs, each holding the word ids of one sample per sentence
+      batch_size: number of sentences
+    Returns:
+      Tuple of array of word ids of dimensions num_samples x batch_size x max_len, where everything from the first EOS
+      on is set to EOS, and array of sample lengths (without EOS) of dimensions num_samples x batch_size
+    """
+    max_len = max(len(search_output.word_ids[0]) for search_output in search_outputs)
+    samples = np.full((len(search_outputs), batch_size, max_len), Vocab.ES, dtype=int)
+    for i, search_output in enumerate(search_outputs):
+      word_ids = np.asarray(search_output.word_ids)
+      samples[i, :, :word_ids.shape[1]] = word_ids
+    after_eos = np.cumsum(samples == Vocab.ES, axis=2) > 0
+    samples[after_eos] = Vocab.ES
+    return samples, max_len - after_eos.sum(axis=2)
+
+  def evaluate_samples(self, evaluation_metric, refs, samples, lengths, keep):
+    """
+    Evaluate many samples with a single call to the evaluation metric.
+
+    Args:
+      evaluation_metric: sentence-level evaluator
+      refs: list of reference sentences, one per batch element
+      samples: array of word ids as returned by :meth:`stack_samples`
+      lengths: array of sample lengths as returned by :meth:`stack_samples`
+      keep: boolean array of dimensions num_samples x batch_size; samples that are not kept get a score of 0
+    Returns:
+      array of scores of dimensions num_samples x batch_size
+    """
+    sample_ids, batch_ids = np.nonzero(keep)
+    scores = np.zeros(keep.shape, dtype=float)
+    scores[sample_ids, batch_ids] = evaluation_metric.evaluate_batch(
+      [refs[j] for j in batch_ids],
+      [samples[i, j, :lengths[i, j]].tolist() for i, j in zip(sample_ids, batch_ids)])
+    return scores
+
 class MLELoss(Serializable, LossCalculator):
   yaml_tag = '!MLELoss'
   
@@ -34,36 +77,127 @@ class MLELoss(Serializable, LossCalculator):
     pass
 
   def __call__(self, translator, initial_state, src, trg):
+    dec_states, ref_ids, trg_mask = self.run_decoder(translator, initial_state, src, trg)
+    return translator.decoder.calc_loss_sequence(dec_states, ref_ids, trg_mask)
+
+  def run_decoder(self, translator, initial_state, src, trg):
+    """
+    Feed the reference words into the decoder and collect the decoder states.
+
+    Args:
+      translator: the translator
+      initial_state: initial decoder state
+      src: source sentence or batch of source sentences
+      trg: target sentence or batch of target sentences
+    Returns:
+      Tuple of list of decoder states (one per timestep), numpy array of reference word ids of dimensions
+      batch_size x seq_len, and target mask (or None)
+    """
     dec_state = initial_state
+    batched = xnmt.batcher.is_batched(src)
     trg_mask = trg.mask if xnmt.batcher.is_batched(trg) else None
-    losses = []
-    seq_len = len(trg[0]) if xnmt.batcher.is_batched(src) else len(trg)
-    if xnmt.batcher.is_batched(src):
+    seq_len = len(trg[0]) if batched else len(trg)
+    if batched and settings.CHECK_INPUTS:
       for j, single_trg in enumerate(trg):
         assert len(single_trg) == seq_len # assert consistent length
         assert 1==len([i for i in range(seq_len) if (trg_mask is None or trg_mask.np_arr[j,i]==0) and single_trg[i]==Vocab.ES]) # assert exactly one unmasked ES token
+    trg_sents = trg if batched else [trg]
+    ref_ids = np.array([[single_trg[i] for i in range(seq_len)] for single_trg in trg_sents])
+    dec_states = []
     for i in range(seq_len):
-      ref_word = trg[i] if not xnmt.batcher.is_batched(src) \
-                      else xnmt.batcher.mark_as_batch([single_trg[i] for single_trg in trg])
-
       dec_state.context = translator.attender.calc_context(dec_state.rnn_state.output())
-      word_loss = translator.decoder.calc_loss(dec_state, ref_word)
-      if xnmt.batcher.is_batched(src) and trg_mask is not None:
-        word_loss = trg_mask.cmult_by_timestep_expr(word_loss, i, inverse=True)
-      losses.append(word_loss)
+      dec_states.append(dec_state)
       if i < seq_len-1:
+        ref_word = xnmt.batcher.mark_as_batch(ref_ids[:,i].tolist()) if batched else trg[i]
         dec_state = translator.decoder.add_input(dec_state, translator.trg_embedder.embed(ref_word))
+    return dec_states, ref_ids, trg_mask
+
+class SampledMLELoss(MLELoss, Serializable):
+  """
+  Maximum likelihood loss that normalizes over a sampled subset of the target vocabulary during training.
+
+  The subset consists of all reference words in the current minibatch plus ``num_samples`` sampled words. With the
+  ``unigram`` proposal, words are sampled from the smoothed unigram distribution of the target words seen during
+  training so far, and scores are corrected by the log proposal probability (sampled softmax, Jean et al., 2015,
+  https://arxiv.org/pdf/1412.2007.pdf). With the ``uniform`` proposal, no correction is applied, which amounts to
+  normalizing over the per-batch target vocabulary. Outside of training, the exact loss over the full vocabulary is
+  computed, so that dev losses remain comparable.
+
+  The unigram counts are kept in memory only and are not saved with the model; after a restart, they start again from
+  add-one smoothed counts and the proposal distribution is re-estimated from the minibatches seen from then on.
+
+  Args:
+    num_samples (int): number of words to sample per minibatch
+    proposal (str): ``unigram`` or ``uniform``
+    unigram_power (float): exponent applied to the unigram counts to flatten the proposal distribution
+  """
+  yaml_tag = '!SampledMLELoss'
+
+  @register_xnmt_handler
+  @serializable_init
+  def __init__(self, num_samples=1000, proposal='unigram', unigram_power=0.75):
+    if proposal not in ('unigram', 'uniform'):
+      raise ValueError("Unknown proposal distribution %s" % proposal)
+    self.num_samples = num_samples
+    self.proposal = proposal
+    self.unigram_power = unigram_power
+    self.unigram_counts = None
+    self.train = False
 
-    return dy.esum(losses)
+  @handle_xnmt_event
+  def on_set_train(self, val):
+    self.train = val
+
+  def __call__(self, translator, initial_state, src, trg):
+    dec_states, ref_ids, trg_mask = self.run_decoder(translator, initial_state, src, trg)
+    vocab_size = translator.decoder.mlp_layer.output_dim
+    if not self.train or self.num_samples >= vocab_size:
+      return translator.decoder.calc_loss_sequence(dec_states, ref_ids, trg_mask)
+    if self.proposal == 'unigram':
+      if self.unigram_counts is None or len(self.unigram_counts) != vocab_size:
+        self.unigram_counts = np.ones(vocab_size)
+      ref_words = ref_ids if trg_mask is None else ref_ids[trg_mask.np_arr == 0]
+      self.unigram_counts += np.bincount(ref_words.flatten(), minlength=vocab_size)
+      proposal_probs = np.power(self.unigram_counts, self.unigram_power)
+      proposal_probs /= proposal_probs.sum()
+      samples = np.random.choice(vocab_size, self.num_samples, p=proposal_probs)
+    else:
+      samples = np.random.randint(vocab_size, size=self.num_samples)
+    candidates = np.union1d(ref_ids, samples)
+    candidate_bias = -np.log(proposal_probs[candidates]) if self.proposal == 'unigram' else None
+    return translator.decoder.calc_sampled_loss_sequence(dec_states, ref_ids, candidates,
+                                                         candidate_bias=candidate_bias, trg_mask=trg_mask)
 
 class ReinforceLoss(Serializable, LossCalculator):
+  """
+  REINFORCE loss (Williams, 1992), using a sentence-level evaluation metric as reward.
+
+  Samples are drawn by the translator's search strategy, usually a :class:`xnmt.search_strategy.SamplingSearch`, and
+  all returned samples are used; the loss is averaged over them. The variance of the gradient estimate can be reduced
+  by subtracting either a learned baseline, predicted from the decoder state at each timestep, or the reward of the
+  greedy output (self-critical sequence training, Rennie et al., 2017, https://arxiv.org/pdf/1612.00563.pdf).
+
+  Args:
+    evaluation_metric (Evaluator): sentence-level evaluation metric; defaults to smoothed BLEU-4
+    sample_length (int): maximum length of the greedy output when using ``self_critical``
+    use_baseline (bool): whether to subtract a learned baseline
+    inv_eval (bool): whether to negate the evaluation metric, so that higher scores yield lower losses
+    decoder_hidden_dim (int): hidden dimension of the decoder, used as input dimension of the baseline
+    baseline (Linear): baseline predictor; created automatically if ``use_baseline`` is set
+    self_critical (bool): whether to subtract the reward of the greedy output as baseline; cannot be combined with
+                          ``use_baseline``
+  """
   yaml_tag = '!ReinforceLoss'
 
-  # TODO: document me
   @serializable_init
   def __init__(self, evaluation_metric=None, sample_length=50, use_baseline=False,
-               inv_eval=True, decoder_hidden_dim=Ref("exp_global.default_layer_dim"), baseline=None):
+               inv_eval=True, decoder_hidden_dim=Ref("exp_global.default_layer_dim"), baseline=None,
+               self_critical=False):
+    if use_baseline and self_critical:
+      raise ValueError("use_baseline and self_critical cannot be combined")
     self.use_baseline = use_baseline
+    self.self_critical = self_critical
+    self.sample_length = sample_length
     self.inv_eval = inv_eval
     if evaluation_metric is None:
       self.evaluation_metric = xnmt.evaluator.FastBLEUEvaluator(ngram=4, smooth=1)
@@ -75,39 +209,45 @@ class ReinforceLoss(Serializable, LossCalculator):
                                                       lambda: linear.Linear(input_dim=decoder_hidden_dim, output_dim=1))
 
   def __call__(self, translator, initial_state, src, trg):
-    # TODO(philip30): currently only using the best hypothesis / first sample for reinforce loss
-    # A small further implementation is needed if we want to do reinforce with multiple samples.
-    search_output = translator.search_strategy.generate_output(translator, initial_state)[0]
-    # Calculate evaluation scores
-    self.eval_score = []
-    for trg_i, sample_i in zip(trg, search_output.word_ids):
-      # Removing EOS
-      sample_i = self.remove_eos(sample_i.tolist())
-      ref_i = self.remove_eos(trg_i.words)
-      # Evaluating 
-      if len(sample_i) == 0:
-        score = 0
-      else:
-        score = self.evaluation_metric.evaluate(ref_i, sample_i) * \
-                (-1 if self.inv_eval else 1)
-      self.eval_score.append(score)
-    self.true_score = dy.inputTensor(self.eval_score, batched=True)
+    batch_size = len(trg)
+    search_outputs = translator.search_strategy.generate_output(translator, initial_state,
+                                                                collect_loss_info=True)
+    num_samples = len(search_outputs)
+    outputs_to_evaluate = list(search_outputs)
+    if self.self_critical:
+      outputs_to_evaluate += GreedySearch(max_len=self.sample_length).generate_output(translator, initial_state)
+    # Calculate the rewards of all samples (and the greedy output) at once
+    refs = [self.remove_eos(single_trg.words) for single_trg in trg]
+    samples, lengths = self.stack_samples(outputs_to_evaluate, batch_size)
+    rewards = self.evaluate_samples(self.evaluation_metric, refs, samples, lengths, lengths > 0)
+    if self.inv_eval:
+      rewards = -rewards
+    if self.self_critical:
+      rewards = rewards[:num_samples] - rewards[num_samples]
     # Composing losses
     loss = LossBuilder()
+    reinforce_losses = []
+    baseline_losses = []
+    for search_output, sample_rewards in zip(search_outputs, rewards):
+      # log probabilities of the sampled words, of dimensions seq_len x batch_size; steps after the first EOS of a
+      # sentence are masked out, as the search may keep producing words (with nonzero log probabilities) for finished
+      # sentences while other sentences of the batch are still being generated
+      logprobs = dy.concatenate(search_output.logsoftmaxes)
+      seq_len = len(search_output.logsoftmaxes)
+      mask = np.ones((seq_len, batch_size)) if search_output.mask is None else np.asarray(search_output.mask)
+      reward_expr = dy.inputTensor(mask * sample_rewards, batched=True)
+      if self.use_baseline:
+        mask_expr = dy.inputTensor(mask, batched=True)
+        baseline_expr = dy.cmult(dy.reshape(self.baseline(dy.concatenate_cols(search_output.state)), (seq_len,),
+                                            batch_size=batch_size),
+                                 mask_expr)
+        reinforce_losses.append(dy.dot_product(logprobs, reward_expr - dy.nobackprop(baseline_expr)))
+        baseline_losses.append(dy.squared_distance(reward_expr, baseline_expr))
+      else:
+        reinforce_losses.append(dy.dot_product(logprobs, reward_expr))
+    loss.add_loss("reinforce", dy.esum(reinforce_losses) * (1.0 / num_samples))
     if self.use_baseline:
-      baseline_loss = []
-      losses = []
-      for state, logsoft, mask in zip(search_output.state,
-                                      search_output.logsoftmaxes,
-                                      search_output.mask):
-        bs_score = self.baseline(state)
-        baseline_loss.append(dy.squared_distance(self.true_score, bs_score))
-        loss_i = dy.cmult(logsoft, self.true_score - bs_score)
-        losses.append(dy.cmult(loss_i, dy.inputTensor(mask, batched=True)))
-      loss.add_loss("reinforce", dy.sum_elems(dy.esum(losses)))
-      loss.add_loss("reinf_baseline", dy.sum_elems(dy.esum(baseline_loss)))
-    else:
-      loss.add_loss("reinforce", dy.sum_elems(dy.cmult(self.true_score, dy.esum(logsofts))))
+      loss.add_loss("reinf_baseline", dy.esum(baseline_losses) * (1.0 / num_samples))
     return loss
 
 class MinRiskLoss(Serializable, LossCalculator):
@@ -126,47 +266,29 @@ class MinRiskLoss(Serializable, LossCalculator):
 
   def __call__(self, translator, initial_state, src, trg):
     batch_size = len(trg)
-    uniques = [set() for _ in range(batch_size)]
-    deltas = []
-    probs = []
-    
-    search_outputs = translator.search_strategy.generate_output(translator, initial_state, forced_trg_ids=trg)
-    for search_output in search_outputs:
-      logprob = search_output.logsoftmaxes
-      sample = search_output.word_ids
-      attentions = search_output.attentions
-
-      logprob = dy.esum(logprob) * self.alpha
-      # Calculate the evaluation score
-      eval_score = np.zeros(batch_size, dtype=float)
-      mask = np.zeros(batch_size, dtype=float)
-      for j in range(batch_size):
-        ref_j = self.remove_eos(trg[j].words)
-        hyp_j = self.remove_eos(sample[j].tolist())
-        if self.unique_sample:
-          hash_val = hash(tuple(hyp_j))
-          if len(hyp_j) == 0 or hash_val in uniques[j]:
-            mask[j] = -INFINITY
-            continue
-          else:
-            # Count this sample in
-            uniques[j].add(hash_val)
-          # Calc evaluation score
-        eval_score[j] = self.evaluation_metric.evaluate(ref_j, hyp_j) * \
-                        (-1 if self.inv_eval else 1)
-      # Appending the delta and logprob of this sample
-      prob = logprob + dy.inputTensor(mask, batched=True)
-      deltas.append(dy.inputTensor(eval_score, batched=True))
-      probs.append(prob)
-    sample_prob = dy.softmax(dy.concatenate(probs))
-    deltas = dy.concatenate(deltas)
-    risk = dy.sum_elems(dy.cmult(sample_prob, deltas))
-
-    ### Debug
-    #print(sample_prob.npvalue().transpose()[0])
-    #print(deltas.npvalue().transpose()[0])
-    #print("----------------------")
-    ### End debug
-
+    search_outputs = translator.search_strategy.generate_output(translator, initial_state, forced_trg_ids=trg,
+                                                                collect_loss_info=True)
+    num_samples = len(search_outputs)
+    # log probabilities of all samples, of dimensions num_samples x batch_size
+    logprobs = dy.concatenate([dy.esum(search_output.logsoftmaxes) for search_output in search_outputs]) * self.alpha
+    samples, lengths = self.stack_samples(search_outputs, batch_size)
+    max_len = samples.shape[2]
+    if self.unique_sample:
+      # keep the first occurrence of each distinct non-empty sample per sentence
+      batch_ids = np.broadcast_to(np.arange(batch_size)[np.newaxis, :, np.newaxis], (num_samples, batch_size, 1))
+      keyed_samples = np.concatenate([batch_ids, samples], axis=2).reshape((num_samples * batch_size, max_len + 1))
+      _, first_ids = np.unique(keyed_samples, axis=0, return_index=True)
+      keep = np.zeros((num_samples * batch_size,), dtype=bool)
+      keep[first_ids] = True
+      keep = keep.reshape((num_samples, batch_size)) & (lengths > 0)
+    else:
+      keep = np.ones((num_samples, batch_size), dtype=bool)
+    # Calculate the evaluation scores of all kept samples at once
+    refs = [self.remove_eos(single_trg.words) for single_trg in trg]
+    eval_score = self.evaluate_samples(self.evaluation_metric, refs, samples, lengths, keep)
+    if self.inv_eval:
+      eval_score = -eval_score
+    sample_prob = dy.softmax(logprobs + dy.inputTensor(np.where(keep, 0.0, -INFINITY), batched=True))
+    risk = dy.sum_elems(dy.cmult(sample_prob, dy.inputTensor(eval_score, batched=True)))
     return LossBuilder({"risk": risk})
 
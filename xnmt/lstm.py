@@ -3,7 +3,7 @@ from collections.abc import Sequence
 import numpy as np
 import dynet as dy
 
-from xnmt.expression_sequence import ExpressionSequence, ReversedExpressionSequence
+from xnmt.expression_sequence import ExpressionSequence
 from xnmt.events import register_xnmt_handler, handle_xnmt_event
 from xnmt.param_collection import ParamManager
 from xnmt.param_init import GlorotInitializer, ZeroInitializer
@@ -171,12 +171,13 @@ class UniLSTMSeqTransducer(SeqTransducer, Serializable):
 
     return new_c, new_h
 
-  def __call__(self, expr_seq):
+  def __call__(self, expr_seq, reverse=False):
     """
     transduce the sequence, applying masks if given (masked timesteps simply copy previous h / c)
 
     Args:
       expr_seq: expression sequence or list of expression sequences (where each inner list will be concatenated)
+      reverse: if True, run over the sequence from right to left; outputs are still returned in the input order
     Returns:
       expression sequence
     """
@@ -184,38 +185,70 @@ class UniLSTMSeqTransducer(SeqTransducer, Serializable):
       expr_seq = [expr_seq]
     batch_size = expr_seq[0][0].dim()[1]
     seq_len = len(expr_seq[0])
+    mask = expr_seq[0].mask
+    hidden_dim = int(self.hidden_dim)
 
     if self.dropout_rate > 0.0 and self.train:
       self.set_dropout_masks(batch_size=batch_size)
 
+    # timesteps at which some sequence is padded; there, the previous h / c are copied for the padded sequences
+    masked_pos = np.zeros((seq_len,), dtype=bool) if mask is None else np.any(mask.np_arr, axis=0)
+    if masked_pos.any():
+      keep_arr = np.transpose(1.0 - mask.np_arr)
+      keep_mask = dy.inputTensor(np.broadcast_to(keep_arr, (hidden_dim,) + keep_arr.shape), batched=True)
+      # DyNet drops trailing dimensions of size 1, which would break picking timesteps from dimension 1
+      keep_mask = dy.reshape(keep_mask, (hidden_dim, seq_len), batch_size=batch_size)
+
+    # weight noise is sampled anew at each timestep inside the dedicated gates node, so only in its absence can the
+    # input projection be precomputed for the whole sequence
+    fused = not (self.train and self.weightnoise_std > 0.0)
+
+    positions = range(seq_len-1, -1, -1) if reverse else range(seq_len)
     cur_input = expr_seq
     self._final_states = []
     for layer_i in range(self.num_layers):
-      h = [dy.zeroes(dim=(self.hidden_dim,), batch_size=batch_size)]
-      c = [dy.zeroes(dim=(self.hidden_dim,), batch_size=batch_size)]
-      for pos_i in range(seq_len):
-        x_t = [cur_input[j][pos_i] for j in range(len(cur_input))]
-        if isinstance(x_t, dy.Expression):
-          x_t = [x_t]
-        elif type(x_t) != list:
-          x_t = list(x_t)
+      h = [dy.zeroes(dim=(hidden_dim,), batch_size=batch_size)]
+      c = [dy.zeroes(dim=(hidden_dim,), batch_size=batch_size)]
+      outputs = [None] * seq_len
+      if fused:
+        x = dy.concatenate([inp.as_tensor() for inp in cur_input])
+        # DyNet drops trailing dimensions of size 1, so for one-token inputs the sequence dimension must be restored
+        x = dy.reshape(x, (x.dim()[0][0], seq_len), batch_size=batch_size)
         if self.dropout_rate > 0.0 and self.train:
           # apply dropout according to https://arxiv.org/abs/1512.05287 (tied weights)
-          gates_t = dy.vanilla_lstm_gates_dropout_concat(x_t, h[-1], self.Wx[layer_i], self.Wh[layer_i], self.b[layer_i], self.dropout_mask_x[layer_i], self.dropout_mask_h[layer_i], self.weightnoise_std if self.train else 0.0)
+          x = dy.cmult(x, self.dropout_mask_x[layer_i] * dy.ones((1, seq_len)))
+        # input projection and bias for all timesteps: (4*hidden_dim, seq_len) x batch_size
+        wx = dy.reshape(dy.affine_transform([self.b[layer_i], self.Wx[layer_i], x]), (4*hidden_dim, seq_len),
+                        batch_size=batch_size)
+      for pos_i in positions:
+        if fused:
+          h_prev = h[-1]
+          if self.dropout_rate > 0.0 and self.train:
+            h_prev = dy.cmult(h_prev, self.dropout_mask_h[layer_i])
+          gates_t = dy.affine_transform([dy.pick(wx, pos_i, dim=1), self.Wh[layer_i], h_prev])
+          # [i; f; o] use a sigmoid, [g] a tanh activation
+          gates_t = dy.concatenate([dy.logistic(dy.pickrange(gates_t, 0, 3*hidden_dim)),
+                                    dy.tanh(dy.pickrange(gates_t, 3*hidden_dim, 4*hidden_dim))])
         else:
-          gates_t = dy.vanilla_lstm_gates_concat(x_t, h[-1], self.Wx[layer_i], self.Wh[layer_i], self.b[layer_i], self.weightnoise_std if self.train else 0.0)
+          x_t = [cur_input[j][pos_i] for j in range(len(cur_input))]
+          if self.dropout_rate > 0.0 and self.train:
+            # apply dropout according to https://arxiv.org/abs/1512.05287 (tied weights)
+            gates_t = dy.vanilla_lstm_gates_dropout_concat(x_t, h[-1], self.Wx[layer_i], self.Wh[layer_i], self.b[layer_i], self.dropout_mask_x[layer_i], self.dropout_mask_h[layer_i], self.weightnoise_std if self.train else 0.0)
+          else:
+            gates_t = dy.vanilla_lstm_gates_concat(x_t, h[-1], self.Wx[layer_i], self.Wh[layer_i], self.b[layer_i], self.weightnoise_std if self.train else 0.0)
         c_t = dy.vanilla_lstm_c(c[-1], gates_t)
         h_t = dy.vanilla_lstm_h(c_t, gates_t)
-        if expr_seq[0].mask is None or np.isclose(np.sum(expr_seq[0].mask.np_arr[:,pos_i:pos_i+1]), 0.0):
-          c.append(c_t)
-          h.append(h_t)
-        else:
-          c.append(expr_seq[0].mask.cmult_by_timestep_expr(c_t,pos_i,True) + expr_seq[0].mask.cmult_by_timestep_expr(c[-1],pos_i,False))
-          h.append(expr_seq[0].mask.cmult_by_timestep_expr(h_t,pos_i,True) + expr_seq[0].mask.cmult_by_timestep_expr(h[-1],pos_i,False))
+        if masked_pos[pos_i]:
+          keep_t = dy.pick(keep_mask, pos_i, dim=1)
+          c_t = c[-1] + dy.cmult(keep_t, c_t - c[-1])
+          h_t = h[-1] + dy.cmult(keep_t, h_t - h[-1])
+        c.append(c_t)
+        h.append(h_t)
+        outputs[pos_i] = h_t
       self._final_states.append(FinalTransducerState(h[-1], c[-1]))
-      cur_input = [h[1:]]
+      cur_input = [ExpressionSequence(expr_list=outputs)]
 
-    return ExpressionSequence(expr_list=h[1:], mask=expr_seq[0].mask)
+    return ExpressionSequence(expr_list=outputs, mask=mask)
 
 class BiLSTMSeqTransducer(SeqTransducer, Serializable):
   """
@@ -274,13 +307,14 @@ class BiLSTMSeqTransducer(SeqTransducer, Serializable):
 
   def __call__(self, es):
     mask = es.mask
-    # first layer
+    # first layer; the backward layers run from right to left but return outputs in input order, so that no reversed
+    # copies of the sequences are needed
     forward_es = self.forward_layers[0](es)
-    rev_backward_es = self.backward_layers[0](ReversedExpressionSequence(es))
+    backward_es = self.backward_layers[0](es, reverse=True)
 
     for layer_i in range(1, len(self.forward_layers)):
-      new_forward_es = self.forward_layers[layer_i]([forward_es, ReversedExpressionSequence(rev_backward_es)])
-      rev_backward_es = ExpressionSequence(self.backward_layers[layer_i]([ReversedExpressionSequence(forward_es), rev_backward_es]).as_list(), mask=mask)
+      new_forward_es = self.forward_layers[layer_i]([forward_es, backward_es])
+      backward_es = self.backward_layers[layer_i]([forward_es, backward_es], reverse=True)
       forward_es = new_forward_es
 
     self._final_states = [FinalTransducerState(dy.concatenate([self.forward_layers[layer_i].get_final_states()[0].main_expr(),
@@ -288,7 +322,7 @@ class BiLSTMSeqTransducer(SeqTransducer, Serializable):
                                             dy.concatenate([self.forward_layers[layer_i].get_final_states()[0].cell_expr(),
                                                             self.backward_layers[layer_i].get_final_states()[0].cell_expr()])) \
                           for layer_i in range(len(self.forward_layers))]
-    return ExpressionSequence(expr_list=[dy.concatenate([forward_es[i],rev_backward_es[-i-1]]) for i in range(len(forward_es))], mask=mask)
+    return ExpressionSequence(expr_tensor=dy.concatenate([forward_es.as_tensor(), backward_es.as_tensor()]), mask=mask)
 
 
 class CustomLSTMSeqTransducer(SeqTransducer, Serializable):
@@ -82,7 +82,16 @@ class MLP(Serializable):
                                                               param_init=param_init_output, bias_init=bias_init_output))
 
   def __call__(self, input_expr):
-    return self.output_projector(self.activation(self.hidden_layer(input_expr)))
+    return self.output_projector(self.get_hidden(input_expr))
+
+  def get_hidden(self, input_expr):
+    """
+    Args:
+      input_expr: input expression
+    Returns:
+      the activated hidden layer, i.e. the input to the output projector
+    """
+    return self.activation(self.hidden_layer(input_expr))
 
   def choose_vocab_size(self, vocab_size, vocab, trg_reader):
     """Choose the vocab size for the embedder basd on the passed arguments
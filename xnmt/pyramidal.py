@@ -1,7 +1,7 @@
 import dynet as dy
 
 from xnmt.lstm import UniLSTMSeqTransducer
-from xnmt.expression_sequence import ExpressionSequence, ReversedExpressionSequence
+from xnmt.expression_sequence import ExpressionSequence
 from xnmt.persistence import serializable_init, Serializable, Ref
 from xnmt.events import register_xnmt_handler, handle_xnmt_event
 from xnmt.transducer import SeqTransducer, FinalTransducerState
@@ -76,6 +76,20 @@ class PyramidalLSTMSeqTransducer(SeqTransducer, Serializable):
     else:
       return self.reduce_factor[layer_i]
 
+  def _stack_groups(self, tensor, reduce_factor):
+    """
+    Stack each group of reduce_factor consecutive columns into a single column.
+
+    Args:
+      tensor: expression of dimensions (dim, seq_len) x batch_size, where seq_len is a multiple of reduce_factor
+      reduce_factor: number of columns per group
+    Returns:
+      expression of dimensions (dim * reduce_factor, seq_len / reduce_factor) x batch_size
+    """
+    dims, batch_size = tensor.dim()
+    dim, seq_len = dims[0], (dims[1] if len(dims) > 1 else 1)
+    return dy.reshape(tensor, (dim * reduce_factor, seq_len // reduce_factor), batch_size=batch_size)
+
   def __call__(self, es):
     """
     returns the list of output Expressions obtained by adding the given inputs
@@ -96,27 +110,29 @@ class PyramidalLSTMSeqTransducer(SeqTransducer, Serializable):
       if self.downsampling_method=="concat" and len(es_list[0]) % reduce_factor != 0:
         raise ValueError("For 'concat' subsampling, sequence lengths must be multiples of the total reduce factor, but got sequence length={} for reduce_factor={}. Set Batcher's pad_src_to_multiple argument accordingly.".format(len(es_list[0]), reduce_factor))
       fs = fb(es_list)
-      bs = bb([ReversedExpressionSequence(es_item) for es_item in es_list])
+      # the backward builder runs from right to left, but returns its outputs in input order
+      bs = bb(es_list, reverse=True)
       if layer_i < len(self.builder_layers) - 1:
+        # downsampling picks or permutes the columns of the output tensors with a single select_cols each
+        seq_len = len(fs)
         if self.downsampling_method=="skip":
-          es_list = [ExpressionSequence(expr_list=fs[::reduce_factor], mask=mask_out), ExpressionSequence(expr_list=bs[::reduce_factor][::-1], mask=mask_out)]
+          es_list = [ExpressionSequence(expr_tensor=dy.select_cols(fs.as_tensor(), list(range(0, seq_len, reduce_factor))),
+                                        mask=mask_out),
+                     ExpressionSequence(expr_tensor=dy.select_cols(bs.as_tensor(),
+                                                                   list(range((seq_len-1) % reduce_factor, seq_len,
+                                                                              reduce_factor))),
+                                        mask=mask_out)]
         elif self.downsampling_method=="concat":
-          es_len = len(es_list[0])
-          es_list_fwd = []
-          es_list_bwd = []
-          for i in range(0, es_len, reduce_factor):
-            for j in range(reduce_factor):
-              if i==0:
-                es_list_fwd.append([])
-                es_list_bwd.append([])
-              es_list_fwd[j].append(fs[i+j])
-              es_list_bwd[j].append(bs[len(es_list[0])-reduce_factor+j-i])
-          es_list = [ExpressionSequence(expr_list=es_list_fwd[j], mask=mask_out) for j in range(reduce_factor)] + [ExpressionSequence(expr_list=es_list_bwd[j], mask=mask_out) for j in range(reduce_factor)]
+          # within each group of reduce_factor timesteps, backward outputs are stacked from right to left
+          bs_tensor = dy.select_cols(bs.as_tensor(), [i + reduce_factor - 1 - j for i in range(0, seq_len, reduce_factor)
+                                                      for j in range(reduce_factor)])
+          es_list = [ExpressionSequence(expr_tensor=self._stack_groups(fs.as_tensor(), reduce_factor), mask=mask_out),
+                     ExpressionSequence(expr_tensor=self._stack_groups(bs_tensor, reduce_factor), mask=mask_out)]
         else:
           raise RuntimeError("unknown downsampling_method %s" % self.downsampling_method)
       else:
         # concat final outputs
-        ret_es = ExpressionSequence(expr_list=[dy.concatenate([f, b]) for f, b in zip(fs, ReversedExpressionSequence(bs))], mask=mask_out)
+        ret_es = ExpressionSequence(expr_tensor=dy.concatenate([fs.as_tensor(), bs.as_tensor()]), mask=mask_out)
 
     self._final_states = [FinalTransducerState(dy.concatenate([fb.get_final_states()[0].main_expr(),
                                                                bb.get_final_states()[0].main_expr()]),
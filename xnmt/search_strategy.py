@@ -1,5 +1,6 @@
 from collections import namedtuple
 import math
+import time
 
 import dynet as dy
 import numpy as np
@@ -20,18 +21,33 @@ from xnmt.vocab import Vocab
 # masks: whether the particular word id should be ignored or not (1 for not, 0 for yes)
 SearchOutput = namedtuple('SearchOutput', ['word_ids', 'attentions', 'score', 'logsoftmaxes', 'state', 'mask'])
 
+def pick_batch_elems(expr, batch_ids):
+  """
+  Args:
+    expr: batched expression, or list of expressions (e.g. one per ensemble member)
+    batch_ids: batch elements to keep
+  Returns:
+    the expression(s) restricted to the given batch elements
+  """
+  if isinstance(expr, dy.Expression):
+    return dy.pick_batch_elems(expr, batch_ids)
+  return type(expr)([pick_batch_elems(elem, batch_ids) for elem in expr])
+
 class SearchStrategy(object):
   '''
   A template class to generate translation from the output probability model. (Non-batched operation)
   '''
   def generate_output(self, translator, dec_state,
-                      src_length=None, forced_trg_ids=None):
+                      src_length=None, forced_trg_ids=None, collect_loss_info=False):
     """
     Args:
       translator (Translator): a translator
       dec_state (MlpSoftmaxDecoderState): initial decoder state
       src_length (int): length of src sequence, required for some types of length normalization
       forced_trg_ids (List[int]): list of word ids, if given will force to generate this is the target sequence
+      collect_loss_info (bool): whether to collect the picked log softmax expressions and non-backpropagateable
+                                decoder states of each step; these are only needed by loss calculators such as
+                                :class:`xnmt.loss_calculator.ReinforceLoss`, and skipping them speeds up inference
     Returns:
       List[SearchOutput]: List of (word_ids, attentions, score, logsoftmaxes)
     """
@@ -52,107 +68,191 @@ class GreedySearch(Serializable, SearchStrategy):
     self.max_len = max_len
 
   def generate_output(self, translator, initial_state,
-                      src_length=None, forced_trg_ids=None):
+                      src_length=None, forced_trg_ids=None, collect_loss_info=False):
     # Output variables
-    score = []
     word_ids = []
     attentions = []
     logsoftmaxes = []
     states = []
     masks = []
+    step_scores = []
     # Search Variables
     done = None
     current_state = initial_state
-    current_output = None
     for length in range(self.max_len):
       prev_word = word_ids[length-1] if length > 0 else None
       current_output = translator.output_one_step(prev_word, current_state)
       current_state = current_output.state
       if forced_trg_ids is None:
-        word_id = np.argmax(current_output.logsoftmax.npvalue(), axis=0)
-        if len(word_id.shape) == 2:
-          word_id = word_id[0]
+        # a single value fetch per step yields both the argmax and its score
+        logsoft_val = current_output.logsoftmax.npvalue()
+        logsoft_val = logsoft_val.reshape((logsoft_val.shape[0], -1))
+        word_id = np.argmax(logsoft_val, axis=0)
+        step_scores.append(logsoft_val[word_id, np.arange(len(word_id))])
       else:
         if xnmt.batcher.is_batched(forced_trg_ids):
-          word_id = [forced_trg_ids[i][length] for i in range(len(forced_trg_ids))]
+          word_id = np.array([forced_trg_ids[i][length] for i in range(len(forced_trg_ids))])
         else:
-          word_id = [forced_trg_ids[length]]
-      logsoft = dy.pick_batch(current_output.logsoftmax, word_id)
-      if done is not None:
-        word_id = [word_id[i] if not done[i] else Vocab.ES for i in range(len(done))]
-        # masking for logsoftmax
-        mask = [1 if not done[i] else 0 for i in range(len(done))]
-        logsoft = dy.cmult(logsoft, dy.inputTensor(mask, batched=True))
-        masks.append(mask)
+          word_id = np.array([forced_trg_ids[length]])
+        # scores of forced words are fetched in one go after the search
+        step_scores.append(dy.pick_batch(current_output.logsoftmax, word_id))
+      if done is None:
+        masks.append(np.ones(len(word_id)))
+      else:
+        word_id = np.where(done, Vocab.ES, word_id)
+        masks.append(np.logical_not(done).astype(float))
       # Packing outputs
-      score.append(logsoft.npvalue())
       word_ids.append(word_id)
       attentions.append(current_output.attention)
-      logsoftmaxes.append(dy.pick_batch(current_output.logsoftmax, word_id))
-      states.append(translator.get_nobp_state(current_state))
+      if collect_loss_info:
+        logsoftmaxes.append(dy.pick_batch(current_output.logsoftmax, word_id))
+        states.append(translator.get_nobp_state(current_state))
       # Check if we are done.
-      done = [x == Vocab.ES for x in word_id]
-      if all(done):
+      done = word_id == Vocab.ES
+      if np.all(done):
         break
-    masks.insert(0, [1 for _ in range(len(done))])
+    if forced_trg_ids is not None:
+      step_scores = dy.concatenate(step_scores).npvalue().reshape((len(step_scores), -1))
     words = np.stack(word_ids, axis=1)
-    score = np.sum(score, axis=0)
+    score = np.sum(np.stack(step_scores) * np.stack(masks), axis=0)
     return [SearchOutput(words, attentions, score, logsoftmaxes, states, masks)]
 
 class BeamSearch(Serializable, SearchStrategy):
   """
   Performs beam search.
+
+  Optional pruning follows "Beam Search Strategies for Neural Machine Translation" (Freitag & Al-Onaizan, 2017):
+  candidates that fall too far behind the best candidate of the current step are discarded, and the number of
+  candidates that each parent hypothesis may contribute to the next beam can be limited.
   
   Args:
     beam_size (int):
     max_len (int): maximum number of tokens to generate.
     len_norm (LengthNormalization): type of length normalization to apply
     one_best (bool): Whether to output the best hyp only or all completed hyps.
+    rel_max_len (float): if given, additionally limit the number of generated tokens to ``rel_max_len`` times the
+                         source length.
+    rel_threshold (float): if given, discard candidates whose probability is less than ``rel_threshold`` times the
+                           probability of the best candidate of the current step (``0 < rel_threshold <= 1``).
+    abs_threshold (float): if given, discard candidates whose log probability is more than ``abs_threshold`` below
+                           the log probability of the best candidate of the current step.
+    max_cands_per_parent (int): if given, each hypothesis contributes at most this many candidates to the next beam.
+    early_stopping (bool): stop as soon as no active hypothesis can outscore the best completed hypothesis under the
+                           given length normalization.
   """
 
   yaml_tag = '!BeamSearch'
-  Hypothesis = namedtuple('Hypothesis', ['score', 'output', 'parent', 'word'])
+  # output: the (batched) output of the step that produced this hyp, batch_id: the hyp's batch element in output
+  Hypothesis = namedtuple('Hypothesis', ['score', 'output', 'parent', 'word', 'length', 'batch_id'])
   
   @serializable_init
-  def __init__(self, beam_size=1, max_len=100, len_norm=bare(NoNormalization), one_best=True):
+  def __init__(self, beam_size=1, max_len=100, len_norm=bare(NoNormalization), one_best=True, rel_max_len=None,
+               rel_threshold=None, abs_threshold=None, max_cands_per_parent=None, early_stopping=False):
     self.beam_size = beam_size
     self.max_len = max_len
     self.len_norm = len_norm
     self.one_best = one_best
+    self.rel_max_len = rel_max_len
+    if rel_threshold is not None and not 0.0 < rel_threshold <= 1.0:
+      raise ValueError(f"rel_threshold must be in (0,1], got: {rel_threshold}")
+    self.rel_threshold = rel_threshold
+    self.abs_threshold = abs_threshold
+    self.max_cands_per_parent = max_cands_per_parent
+    self.early_stopping = early_stopping
+
+  def get_max_len(self, src_length):
+    """
+    Args:
+      src_length: length of the source sequence (or a list containing the length), or None
+    Returns:
+      int: the maximum number of tokens to generate for this source
+    """
+    if self.rel_max_len is None or src_length is None:
+      return self.max_len
+    if isinstance(src_length, list):
+      src_length = src_length[0]
+    return max(1, min(self.max_len, int(math.ceil(self.rel_max_len * src_length))))
+
+  def prune_candidates(self, cands):
+    """
+    Discard candidates according to the relative and absolute thresholds.
 
-  def generate_output(self, translator, initial_state, src_length=None, forced_trg_ids=None):
-    # TODO(philip30): can only do single decoding, not batched
+    Args:
+      cands: list of Hypothesis objects
+    Returns:
+      list of remaining Hypothesis objects
+    """
+    if len(cands) == 0 or (self.rel_threshold is None and self.abs_threshold is None):
+      return cands
+    threshold = max(cand.score for cand in cands)
+    if self.abs_threshold is not None and self.rel_threshold is not None:
+      threshold -= min(self.abs_threshold, -math.log(self.rel_threshold))
+    elif self.abs_threshold is not None:
+      threshold -= self.abs_threshold
+    else:
+      threshold += math.log(self.rel_threshold)
+    return [cand for cand in cands if cand.score >= threshold]
+
+  def generate_output(self, translator, initial_state, src_length=None, forced_trg_ids=None,
+                      collect_loss_info=False):
+    # TODO(philip30): can only decode a single source sentence, not batched
     assert forced_trg_ids is None or self.beam_size == 1
-    active_hyp = [self.Hypothesis(0, None, None, None)]
+    max_len = self.get_max_len(src_length) if forced_trg_ids is None else self.max_len
+    num_top_words = self.beam_size if self.max_cands_per_parent is None \
+                                   else min(self.beam_size, self.max_cands_per_parent)
+    active_hyp = [self.Hypothesis(0, None, None, None, 0, 0)]
     completed_hyp = []
-    for length in range(self.max_len):
-      if len(completed_hyp) >= self.beam_size:
+    best_completed_score = None
+    for length in range(max_len):
+      if len(completed_hyp) >= self.beam_size or len(active_hyp) == 0:
         break
-      # Expand hyp
-      new_set = []
-      for hyp in active_hyp:
-        if length > 0:
-          prev_word = hyp.word
-          prev_state = hyp.output.state
-        else:
-          prev_word = None
-          prev_state = initial_state
-        if prev_word == Vocab.ES:
-          completed_hyp.append(hyp)
-          continue
+      # Expand all active hyps at once, with one batch element per hyp
+      if length > 0:
+        prev_word = [hyp.word for hyp in active_hyp]
+        prev_state = translator.decoder.select_batch_elems(active_hyp[0].output.state,
+                                                           [hyp.batch_id for hyp in active_hyp])
+      else:
+        prev_word = None
+        prev_state = initial_state
+      # Next Words
+      if forced_trg_ids is None and not collect_loss_info:
+        # let the decoder find the best words, which can be cheaper than computing the full distribution
+        current_output = translator.output_one_step(prev_word, prev_state, compute_logsoftmax=False)
+        top_words, top_scores = translator.decoder.best_k(current_output.state, num_top_words)
+      else:
         current_output = translator.output_one_step(prev_word, prev_state)
-        score = current_output.logsoftmax.npvalue().transpose()
-        # Next Words
+        score = current_output.logsoftmax.npvalue()
+        score = score.reshape((score.shape[0], -1))
         if forced_trg_ids is None:
-          top_words = np.argpartition(score, max(-len(score),-self.beam_size))[-self.beam_size:]
+          top_words = np.argpartition(score, max(-len(score),-num_top_words), axis=0)[-num_top_words:]
         else:
-          top_words = [forced_trg_ids[length]]
-        # Queue next states
-        for cur_word in top_words:
-          new_score = self.len_norm.normalize_partial(hyp.score, score[cur_word], length+1)
-          new_set.append(self.Hypothesis(new_score, current_output, hyp, cur_word))
+          top_words = np.full((1, score.shape[1]), forced_trg_ids[length])
+        top_scores = np.take_along_axis(score, top_words, axis=0)
+      # Queue next states
+      new_set = []
+      for batch_id, hyp in enumerate(active_hyp):
+        new_scores = self.len_norm.normalize_partial(hyp.score, top_scores[:, batch_id], length+1)
+        for cur_word, new_score in zip(top_words[:, batch_id], new_scores):
+          new_set.append(self.Hypothesis(new_score, current_output, hyp, cur_word, length+1, batch_id))
       # Next top hypothesis
-      active_hyp = sorted(new_set, key=lambda x: x.score, reverse=True)[:self.beam_size]
+      new_set = self.prune_candidates(new_set)
+      active_hyp = []
+      new_completed = []
+      for hyp in sorted(new_set, key=lambda x: x.score, reverse=True)[:self.beam_size]:
+        if hyp.word == Vocab.ES:
+          new_completed.append(hyp)
+        else:
+          active_hyp.append(hyp)
+      completed_hyp.extend(new_completed)
+      # Stop early if no active hyp can beat the best completed one
+      if self.early_stopping and len(new_completed) > 0:
+        new_best = max(self.len_norm.normalize_completed(new_completed, src_length))
+        if best_completed_score is None or new_best > best_completed_score:
+          best_completed_score = new_best
+      if self.early_stopping and best_completed_score is not None:
+        bounds = [self.len_norm.upper_bound_completed(hyp.score, length+1, max_len, src_length) for hyp in active_hyp]
+        if all(bound is not None and bound <= best_completed_score for bound in bounds):
+          break
     # There is no hyp reached </s>
     if len(completed_hyp) == 0:
       completed_hyp = active_hyp
@@ -171,14 +271,10 @@ class BeamSearch(Serializable, SearchStrategy):
       current = end_hyp
       while current.parent is not None:
         word_ids.append(current.word)
-        attentions.append(current.output.attention)
-        # TODO(philip30): This should probably be uncommented.
-        # These 2 statements are an overhead because it is need only for reinforce and minrisk
-        # Furthermore, the attentions is only needed for report.
-        # We should have a global flag to indicate whether this is needed or not?
-        # The global flag is modified if certain objects is instantiated.
-        #logsoftmaxes.append(dy.pick(current.output.logsoftmax, current.word))
-        #states.append(translator.get_nobp_state(current.output.state))
+        attentions.append(pick_batch_elems(current.output.attention, [current.batch_id]))
+        if collect_loss_info:
+          logsoftmaxes.append(dy.pick(dy.pick_batch_elems(current.output.logsoftmax, [current.batch_id]), current.word))
+          states.append(pick_batch_elems(translator.get_nobp_state(current.output.state), [current.batch_id]))
         current = current.parent
       results.append(SearchOutput([list(reversed(word_ids))], [list(reversed(attentions))],
                                   [score], list(reversed(logsoftmaxes)), list(reversed(states)), None))
@@ -187,11 +283,15 @@ class BeamSearch(Serializable, SearchStrategy):
 class SamplingSearch(Serializable, SearchStrategy):
   """
   Performs search based on the softmax probability distribution.
-  Similar to greedy searchol
-  
+  Similar to greedy search, but the next word is sampled instead of chosen greedily.
+
+  All samples are drawn at once: the decoder state and the encodings are copied ``sample_size`` times along the batch
+  dimension, so that each step of the search is a single batched operation. The result is split into one
+  :class:`SearchOutput` per sample.
+
   Args:
-    max_len (int):
-    sample_size (int): 
+    max_len (int): maximum number of tokens to generate
+    sample_size (int): number of samples to draw
   """
 
   yaml_tag = '!SamplingSearch'
@@ -202,234 +302,299 @@ class SamplingSearch(Serializable, SearchStrategy):
     self.sample_size = sample_size
 
   def generate_output(self, translator, initial_state,
-                      src_length=None, forced_trg_ids=None):
-    outputs = []
-    for k in range(self.sample_size):
-      if k == 0 and forced_trg_ids is not None:
-        outputs.append(self.sample_one(translator, initial_state, forced_trg_ids))
-      else:
-        outputs.append(self.sample_one(translator, initial_state))
-    return outputs
- 
-  # Words ids, attentions, score, logsoftmax, state
-  def sample_one(self, translator, initial_state, forced_trg_ids=None):
-    # Search variables
+                      src_length=None, forced_trg_ids=None, collect_loss_info=False):
+    """
+    Args:
+      translator (Translator): a translator
+      initial_state: initial decoder state
+      src_length (int): length of src sequence (not used)
+      forced_trg_ids: batch of word id sequences; if given, the first sample is forced to be this target sequence
+      collect_loss_info (bool): whether to collect the non-backpropagateable decoder states of each step
+    Returns:
+      List[SearchOutput]: one output per sample, each holding one sampled sequence per sentence
+    """
+    num_samples = self.sample_size
+    if forced_trg_ids is not None and not xnmt.batcher.is_batched(forced_trg_ids):
+      forced_trg_ids = [forced_trg_ids]
+    # batch element c*batch_size+b of the search holds sample c of sentence b
+    encodings = translator.attender.curr_sent
+    translator.attender.init_sent(encodings.tile_batch(num_samples))
+    current_state = translator.decoder.tile_state(initial_state, num_samples)
     current_words = None
-    current_state = initial_state
     done = None
-    # Outputs
-    logsofts = []
-    samples = []
-    states = []
-    attentions = []
-    masks = []
-    # Sample to the max length
+    logsofts, samples, states, attentions = [], [], [], []
     for length in range(self.max_len):
       translator_output = translator.output_one_step(current_words, current_state)
-      if forced_trg_ids is None:
-        sample = translator_output.logsoftmax.tensor_value().categorical_sample_log_prob().as_numpy()
-        if len(sample.shape) == 2:
-          sample = sample[0]
-      else:
-        sample = [forced_trg[length] if len(forced_trg) > length else Vocab.ES for forced_trg in forced_trg_ids]
-      logsoft = dy.pick_batch(translator_output.logsoftmax, sample)
+      sample = translator_output.logsoftmax.tensor_value().categorical_sample_log_prob().as_numpy().flatten().astype(int)
+      if forced_trg_ids is not None:
+        forced = [forced_trg[length] if len(forced_trg) > length else Vocab.ES for forced_trg in forced_trg_ids]
+        sample[:len(forced)] = forced
       if done is not None:
-        sample = [sample[i] if not done[i] else Vocab.ES for i in range(len(done))]
-        # masking for logsoftmax
-        mask = [1 if not done[i] else 0 for i in range(len(done))]
-        logsoft = dy.cmult(logsoft, dy.inputTensor(mask, batched=True))
-        masks.append(mask)
-      # Appending output
-      logsofts.append(logsoft)
+        sample = np.where(done, Vocab.ES, sample)
+      logsofts.append(dy.pick_batch(translator_output.logsoftmax, sample))
       samples.append(sample)
-      states.append(translator.get_nobp_state(translator_output.state))
+      if collect_loss_info:
+        states.append(translator.get_nobp_state(translator_output.state))
       attentions.append(translator_output.attention)
-      # Next time step
       current_words = sample
       current_state = translator_output.state
-      # Check done
-      done = [x == Vocab.ES for x in sample]
-      # Check if we are done.
-      if all(done):
+      done = sample == Vocab.ES
+      if np.all(done):
         break
-    # Packing output
-    scores = dy.esum(logsofts).npvalue()
-    masks.insert(0, [1 for _ in range(len(done))])
-    samples = np.stack(samples, axis=1)
-    return SearchOutput(samples, attentions, scores, logsofts, states, masks)
+    translator.attender.init_sent(encodings)
+    # a step is masked out once the sample has produced an EOS at an earlier step
+    samples = np.stack(samples)
+    masks = np.ones(samples.shape)
+    masks[1:] = np.cumsum(samples == Vocab.ES, axis=0)[:-1] == 0
+    logsofts = dy.cmult(dy.concatenate(logsofts), dy.inputTensor(masks, batched=True))
+    scores = logsofts.npvalue().reshape(samples.shape).sum(axis=0)
+    return [self.split_sample(k, samples, logsofts, attentions, states, masks, scores)
+            for k in range(num_samples)]
+
+  def split_sample(self, k, samples, logsofts, attentions, states, masks, scores):
+    """
+    Args:
+      k (int): sample index
+      samples: array of sampled word ids, of dimensions seq_len x (num_samples * batch_size)
+      logsofts: log probabilities of the sampled words, of dimension seq_len and batch size num_samples * batch_size
+      attentions: list of attention vectors, one per step
+      states: list of decoder states, one per step, or empty list
+      masks: array of masks, of same dimensions as ``samples``
+      scores: array of sample scores, of dimension num_samples * batch_size
+    Returns:
+      SearchOutput: the k-th sample of each sentence
+    """
+    batch_size = samples.shape[1] // self.sample_size
+    batch_ids = list(range(k * batch_size, (k + 1) * batch_size))
+    sample_logsofts = dy.pick_batch_elems(logsofts, batch_ids)
+    return SearchOutput(np.transpose(samples[:, batch_ids]),
+                        [pick_batch_elems(attention, batch_ids) for attention in attentions],
+                        scores[batch_ids],
+                        [dy.pick(sample_logsofts, length) for length in range(len(samples))],
+                        [pick_batch_elems(state, batch_ids) for state in states],
+                        list(masks[:, batch_ids]))
 
 
 class MctsNode:
-  def __init__(self, parent, prior_dist, word, attention, translator, dec_state):
+  """
+  A node of the MCTS search tree, representing the prefix that ends with ``word``.
+
+  Statistics of the children are kept in arrays over the whole vocabulary, so that the UCT priorities of all possible
+  moves are computed at once. The arrays are only allocated once the node is expanded.
+
+  Args:
+    parent (MctsNode): parent node, or None for the root
+    prior_dist: numpy array of log probabilities of the next word
+    word (int): last word of the prefix, or None for the root
+    attention: attention vector used to predict the next word
+    dec_state: decoder state after reading the prefix (not batched)
+  """
+  def __init__(self, parent, prior_dist, word, attention, dec_state):
     self.parent = parent
     self.prior_dist = prior_dist  # log of softmax
     self.word = word
     self.attention = attention
-
-    self.translator = translator
     self.dec_state = dec_state
+    self.depth = 0 if parent is None else parent.depth + 1
 
     self.tries = 0
     self.avg_value = 0.0
     self.children = {}
+    self.child_tries = None
+    self.child_values = None
+    self.prior_weights = None
+    # moves that are already being expanded in the current batch of leaves
+    self.pending_moves = set()
 
     # If the child is unvisited, set its avg_value to
     # parent value - reduction where reduction = c * sqrt(sum of scores of all visited children)
     # where c is 0.25 in leela
     self.reduction = 0.0
 
+  def is_terminal(self, max_len):
+    return self.word == Vocab.ES or self.depth >= max_len
+
+  def compute_priorities(self):
+    """
+    Returns:
+      numpy array of the UCT priorities of all possible next words
+    """
+    if self.child_tries is None:
+      self.child_tries = np.zeros(self.prior_dist.shape)
+      self.child_values = np.zeros(self.prior_dist.shape)
+      K = 5.0
+      self.prior_weights = K * np.exp(self.prior_dist)
+    child_val = self.prior_dist + np.where(self.child_tries > 0, self.child_values, self.avg_value - self.reduction)
+    exp_term = math.sqrt(1.0 * self.tries + 1.0) / (self.child_tries + 1) * self.prior_weights
+    return child_val + exp_term
+
   def choose_child(self):
-    return max(range(len(self.prior_dist)),
-               key=lambda move: self.compute_priority(move))
+    priorities = self.compute_priorities()
+    if self.pending_moves:
+      priorities[list(self.pending_moves)] = -np.inf
+    return int(np.argmax(priorities))
 
-  def compute_priority(self, move):
-    if move not in self.children:
-      child_val = self.prior_dist[move] + self.avg_value - self.reduction
-      child_tries = 0
-    else:
-      child_val = self.prior_dist[move] + self.children[move].avg_value
-      child_tries = self.children[move].tries
-
-    K = 5.0
-    exp_term = math.sqrt(1.0 * self.tries + 1.0) / (child_tries + 1)
-    # TODO: This exp could be done before the prior is passed into the MctsNode
-    # so it's done as a big batch
-    exp_term *= K * math.exp(self.prior_dist[move])
-    total_value = child_val + exp_term
-    return total_value
-
-  def expand(self):
-    if self.word == Vocab.ES:
-      return self
-
-    move = self.choose_child()
-    if move in self.children:
-      return self.children[move].expand()
-    else:
-      output = self.translator.output_one_step(move, self.dec_state)
-      prior_dist = output.logsoftmax.npvalue()
-      attention = output.attention
-
-      path = []
-      node = self
-      while node is not None:
-        path.append(node.word)
-        node = node.parent
-      path = ' '.join(str(word) for word in reversed(path))
-      print('Creating new node:', path, '+', move)
-      new_node = MctsNode(self, prior_dist, move, attention,
-                          self.translator, output.state)
-      self.children[move] = new_node
-      return new_node
-
-  def rollout(self, sample_func, max_len):
-    prefix = []
-    scores = []
-    prev_word = None
-    dec_state = self.dec_state
-
-    if self.word == Vocab.ES:
-      return prefix, scores
-
-    while True:
-      output = self.translator.output_one_step(prev_word, dec_state)
-      logsoftmax = output.logsoftmax.npvalue()
-      attention = output.attention
-      best_id = sample_func(logsoftmax)
-      print("Rolling out node with word=", best_id, 'score=', logsoftmax[best_id])
-
-      prefix.append(best_id)
-      scores.append(logsoftmax[best_id])
-
-      if best_id == Vocab.ES or len(prefix) >= max_len:
-        break
-      prev_word = best_id
-      dec_state = output.state
-    return prefix, scores
+  def select_leaf(self, max_len):
+    """
+    Descend the tree along the children of highest priority.
+
+    Args:
+      max_len (int): maximum length of a prefix
+    Returns:
+      Tuple of the node where the descent ended and the move to expand from it, or None if the node is terminal
+    """
+    node = self
+    while not node.is_terminal(max_len):
+      move = node.choose_child()
+      if move not in node.children:
+        return node, move
+      node = node.children[move]
+    return node, None
 
   def backup(self, result):
-    print('Backing up', result)
     self.avg_value = self.avg_value * (self.tries / (self.tries + 1)) + result / (self.tries + 1)
     self.tries += 1
     if self.parent is not None:
+      self.parent.child_tries[self.word] = self.tries
+      self.parent.child_values[self.word] = self.avg_value
       my_prob = self.parent.prior_dist[self.word]
       self.parent.backup(result + my_prob)
 
-  def collect(self, words, attentions):
-    if self.word is not None:
-      words.append(self.word)
-      attentions.append(self.attention)
+  def collect(self, words, attentions, scores):
+    """
+    Collect the most visited path below this node.
+
+    Args:
+      words: list to which the words of the path are appended
+      attentions: list to which the attention vectors used to predict these words are appended
+      scores: list to which the log probabilities of these words are appended
+    """
     if len(self.children) > 0:
-      best_child = max(self.children.itervalues(), key=lambda child: child.visits)
-      best_child.collect(words, attentions)
+      best_child = max(self.children.values(), key=lambda child: child.tries)
+      words.append(best_child.word)
+      attentions.append(self.attention)
+      scores.append(self.prior_dist[best_child.word])
+      best_child.collect(words, attentions, scores)
 
 
 def random_choice(logsoftmax):
-  #logsoftmax *= 100
-  probs = np.exp(logsoftmax)
-  probs /= sum(probs)
-  choices = np.random.choice(len(probs), 1, p=probs)
-  return choices[0]
+  """
+  Args:
+    logsoftmax: numpy array of log probabilities of dimensions vocab_size or vocab_size x batch_size
+  Returns:
+    sampled word id, or array of one sampled word id per batch element
+  """
+  # Gumbel-max trick: adding Gumbel noise and taking the argmax samples from the softmax distribution
+  return np.argmax(logsoftmax - np.log(-np.log(np.random.uniform(size=logsoftmax.shape))), axis=0)
 
 
 def greedy_choice(logsoftmax):
-  return np.argmax(logsoftmax)
+  return np.argmax(logsoftmax, axis=0)
 
 
 class MctsSearch(Serializable, SearchStrategy):
-  '''
-  Performs search with Monte Carlo Tree Search
-  '''
+  """
+  Performs search with Monte Carlo Tree Search.
+
+  Each step of the search selects several leaves by descending the tree according to the UCT priorities, expands all
+  of them with a single batched decoder step, and rolls out a sample from each new node, again batched over all
+  nodes. The rollout scores are then backed up along the paths. The search stops once the visit budget or the time
+  budget is used up, and the most visited path is returned.
+
+  Args:
+    visits (int): maximum number of leaves to visit; None for no limit (requires ``time_budget``)
+    max_len (int): maximum number of tokens to generate
+    time_budget (float): maximum number of seconds to search per sentence; None for no limit
+    leaves_per_step (int): number of leaves to expand and roll out in one batched step
+  """
   yaml_tag = '!MctsSearch'
 
   @serializable_init
-  def __init__(self, visits=200, max_len=100):
+  def __init__(self, visits=200, max_len=100, time_budget=None, leaves_per_step=8):
+    if visits is None and time_budget is None:
+      raise ValueError("MctsSearch requires a visit budget or a time budget")
     self.max_len = max_len
     self.visits = visits
+    self.time_budget = time_budget
+    self.leaves_per_step = leaves_per_step
 
-  def generate_output(self, translator, dec_state, src_length=None, forced_trg_ids=None):
+  def generate_output(self, translator, dec_state, src_length=None, forced_trg_ids=None,
+                      collect_loss_info=False):
     assert forced_trg_ids is None
-    orig_dec_state = dec_state
-
     output = translator.output_one_step(None, dec_state)
-    dec_state = output.state
-    assert dec_state == orig_dec_state
-    logsoftmax = output.logsoftmax.npvalue()
-    root_node = MctsNode(None, logsoftmax, None, None, translator, dec_state)
-    for i in range(self.visits):
-      terminal = root_node.expand()
-      words, scores = terminal.rollout(random_choice, self.max_len)
-      terminal.backup(sum(scores))
-      print()
-
-    print('Final stats:')
-    for word in root_node.children:
-      print (word, root_node.compute_priority(word), root_node.prior_dist[word] + root_node.children[word].avg_value, root_node.children[word].tries)
-    print()
-
-    scores = []
-    logsoftmaxes = []
-    word_ids = []
-    attentions = []
-    states = []
-    masks = []
-
-    node = root_node
-    while True:
-      if len(node.children) == 0:
-        break
-      best_word = max(node.children, key=lambda word: node.children[word].tries)
-      score = node.prior_dist[best_word]
-      attention = node.children[best_word].attention
-
-      scores.append(score)
-      logsoftmaxes.append(node.prior_dist)
-      word_ids.append(best_word)
-      attentions.append(attention)
-      states.append(node.dec_state)
-      masks.append(1)
+    root_node = MctsNode(None, output.logsoftmax.npvalue().flatten(), None, output.attention, output.state)
+    start_time = time.time()
+    num_visits = 0
+    while (self.visits is None or num_visits < self.visits) \
+            and (self.time_budget is None or time.time() - start_time < self.time_budget):
+      num_leaves = self.leaves_per_step if self.visits is None \
+                   else min(self.leaves_per_step, self.visits - num_visits)
+      self.visit_leaves(translator, root_node, num_leaves)
+      num_visits += num_leaves
+
+    word_ids, attentions, scores = [], [], []
+    root_node.collect(word_ids, attentions, scores)
+    masks = [np.ones(1) for _ in word_ids]
+    return [SearchOutput(np.array([word_ids], dtype=int), attentions, np.array([sum(scores)]), [], [], masks)]
+
+  def visit_leaves(self, translator, root_node, num_leaves):
+    """
+    Select, expand, roll out and back up several leaves at once.
 
-      node = node.children[best_word]
+    Args:
+      translator (Translator): a translator
+      root_node (MctsNode): root of the search tree
+      num_leaves (int): number of leaves to select
+    """
+    terminal_nodes, expansions = [], []
+    for _ in range(num_leaves):
+      node, move = root_node.select_leaf(self.max_len)
+      if move is None:
+        terminal_nodes.append(node)
+      else:
+        # excluding pending moves from further selections makes all expanded leaves distinct
+        node.pending_moves.add(move)
+        expansions.append((node, move))
+    for node in terminal_nodes:
+      node.backup(0.0)
+    if not expansions:
+      return
+    dec_state = translator.decoder.concatenate_states([node.dec_state for node, _ in expansions])
+    output = translator.output_one_step([move for _, move in expansions], dec_state)
+    logsoftmax = output.logsoftmax.npvalue().reshape((-1, len(expansions)))
+    children = []
+    for i, (node, move) in enumerate(expansions):
+      node.pending_moves.clear()
+      node.children[move] = MctsNode(node, logsoftmax[:, i], move, pick_batch_elems(output.attention, [i]),
+                                     translator.decoder.select_batch_elems(output.state, [i]))
+      children.append(node.children[move])
+    results = self.rollout(translator, output.state, logsoftmax, children)
+    for child, result in zip(children, results):
+      child.backup(result)
+
+  def rollout(self, translator, dec_state, logsoftmax, nodes):
+    """
+    Sample a completion for each of the given nodes, as one batched search.
 
-    word_ids = np.expand_dims(word_ids, axis=0)
-    return [SearchOutput(word_ids, attentions, scores, logsoftmaxes, states, masks)]
+    Args:
+      translator (Translator): a translator
+      dec_state: decoder state of the nodes, batched in the same order as ``nodes``
+      logsoftmax: numpy array of log probabilities of the next word, of dimensions vocab_size x number of nodes
+      nodes: list of nodes to roll out
+    Returns:
+      numpy array of the log probabilities of the sampled completions
+    """
+    remaining = np.array([0 if node.is_terminal(self.max_len) else self.max_len - node.depth for node in nodes])
+    scores = np.zeros((len(nodes),))
+    done = remaining <= 0
+    length = 0
+    while not np.all(done):
+      words = random_choice(logsoftmax)
+      scores += np.where(done, 0.0, logsoftmax[words, np.arange(len(nodes))])
+      length += 1
+      done |= (words == Vocab.ES) | (length >= remaining)
+      if not np.all(done):
+        output = translator.output_one_step(words, dec_state)
+        logsoftmax = output.logsoftmax.npvalue().reshape((-1, len(nodes)))
+        dec_state = output.state
+    return scores
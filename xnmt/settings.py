@@ -6,6 +6,7 @@ Currently, settings control the following:
 * OVERWRITE_LOG: whether logs should be overwritten (not overwriting helps when copy-pasting config files and forgetting to change the output location)
 * IMMEDIATE_COMPUTE: whether to execute DyNet in eager mode
 * CHECK_VALIDITY: configure DyNet to perform numerical checks
+* CHECK_INPUTS: perform (potentially slow) consistency checks on the inputs of loss computations
 * RESOURCE_WARNINGS: whether to show resource warnings
 * LOG_LEVEL_CONSOLE: verbosity of console output (DEBUG|INFO|WARNING|ERROR|CRITICAL)
 * LOG_LEVEL_FILE: verbosity of file output (DEBUG|INFO|WARNING|ERROR|CRITICAL)
@@ -32,6 +33,7 @@ class Standard(object):
   OVERWRITE_LOG = False
   IMMEDIATE_COMPUTE = False
   CHECK_VALIDITY = False
+  CHECK_INPUTS = False
   RESOURCE_WARNINGS = False
   LOG_LEVEL_CONSOLE = "INFO"
   LOG_LEVEL_FILE = "DEBUG"
@@ -45,6 +47,7 @@ class Debug(Standard):
   OVERWRITE_LOG = True
   IMMEDIATE_COMPUTE = True
   CHECK_VALIDITY = True
+  CHECK_INPUTS = True
   RESOURCE_WARNINGS = True
   LOG_LEVEL_CONSOLE = "DEBUG"
   LOG_LEVEL_FILE = "DEBUG"
@@ -54,6 +57,7 @@ class Unittest(Standard):
   More checks and less verbosity, activated automatically when running the unit tests from the "test" package.
   """
   OVERWRITE_LOG = True
+  CHECK_INPUTS = True
   RESOURCE_WARNINGS = True
   LOG_LEVEL_CONSOLE = "WARNING"
 
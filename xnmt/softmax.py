@@ -0,0 +1,214 @@
+import itertools
+import math
+
+import numpy as np
+import dynet as dy
+
+import xnmt.batcher
+from xnmt.constants import INFINITY
+from xnmt.param_collection import ParamManager
+from xnmt.param_init import GlorotInitializer, ZeroInitializer
+from xnmt.persistence import serializable_init, Serializable, Ref, bare
+
+class ClassFactoredSoftmax(Serializable):
+  """
+  Class-factored (two-level) softmax.
+
+  The vocabulary is partitioned into word classes, and the probability of a word is factored into the probability of
+  its class and the probability of the word given its class (Goodman, 2001, https://arxiv.org/pdf/cs/0108006.pdf).
+  Words are sorted by frequency and binned into classes of equal size, so that frequent words share classes. With
+  about sqrt(V) classes of about sqrt(V) words each, the loss of a reference word costs O(sqrt(V)) instead of O(V),
+  and the most probable words can be found by expanding only the most probable classes.
+
+  This is meant to be used as the ``output_projector`` of the :class:`xnmt.mlp.MLP` of a
+  :class:`xnmt.decoder.MlpSoftmaxDecoder`, which then uses :meth:`calc_loss` and :meth:`best_k` where possible.
+  Calling the object directly returns log probabilities over the full vocabulary, so that it can also be used wherever
+  full scores are required (applying another log softmax leaves them unchanged).
+
+  Args:
+    input_dim (int): input dimension
+    vocab_size (int): vocab size or None
+    vocab (Vocab): vocab or None
+    trg_reader (InputReader): Model's trg_reader, if exists and unambiguous
+    num_classes (int): number of word classes; defaults to the square root of the vocab size
+    word_ranking (List[int]): word ids, sorted by descending frequency
+    train_trg_file (str): target side of the training data, used to compute ``word_ranking`` if not given. If neither
+                          is given, word ids are assumed to be sorted by frequency already.
+    param_init (ParamInitializer): how to initialize weight matrices
+    bias_init (ParamInitializer): how to initialize bias vectors
+  """
+  yaml_tag = '!ClassFactoredSoftmax'
+
+  @serializable_init
+  def __init__(self,
+               input_dim=Ref("exp_global.default_layer_dim"),
+               vocab_size=None,
+               vocab=None,
+               trg_reader=Ref("model.trg_reader", default=None),
+               num_classes=None,
+               word_ranking=None,
+               train_trg_file=None,
+               param_init=Ref("exp_global.param_init", default=bare(GlorotInitializer)),
+               bias_init=Ref("exp_global.bias_init", default=bare(ZeroInitializer))):
+    self.input_dim = input_dim
+    self.vocab_size = self.choose_vocab_size(vocab_size, vocab, trg_reader)
+    self.save_processed_arg("vocab_size", self.vocab_size)
+    if word_ranking is None:
+      if train_trg_file is not None:
+        word_ranking = self.rank_words(trg_reader, train_trg_file)
+        self.save_processed_arg("word_ranking", word_ranking)
+        self.save_processed_arg("train_trg_file", None)
+      else:
+        word_ranking = list(range(self.vocab_size))
+    if num_classes is None:
+      num_classes = int(math.ceil(math.sqrt(self.vocab_size)))
+    self.class_size = int(math.ceil(self.vocab_size / num_classes))
+    self.num_classes = int(math.ceil(self.vocab_size / self.class_size))
+
+    # words occupy slots in order of frequency; slot c*class_size+i holds the i-th word of class c
+    self.word_slots = np.empty((self.vocab_size,), dtype=int)
+    self.word_slots[word_ranking] = np.arange(self.vocab_size)
+    self.word_classes = self.word_slots // self.class_size
+    self.word_positions = self.word_slots % self.class_size
+    slot_words = np.full((self.num_classes * self.class_size,), -1, dtype=int)
+    slot_words[:self.vocab_size] = word_ranking
+    self.slot_words = slot_words.reshape((self.num_classes, self.class_size))
+    # excludes the unused slots of the last class from the softmax, of dimensions class_size x num_classes
+    self.pad_bias = np.where(self.slot_words >= 0, 0.0, -INFINITY).transpose()
+
+    model = ParamManager.my_params(self)
+    self.W_class = model.add_parameters((self.num_classes, input_dim),
+                                        init=param_init.initializer((self.num_classes, input_dim)))
+    self.b_class = model.add_parameters((self.num_classes,), init=bias_init.initializer((self.num_classes,)))
+    self.W_word = model.add_lookup_parameters((self.num_classes, self.class_size, input_dim),
+                                              init=param_init.initializer((self.class_size, input_dim)))
+    self.b_word = model.add_lookup_parameters((self.num_classes, self.class_size),
+                                              init=bias_init.initializer((self.class_size,)))
+
+  def choose_vocab_size(self, vocab_size, vocab, trg_reader):
+    """Choose the vocab size based on the passed arguments
+
+    This is done in order of priority of vocab_size, vocab, trg_reader
+
+    Args:
+      vocab_size (int): vocab size or None
+      vocab (Vocab): vocab or None
+      trg_reader (InputReader): Model's trg_reader, if exists and unambiguous.
+
+    Returns:
+      int: chosen vocab size
+    """
+    if vocab_size is not None:
+      return vocab_size
+    elif vocab is not None:
+      return len(vocab)
+    elif trg_reader is None or trg_reader.vocab is None:
+      raise ValueError("Could not determine the softmax's vocab size. Please set its vocab_size or vocab member explicitly, or specify the vocabulary of trg_reader ahead of time.")
+    else:
+      return len(trg_reader.vocab)
+
+  def rank_words(self, trg_reader, train_trg_file):
+    """
+    Args:
+      trg_reader (InputReader): reader for the target side
+      train_trg_file (str): target side of the training data
+    Returns:
+      list of word ids, sorted by descending frequency in the training data
+    """
+    word_ids = np.fromiter(itertools.chain.from_iterable(sent.words for sent in trg_reader.read_sents(train_trg_file)),
+                           dtype=int)
+    counts = np.bincount(word_ids, minlength=self.vocab_size)[:self.vocab_size]
+    return np.argsort(-counts, kind='stable').tolist()
+
+  def __call__(self, input_expr):
+    W = dy.reshape(dy.transpose(dy.parameter(self.W_word), [0, 2, 1]),
+                   (self.class_size * self.num_classes, self.input_dim))
+    b = dy.reshape(dy.parameter(self.b_word), (self.class_size * self.num_classes,))
+    word_scores = dy.reshape(dy.affine_transform([b, W, input_expr]), (self.class_size, self.num_classes)) \
+                  + dy.inputTensor(self.pad_bias)
+    log_probs = dy.colwise_add(dy.transpose(dy.log_softmax(word_scores)), self.calc_class_log_probs(input_expr))
+    log_probs = dy.reshape(dy.transpose(log_probs), (self.class_size * self.num_classes, 1))
+    return dy.reshape(dy.select_rows(log_probs, self.word_slots.tolist()), (self.vocab_size,))
+
+  def calc_class_log_probs(self, input_expr):
+    """
+    Args:
+      input_expr: input expression, possibly batched
+    Returns:
+      log probabilities of the word classes
+    """
+    return dy.log_softmax(dy.affine_transform([dy.parameter(self.b_class), dy.parameter(self.W_class), input_expr]))
+
+  def calc_word_scores(self, input_expr, classes):
+    """
+    Args:
+      input_expr: input expression, batched with the same batch size as ``classes`` or unbatched
+      classes: list of class ids, one per batch element
+    Returns:
+      batched unnormalized scores of the words within each class, with unused slots set to -INFINITY
+    """
+    return dy.affine_transform([dy.lookup_batch(self.b_word, classes), dy.lookup_batch(self.W_word, classes),
+                                input_expr]) \
+           + dy.inputTensor(self.pad_bias[:, classes], batched=True)
+
+  def calc_loss(self, input_expr, ref_action):
+    """
+    Args:
+      input_expr: input expression, possibly batched
+      ref_action: reference word id, or batch of word ids
+    Returns:
+      batched negative log probabilities of the reference words
+    """
+    ref_ids = np.asarray(ref_action if xnmt.batcher.is_batched(ref_action) else [ref_action], dtype=int)
+    classes = self.word_classes[ref_ids].tolist()
+    class_loss = dy.pickneglogsoftmax_batch(
+      dy.affine_transform([dy.parameter(self.b_class), dy.parameter(self.W_class), input_expr]), classes)
+    word_loss = dy.pickneglogsoftmax_batch(self.calc_word_scores(input_expr, classes),
+                                           self.word_positions[ref_ids].tolist())
+    return class_loss + word_loss
+
+  def best_k(self, input_expr, k):
+    """
+    Find the k most probable words, expanding classes in order of their probability until no unexpanded class can
+    contain a better word than the k-th best one found so far.
+
+    The classes expanded in each round are scored with a single batched lookup, for all batch elements at once.
+
+    Args:
+      input_expr: input expression, possibly batched
+      k (int): number of words to return
+    Returns:
+      Tuple of numpy arrays of word ids and their log probabilities, of dimensions k x batch_size, in no particular
+      order
+    """
+    class_log_probs = self.calc_class_log_probs(input_expr).npvalue().reshape((self.num_classes, -1))
+    batch_size = class_log_probs.shape[1]
+    class_order = np.argsort(-class_log_probs, axis=0)
+    k = min(k, self.vocab_size)
+    best_words = [np.zeros((0,), dtype=int) for _ in range(batch_size)]
+    best_scores = [np.zeros((0,)) for _ in range(batch_size)]
+    num_expanded = np.zeros((batch_size,), dtype=int)
+    # the k best words are spread over at least this many classes
+    num_to_expand = np.full((batch_size,), min(self.num_classes, int(math.ceil(k / self.class_size))))
+    while num_to_expand.any():
+      batch_ids = np.repeat(np.arange(batch_size), num_to_expand)
+      ranks = np.concatenate([np.arange(num_expanded[b], num_expanded[b] + num_to_expand[b])
+                              for b in range(batch_size)])
+      classes = class_order[ranks, batch_ids]
+      x = input_expr if batch_size == 1 else dy.pick_batch_elems(input_expr, batch_ids.tolist())
+      word_log_probs = dy.log_softmax(self.calc_word_scores(x, classes.tolist())).npvalue()
+      word_log_probs = word_log_probs.reshape((self.class_size, -1)) + class_log_probs[classes, batch_ids]
+      for i, (b, class_id) in enumerate(zip(batch_ids, classes)):
+        in_class = self.slot_words[class_id] >= 0
+        best_words[b] = np.concatenate([best_words[b], self.slot_words[class_id][in_class]])
+        best_scores[b] = np.concatenate([best_scores[b], word_log_probs[in_class, i]])
+      num_expanded += num_to_expand
+      for b in range(batch_size):
+        if len(best_scores[b]) > k:
+          top = np.argpartition(best_scores[b], -k)[-k:]
+          best_words[b], best_scores[b] = best_words[b][top], best_scores[b][top]
+        # the log probability of a word is at most that of its class
+        num_to_expand[b] = num_expanded[b] < self.num_classes \
+                           and (len(best_scores[b]) < k
+                                or class_log_probs[class_order[num_expanded[b], b], b] > best_scores[b].min())
+    return np.stack(best_words, axis=1), np.stack(best_scores, axis=1)
@@ -25,7 +25,7 @@ class ReverseTimeDistributed(object):
 
 class LinearSent(object):
   def __init__(self, dy_model, input_dim, output_dim):
-    self.L = Linear(input_dim, output_dim, dy_model, param_init=LeCunUniformInitializer(), bias_init=LeCunUniformInitializer())
+    self.L = Linear(input_dim, output_dim, param_init=LeCunUniformInitializer(), bias_init=LeCunUniformInitializer())
 
   def __call__(self, input_expr, reconstruct_shape=True, timedistributed=False):
     if not timedistributed:
@@ -42,7 +42,7 @@ class LinearSent(object):
 
 class LinearNoBiasSent(object):
   def __init__(self, dy_model, input_dim, output_dim):
-    self.L = Linear(input_dim, output_dim, dy_model, bias=False, param_init=LeCunUniformInitializer(), bias_init=LeCunUniformInitializer())
+    self.L = Linear(input_dim, output_dim, bias=False, param_init=LeCunUniformInitializer(), bias_init=LeCunUniformInitializer())
     self.output_dim = output_dim
 
   def __call__(self, input_expr):
@@ -69,67 +69,102 @@ class LayerNorm(object):
     return ReverseTimeDistributed()(output, seq_len, batch_size)
 
 
+def seq_len_of(X):
+  (dims, _) = X.dim()
+  return dims[1] if len(dims) > 1 else 1
+
+
+def make_attention_mask_exprs(mask, h):
+  """
+  Create the expressions for masking attention scores; these are created once and shared by all attention layers.
+
+  Args:
+    mask: numpy array of dimensions (batch, n_querys, n_keys), nonzero where attention is allowed
+    h: number of attention heads
+  Returns:
+    Tuple of mask and of values to add to masked scores, both of dimensions (n_querys, n_keys) x (batch * h), where
+    batch element b * h + i corresponds to head i of batch element b
+  """
+  mask = np.moveaxis(np.repeat(mask.astype(np.float32), h, axis=0), 0, 2)
+  return dy.inputTensor(mask, batched=True), dy.inputTensor((1. - mask) * MIN_VALUE, batched=True)
+
+
 class MultiHeadAttention(object):
   """ Multi Head Attention Layer for Sentence Blocks
+
+  Queries, keys and values are projected by a single matrix multiply. Heads are split off and merged by reshaping
+  the transposed projections, which moves the heads into the batch dimension.
   """
   def __init__(self, dy_model, n_units, h=1, attn_dropout=False):
     self.W_Q = LinearNoBiasSent(dy_model, n_units, n_units)
     self.W_K = LinearNoBiasSent(dy_model, n_units, n_units)
     self.W_V = LinearNoBiasSent(dy_model, n_units, n_units)
     self.finishing_linear_layer = LinearNoBiasSent(dy_model, n_units, n_units)
+    self.n_units = n_units
     self.h = h
     self.scale_score = 1. / (n_units / h) ** 0.5
     self.attn_dropout = attn_dropout
 
-  def split_rows(self, X, h):
-    (n_rows, _), batch = X.dim()
-    l = range(n_rows)
-    steps = n_rows // h
-    output = []
-    for i in range(0, n_rows, steps):
-      output.append(dy.pickrange(X, i, i + steps))
-    return output
+  def project(self, layers, X):
+    """
+    Apply several projections with a single matrix multiply.
 
-  def split_batch(self, X, h):
-    (n_rows, _), batch = X.dim()
-    l = range(batch)
-    steps = batch // h
-    output = []
-    for i in range(0, batch, steps):
-      indexes = l[i:i + steps]
-      output.append(dy.pick_batch_elems(X, indexes))
-    return output
+    Args:
+      layers: list of LinearNoBiasSent objects
+      X: expression of dimensions (n_units, seq_len) x batch
+    Returns:
+      list of projected expressions of dimensions (n_units, seq_len) x batch
+    """
+    W = dy.concatenate([dy.parameter(layer.L.W1) for layer in layers])
+    projected = W * X
+    return [dy.pickrange(projected, i * self.n_units, (i + 1) * self.n_units) for i in range(len(layers))]
+
+  def split_heads(self, X, seq_len, batch):
+    """
+    Args:
+      X: expression of dimensions (n_units, seq_len) x batch
+    Returns:
+      transposed heads, of dimensions (seq_len, n_units / h) x (batch * h)
+    """
+    return dy.reshape(dy.transpose(X), (seq_len, self.n_units // self.h), batch_size=batch * self.h)
+
+  def merge_heads(self, X, seq_len, batch):
+    """
+    Inverse of :meth:`split_heads`.
+
+    Args:
+      X: transposed heads, of dimensions (seq_len, n_units / h) x (batch * h)
+    Returns:
+      expression of dimensions (n_units, seq_len) x batch
+    """
+    return dy.transpose(dy.reshape(X, (seq_len, self.n_units), batch_size=batch))
 
   def set_dropout(self, dropout):
     self.dropout = dropout
 
   def __call__(self, x, z=None, mask=None):
-    h = self.h
+    """
+    Args:
+      x: queries, of dimensions (n_units, n_querys) x batch
+      z: keys and values, of dimensions (n_units, n_keys) x batch; if None, perform self-attention over x
+      mask: pair of mask expressions, as returned by :func:`make_attention_mask_exprs`
+    """
     if z is None:
-      Q = self.W_Q(x)
-      K = self.W_K(x)
-      V = self.W_V(x)
+      Q, K, V = self.project([self.W_Q, self.W_K, self.W_V], x)
+      z = x
     else:
-      Q = self.W_Q(x)
-      K = self.W_K(z)
-      V = self.W_V(z)
-
-    (n_units, n_querys), batch = Q.dim()
-    (_, n_keys), _ = K.dim()
+      Q, = self.project([self.W_Q], x)
+      K, V = self.project([self.W_K, self.W_V], z)
 
-    batch_Q = dy.concatenate_to_batch(self.split_rows(Q, h))
-    batch_K = dy.concatenate_to_batch(self.split_rows(K, h))
-    batch_V = dy.concatenate_to_batch(self.split_rows(V, h))
+    n_querys, n_keys, batch = seq_len_of(x), seq_len_of(z), x.dim()[1]
 
-    assert(batch_Q.dim() == (n_units // h, n_querys), batch * h)
-    assert(batch_K.dim() == (n_units // h, n_keys), batch * h)
-    assert(batch_V.dim() == (n_units // h, n_keys), batch * h)
+    batch_Q = self.split_heads(Q, n_querys, batch)
+    batch_K = self.split_heads(K, n_keys, batch)
+    batch_V = self.split_heads(V, n_keys, batch)
 
-    mask = np.concatenate([mask] * h, axis=0)
-    mask = np.moveaxis(mask, [1, 0, 2], [0, 2, 1])
-    mask = dy.inputTensor(mask, batched=True)
-    batch_A = (dy.transpose(batch_Q) * batch_K) * self.scale_score
-    batch_A = dy.cmult(batch_A, mask) + (1 - mask)*MIN_VALUE
+    mask_expr, masked_value = mask
+    batch_A = (batch_Q * dy.transpose(batch_K)) * self.scale_score
+    batch_A = dy.cmult(batch_A, mask_expr) + masked_value
 
     sent_len = batch_A.dim()[0][0]
     if sent_len == 1:
@@ -137,18 +172,15 @@ class MultiHeadAttention(object):
     else:
         batch_A = dy.softmax(batch_A, d=1)
 
-    batch_A = dy.cmult(batch_A, mask)
-    assert (batch_A.dim() == ((n_querys, n_keys), batch * h))
+    batch_A = dy.cmult(batch_A, mask_expr)
 
     if self.attn_dropout:
       if self.dropout != 0.0:
         batch_A = dy.dropout(batch_A, self.dropout)
 
-    batch_C = dy.transpose(batch_A * dy.transpose(batch_V))
-    assert (batch_C.dim() == ((n_units // h, n_querys), batch * h))
+    batch_C = batch_A * batch_V
 
-    C = dy.concatenate(self.split_batch(batch_C, h), d=0)
-    assert (C.dim() == ((n_units, n_querys), batch))
+    C = self.merge_heads(batch_C, n_querys, batch)
     C = self.finishing_linear_layer(C)
     return C
 
@@ -245,6 +277,7 @@ class TransformerEncoder(Serializable):
   def __init__(self, layers=1, input_dim=512, h=1,
                dropout=0.0, attn_dropout=False, layer_norm=False, **kwargs):
     dy_model = ParamManager.my_params(self)
+    self.h = h
     self.layer_names = []
     for i in range(1, layers + 1):
       name = 'l{}'.format(i)
@@ -264,6 +297,7 @@ class TransformerEncoder(Serializable):
     if self.dropout != 0.0:
       e = dy.dropout(e, self.dropout)  # Word Embedding Dropout
 
+    xx_mask = make_attention_mask_exprs(xx_mask, self.h)
     for name, layer in self.layer_names:
       layer.set_dropout(self.dropout)
       e = layer(e, xx_mask)
@@ -280,6 +314,7 @@ class TransformerDecoder(Serializable):
                vocab_size = None, vocab = None,
                trg_reader = Ref("model.trg_reader")):
     dy_model = ParamManager.my_params(self)
+    self.h = h
     self.layer_names = []
     for i in range(1, layers + 1):
       name = 'l{}'.format(i)
@@ -314,6 +349,8 @@ class TransformerDecoder(Serializable):
   def __call__(self, e, source, xy_mask, yy_mask):
     if self.dropout != 0.0:
       e = dy.dropout(e, self.dropout)  # Word Embedding Dropout
+    xy_mask = make_attention_mask_exprs(xy_mask, self.h)
+    yy_mask = make_attention_mask_exprs(yy_mask, self.h)
     for name, layer in self.layer_names:
       layer.set_dropout(self.dropout)
       e = layer(e, source, xy_mask, yy_mask)
@@ -11,7 +11,7 @@ from xnmt.settings import settings
 
 from xnmt.attender import MlpAttender
 from xnmt.batcher import Batch, mark_as_batch, is_batched
-from xnmt.decoder import MlpSoftmaxDecoder
+from xnmt.decoder import Decoder, MlpSoftmaxDecoder
 from xnmt.embedder import SimpleWordEmbedder
 from xnmt.events import register_xnmt_event_assign, handle_xnmt_event, register_xnmt_handler
 from xnmt.model_base import GeneratorModel, EventTrigger
@@ -20,12 +20,15 @@ from xnmt.input import Input, SimpleSentenceInput
 import xnmt.length_normalization
 from xnmt.loss import LossBuilder
 from xnmt.loss_calculator import LossCalculator
+from xnmt.linear import Linear
 from xnmt.lstm import BiLSTMSeqTransducer
+from xnmt.mlp import MLP
 from xnmt.output import TextOutput
 import xnmt.plot
 from xnmt.reports import Reportable
 from xnmt.persistence import serializable_init, Serializable, bare
 from xnmt.search_strategy import BeamSearch
+from xnmt.transducer import FinalTransducerState
 from collections import namedtuple
 from xnmt.vocab import Vocab
 from xnmt.constants import EPSILON
@@ -128,15 +131,54 @@ class DefaultTranslator(Translator, Serializable, Reportable, EventTrigger):
     self.report_path = kwargs.get("report_path", None)
     self.report_type = kwargs.get("report_type", None)
 
-  def calc_loss(self, src, trg, loss_calculator):
-    self.start_sent(src)
+  def _encode_src(self, src):
     embeddings = self.src_embedder.embed_sent(src)
     encodings = self.encoder(embeddings)
+    return encodings, self.encoder.get_final_states()
+
+  def _initial_state(self, src, encodings, enc_final_states):
     self.attender.init_sent(encodings)
     # Initialize the hidden state from the encoder
     ss = mark_as_batch([Vocab.SS] * len(src)) if is_batched(src) else Vocab.SS
-    initial_state = self.decoder.initial_state(self.encoder.get_final_states(), self.trg_embedder.embed(ss))
-    # Compose losses
+    return self.decoder.initial_state(enc_final_states, self.trg_embedder.embed(ss))
+
+  def calc_loss(self, src, trg, loss_calculator):
+    self.start_sent(src)
+    encodings, enc_final_states = self._encode_src(src)
+    initial_state = self._initial_state(src, encodings, enc_final_states)
+    return self._compose_loss(initial_state, src, trg, loss_calculator)
+
+  def calc_loss_shared_src(self, src, trgs, loss_calculator):
+    """
+    Calculate the losses of several targets for the same source sentence, e.g. for scoring an n-best list.
+
+    The source is encoded only once, as a batch of size 1. The attender broadcasts the encodings over the batch of all
+    targets, so that only the encoder final states, which initialize the decoder, are copied once per target.
+
+    Args:
+      src: a single (unbatched) source sentence
+      trgs: list of target sentences
+      loss_calculator: loss calculator
+    Returns:
+      LossBuilder: batched losses, with one batch element per target
+    """
+    src_batch = mark_as_batch([src])
+    trg_sents, trg_mask = xnmt.batcher.pad(trgs)
+    trg_batch = mark_as_batch(trg_sents, trg_mask)
+    self.start_sent(src_batch)
+    encodings, enc_final_states = self._encode_src(src_batch)
+    enc_final_states = [FinalTransducerState(self._broadcast_batch(state.main_expr(), len(trgs)),
+                                             self._broadcast_batch(state.cell_expr(), len(trgs)))
+                        for state in enc_final_states]
+    initial_state = self._initial_state(src_batch, encodings, enc_final_states)
+    return self._compose_loss(initial_state, src_batch, trg_batch, loss_calculator)
+
+  def _broadcast_batch(self, expr, batch_size):
+    if batch_size == 1:
+      return expr
+    return dy.concatenate_to_batch([expr] * batch_size)
+
+  def _compose_loss(self, initial_state, src, trg, loss_calculator):
     model_loss = LossBuilder()
     model_loss.add_loss("mle", loss_calculator(self, initial_state, src, trg))
 
@@ -164,11 +206,8 @@ class DefaultTranslator(Translator, Serializable, Reportable, EventTrigger):
     outputs = []
     for sents in src:
       self.start_sent(src)
-      embeddings = self.src_embedder.embed_sent(src)
-      encodings = self.encoder(embeddings)
-      self.attender.init_sent(encodings)
-      ss = mark_as_batch([Vocab.SS] * len(src)) if is_batched(src) else Vocab.SS
-      initial_state = self.decoder.initial_state(self.encoder.get_final_states(), self.trg_embedder.embed(ss))
+      encodings, enc_final_states = self._encode_src(src)
+      initial_state = self._initial_state(src, encodings, enc_final_states)
       search_outputs = search_strategy.generate_output(self, initial_state,
                                                        src_length=[len(sents)],
                                                        forced_trg_ids=forced_trg_ids)
@@ -224,7 +263,16 @@ class DefaultTranslator(Translator, Serializable, Reportable, EventTrigger):
     """
     self.reporting_src_vocab = src_vocab
 
-  def output_one_step(self, current_word, current_state):
+  def output_one_step(self, current_word, current_state, compute_logsoftmax=True):
+    """
+    Args:
+      current_word: word id or batch of word ids to feed into the decoder, or None to use the current state as is
+      current_state: current decoder state
+      compute_logsoftmax (bool): whether to compute the output distribution; if False, the ``logsoftmax`` of the
+                                 returned object is None, and the next words can be found via the decoder's ``best_k()``
+    Returns:
+      TranslatorOutput:
+    """
     if current_word is not None:
       if type(current_word) == int:
         current_word = [current_word]
@@ -235,7 +283,7 @@ class DefaultTranslator(Translator, Serializable, Reportable, EventTrigger):
     else:
       next_state = current_state
     next_state.context = self.attender.calc_context(next_state.rnn_state.output())
-    next_logsoftmax = self.decoder.get_scores_logsoftmax(next_state)
+    next_logsoftmax = self.decoder.get_scores_logsoftmax(next_state) if compute_logsoftmax else None
     return TranslatorOutput(next_state, next_logsoftmax, self.attender.get_last_attention())
 
   @register_xnmt_event_assign
@@ -329,6 +377,8 @@ class TransformerTranslator(Translator, Serializable, Reportable, EventTrigger):
     self.scale_emb = self.input_dim ** 0.5
     self.max_input_len = 500
     self.initialize_position_encoding(self.max_input_len, input_dim)  # TODO: parametrize this
+    self.max_cached_masks = 100
+    self.mask_cache = collections.OrderedDict()
 
   def initialize_generator(self, **kwargs):
     self.report_path = kwargs.get("report_path", None)
@@ -343,17 +393,43 @@ class TransformerTranslator(Translator, Serializable, Reportable, EventTrigger):
     """
     self.reporting_src_vocab = src_vocab
 
+  def get_cached_mask(self, key, create_mask):
+    """
+    Return a mask from the cache of masks that depend only on the batch shape, creating it if needed.
+
+    Cached masks are shared between batches and therefore read-only. The cache holds at most ``max_cached_masks``
+    masks, and the least recently used mask is discarded first.
+    """
+    if key in self.mask_cache:
+      self.mask_cache.move_to_end(key)
+    else:
+      mask = create_mask()
+      mask.flags.writeable = False
+      self.mask_cache[key] = mask
+      if len(self.mask_cache) > self.max_cached_masks:
+        self.mask_cache.popitem(last=False)
+    return self.mask_cache[key]
+
   def make_attention_mask(self, source_block, target_block):
-    mask = (target_block[:, None, :] <= 0) * (source_block[:, :, None] <= 0)
-    # (batch, source_length, target_length)
-    return mask
+    """
+    Args:
+      source_block: numpy array of dimensions (batch, source_length), nonzero for padded positions
+      target_block: numpy array of dimensions (batch, target_length), nonzero for padded positions
+    Returns:
+      boolean numpy array of dimensions (batch, source_length, target_length)
+    """
+    if not (source_block.any() or target_block.any()):
+      shape = source_block.shape + target_block.shape[1:]
+      return self.get_cached_mask(("attention", shape), lambda: np.ones(shape, dtype=bool))
+    return (target_block[:, None, :] <= 0) & (source_block[:, :, None] <= 0)
 
   def make_history_mask(self, block):
     batch, length = block.shape
-    arange = np.arange(length)
-    history_mask = (arange[None,] <= arange[:, None])[None,]
-    history_mask = np.broadcast_to(history_mask, (batch, length, length))
-    return history_mask
+    def create_mask():
+      arange = np.arange(length)
+      return arange[None,] <= arange[:, None]
+    history_mask = self.get_cached_mask(("history", length), create_mask)
+    return np.broadcast_to(history_mask[None,], (batch, length, length))
 
   def mask_embeddings(self, embeddings, mask):
     """
@@ -376,13 +452,24 @@ class TransformerTranslator(Translator, Serializable, Reportable, EventTrigger):
     signal = np.concatenate([np.sin(scaled_time), np.cos(scaled_time)], axis=1)
     signal = np.reshape(signal, [1, length, channels])
     self.position_encoding_block = np.transpose(signal, (0, 2, 1))
+    self.position_encoding_cache = {}
+
+  def get_position_encoding(self, length):
+    """
+    Returns:
+      contiguous float32 numpy array of dimensions (n_units, length) holding the position encoding
+    """
+    if length not in self.position_encoding_cache:
+      self.position_encoding_cache[length] = np.ascontiguousarray(self.position_encoding_block[0, :, :length],
+                                                                  dtype=np.float32)
+    return self.position_encoding_cache[length]
 
   def make_input_embedding(self, emb_block, length):
     if length > self.max_input_len:
       self.initialize_position_encoding(2 * length, self.input_dim)
       self.max_input_len = 2 * length
     emb_block = emb_block * self.scale_emb
-    emb_block += dy.inputTensor(self.position_encoding_block[0, :, :length])
+    emb_block += dy.inputTensor(self.get_position_encoding(length))
     return emb_block
 
   def sentence_block_embed(self, embed, x, mask):
@@ -403,9 +490,9 @@ class TransformerTranslator(Translator, Serializable, Reportable, EventTrigger):
     batch_size, src_len = src_words.shape
 
     if isinstance(src.mask, type(None)):
-      src_mask = np.zeros((batch_size, src_len), dtype=np.int)
+      src_mask = np.zeros((batch_size, src_len), dtype=bool)
     else:
-      src_mask = np.concatenate([np.zeros((batch_size, 1), dtype=np.int), src.mask.np_arr.astype(np.int)], axis=1)
+      src_mask = np.concatenate([np.zeros((batch_size, 1), dtype=bool), src.mask.np_arr.astype(bool)], axis=1)
 
     src_embeddings = self.sentence_block_embed(self.src_embedder.embeddings, src_words, src_mask)
     src_embeddings = self.make_input_embedding(src_embeddings, src_len)
@@ -414,9 +501,9 @@ class TransformerTranslator(Translator, Serializable, Reportable, EventTrigger):
     batch_size, trg_len = trg_words.shape
 
     if isinstance(trg.mask, type(None)):
-      trg_mask = np.zeros((batch_size, trg_len), dtype=np.int)
+      trg_mask = np.zeros((batch_size, trg_len), dtype=bool)
     else:
-      trg_mask = trg.mask.np_arr.astype(np.int)
+      trg_mask = trg.mask.np_arr.astype(bool)
 
     trg_embeddings = self.sentence_block_embed(self.trg_embedder.embeddings, trg_words, trg_mask)
     trg_embeddings = self.make_input_embedding(trg_embeddings, trg_len)
@@ -424,7 +511,7 @@ class TransformerTranslator(Translator, Serializable, Reportable, EventTrigger):
     xx_mask = self.make_attention_mask(src_mask, src_mask)
     xy_mask = self.make_attention_mask(trg_mask, src_mask)
     yy_mask = self.make_attention_mask(trg_mask, trg_mask)
-    yy_mask *= self.make_history_mask(trg_mask)
+    yy_mask = yy_mask & self.make_history_mask(trg_mask)
 
     z_blocks = self.encoder(src_embeddings, xx_mask)
     h_block = self.decoder(trg_embeddings, z_blocks, xy_mask, yy_mask)
@@ -436,7 +523,7 @@ class TransformerTranslator(Translator, Serializable, Reportable, EventTrigger):
       return logits
 
     ref_list = list(itertools.chain.from_iterable(map(lambda x: x.words, trg)))
-    concat_t_block = (1 - trg_mask.ravel()).reshape(-1) * np.array(ref_list)
+    concat_t_block = np.logical_not(trg_mask.ravel()) * np.array(ref_list)
     loss = self.decoder.output_and_loss(h_block, concat_t_block)
     return LossBuilder({"mle": loss})
 
@@ -499,16 +586,24 @@ class EnsembleTranslator(Translator, Serializable, EventTrigger):
     src_reader (InputReader): A reader for the source side.
     trg_reader (InputReader): A reader for the target side.
     inference (SimpleInference): The inference strategy used for this ensemble.
+    weights (List[float]): weights for the log-linear combination of the models' output distributions, one per model.
+                           Weights are rescaled to sum to 1. If not given, all models are weighted equally.
   '''
 
   yaml_tag = '!EnsembleTranslator'
 
   @register_xnmt_handler
   @serializable_init
-  def __init__(self, models, src_reader, trg_reader, inference=bare(SimpleInference)):
+  def __init__(self, models, src_reader, trg_reader, inference=bare(SimpleInference), weights=None):
     super().__init__(src_reader=src_reader, trg_reader=trg_reader)
     self.models = models
     self.inference = inference
+    if weights is not None:
+      if len(weights) != len(models):
+        raise ValueError(f"expected one ensemble weight per model, got {len(weights)} weights for {len(models)} models")
+      if any(weight < 0 for weight in weights) or sum(weights) <= 0:
+        raise ValueError(f"ensemble weights must be non-negative and not all zero, got {weights}")
+    self.weights = weights
 
     # perform checks to verify the models can logically be ensembled
     for i, model in enumerate(self.models):
@@ -525,7 +620,7 @@ class EnsembleTranslator(Translator, Serializable, EventTrigger):
       EnsembleListDelegate([model.encoder for model in self.models]),
       EnsembleListDelegate([model.attender for model in self.models]),
       EnsembleListDelegate([model.trg_embedder for model in self.models]),
-      EnsembleDecoder([model.decoder for model in self.models])
+      EnsembleDecoder([model.decoder for model in self.models], weights=self.weights)
     )
 
   def shared_params(self):
@@ -598,10 +693,13 @@ class EnsembleListDelegate(object):
     attrs = [getattr(obj, attr) for obj in self._objects]
     if callable(attrs[0]):
       def wrapper_func(*args, **kwargs):
-        ret = []
-        for i, attr_ in enumerate(attrs):
-          args_i, kwargs_i = unwrap(i, args, kwargs)
-          ret.append(attr_(*args_i, **kwargs_i))
+        if any(isinstance(arg, EnsembleListDelegate) for arg in itertools.chain(args, kwargs.values())):
+          ret = []
+          for i, attr_ in enumerate(attrs):
+            args_i, kwargs_i = unwrap(i, args, kwargs)
+            ret.append(attr_(*args_i, **kwargs_i))
+        else:
+          ret = [attr_(*args, **kwargs) for attr_ in attrs]
         if all(val is None for val in ret):
           return None
         else:
@@ -630,11 +728,64 @@ class EnsembleDecoder(EnsembleListDelegate):
   Auxiliary object to wrap a list of decoders for ensembling.
 
   This behaves like an EnsembleListDelegate, except that it overrides
-  get_scores() to combine the individual decoder's scores.
+  get_scores_logsoftmax() and best_k() to combine the individual decoder's scores, and concatenate_states() to
+  unwrap lists of ensemble states.
+
+  Scores are combined log-linearly, i.e. as a weighted sum of the individual log-softmax outputs.
+  If all decoders are plain :class:`xnmt.decoder.MlpSoftmaxDecoder` objects with output projections of identical
+  shape, and decoding is not batched, the output projections and softmaxes of all models are computed by a single
+  batched operation, with the models stacked along the batch dimension.
 
-  Currently only supports averaging.
+  Args:
+    objects: list of decoders
+    weights: list of combination weights (one per decoder), or None for uniform weights
   '''
-  def get_scores_logsoftmax(self, mlp_dec_states):
-    scores = [obj.get_scores_logsoftmax(dec_state) for obj, dec_state in zip(self._objects, mlp_dec_states)]
-    return dy.average(scores)
+  def __init__(self, objects, weights=None):
+    super().__init__(objects)
+    if weights is None:
+      weights = [1.0] * len(objects)
+    self._weights = [weight / sum(weights) for weight in weights]
+    self._stackable = self._check_stackable(objects)
+    self._stacked_output = None
+    self._stacked_output_cg_version = None
+
+  @staticmethod
+  def _check_stackable(decoders):
+    shapes = set()
+    for decoder in decoders:
+      if type(decoder) != MlpSoftmaxDecoder or type(decoder.mlp_layer) != MLP \
+              or type(decoder.mlp_layer.output_projector) != Linear or not decoder.mlp_layer.output_projector.bias:
+        return False
+      shapes.add(decoder.mlp_layer.output_projector.W1.shape())
+    return len(shapes) == 1
 
+  def get_scores_logsoftmax(self, mlp_dec_states):
+    if self._stackable and all(dec_state.rnn_state.output().dim()[1] == 1 for dec_state in mlp_dec_states):
+      logsoftmaxes = self._get_stacked_logsoftmax(mlp_dec_states)
+    else:
+      logsoftmaxes = dy.concatenate_cols([obj.get_scores_logsoftmax(dec_state)
+                                          for obj, dec_state in zip(self._objects, mlp_dec_states)])
+    return logsoftmaxes * dy.inputTensor(self._weights)
+
+  def best_k(self, mlp_dec_states, k):
+    return Decoder.best_k(self, mlp_dec_states, k)
+
+  def concatenate_states(self, mlp_dec_states):
+    return EnsembleListDelegate([obj.concatenate_states([mlp_dec_state[i] for mlp_dec_state in mlp_dec_states])
+                                 for i, obj in enumerate(self._objects)])
+
+  def _get_stacked_logsoftmax(self, mlp_dec_states):
+    # the stacked parameter expressions are created once per computation graph
+    cg_version = dy.cg_version()
+    if self._stacked_output_cg_version != cg_version:
+      self._stacked_output_cg_version = cg_version
+      projectors = [obj.mlp_layer.output_projector for obj in self._objects]
+      self._stacked_output = (dy.concatenate_to_batch([dy.parameter(projector.W1) for projector in projectors]),
+                              dy.concatenate_to_batch([dy.parameter(projector.b1) for projector in projectors]))
+    W, b = self._stacked_output
+    hidden = dy.concatenate_to_batch([obj.mlp_layer.get_hidden(dy.concatenate([dec_state.rnn_state.output(),
+                                                                                dec_state.context]))
+                                      for obj, dec_state in zip(self._objects, mlp_dec_states)])
+    logsoftmaxes = dy.log_softmax(dy.affine_transform([b, W, hidden]))
+    # move the models from the batch dimension into columns
+    return dy.reshape(logsoftmaxes, (logsoftmaxes.dim()[0][0], len(self._objects)), batch_size=1)